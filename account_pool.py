@@ -0,0 +1,385 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Container, Dict, List, Optional, Tuple
+
+from circuit_breaker import (
+    CircuitBreaker,
+    STATE_CLOSED,
+    STATE_OPEN,
+    STATE_BY_ACCOUNT_STATUS,
+    ACCOUNT_STATUS_BY_STATE,
+)
+from config import settings
+import metrics
+from shared_state import SharedView, shared_state
+
+logger = logging.getLogger(__name__)
+
+STRATEGY_LEAST_OUTSTANDING = "least_outstanding"
+STRATEGY_WEIGHTED_ROUND_ROBIN = "weighted_round_robin"
+
+
+@dataclass
+class PooledAccount:
+    account_id: int
+    name: str
+    token: str
+    weight: int = 1
+    outstanding: int = 0
+    # 多 worker 时其他 worker 在该账号上的在途数（选账号时从共享状态读取）
+    remote: int = 0
+    # 该账号在堆中最新条目的序号，序号不一致的条目已过期
+    heap_seq: int = -1
+    breaker: CircuitBreaker = field(default_factory=CircuitBreaker)
+
+    @property
+    def load(self) -> int:
+        return self.outstanding + self.remote
+
+
+class AccountPool:
+    """内存账号池：与数据库账号表保持同步，按策略 O(1)/O(log n) 选出下一个 Token"""
+
+    def __init__(self, strategy: str = STRATEGY_LEAST_OUTSTANDING):
+        if strategy not in (STRATEGY_LEAST_OUTSTANDING, STRATEGY_WEIGHTED_ROUND_ROBIN):
+            raise ValueError(f"未知的账号调度策略: {strategy}")
+        self.strategy = strategy
+        self._lock = threading.Lock()
+        self._accounts: Dict[int, PooledAccount] = {}
+        # 最少在途请求：惰性删除的小根堆 (load, seq, account_id)，load 含其他 worker 的在途数；
+        # 每个账号只有 seq 等于 heap_seq 的条目有效，归还后的新条目排在同等负载的空闲账号之后
+        self._heap: List[Tuple[int, int, int]] = []
+        self._seq = itertools.count()
+        # 加权轮询：预先展开的调度表 + 游标
+        self._schedule: List[int] = []
+        self._cursor = 0
+        # 熔断状态变化回调 (account_id, account_status)，在锁外调用
+        self._listeners: List[Callable[[int, str], None]] = []
+
+    # ---- 同步 ----
+
+    @staticmethod
+    def is_eligible(account) -> bool:
+        # quarantined / probing 由熔断器管理，仍留在池中等待探测
+        return account.status in STATE_BY_ACCOUNT_STATUS and bool(account.auth_token)
+
+    def add_listener(self, listener: Callable[[int, str], None]) -> None:
+        self._listeners.append(listener)
+
+    def _notify(self, changes: List[Tuple[int, str]]) -> None:
+        for account_id, state in changes:
+            for listener in self._listeners:
+                listener(account_id, ACCOUNT_STATUS_BY_STATE[state])
+
+    @staticmethod
+    def _new_entry(account) -> PooledAccount:
+        return PooledAccount(
+            account_id=account.id,
+            name=account.name,
+            token=account.auth_token,
+            weight=AccountPool._weight_of(account),
+            breaker=CircuitBreaker(STATE_BY_ACCOUNT_STATUS[account.status]),
+        )
+
+    @staticmethod
+    def _weight_of(account) -> int:
+        # 权重保存在 auth_data["weight"]，默认 1
+        try:
+            return max(1, int((account.auth_data or {}).get("weight", 1)))
+        except (TypeError, ValueError):
+            return 1
+
+    def load(self, accounts) -> None:
+        with self._lock:
+            self._accounts.clear()
+            for account in accounts:
+                if self.is_eligible(account):
+                    self._accounts[account.id] = self._new_entry(account)
+            self._rebuild()
+        logger.info(f"账号池已加载 {len(self._accounts)} 个可用账号 (策略: {self.strategy})")
+
+    def upsert(self, account) -> None:
+        """账号创建/更新/绑定后调用；不再满足条件的账号会被移出"""
+        with self._lock:
+            if not self.is_eligible(account):
+                if self._accounts.pop(account.id, None) is not None:
+                    self._rebuild()
+                return
+
+            current = self._accounts.get(account.id)
+            if current is None:
+                self._accounts[account.id] = self._new_entry(account)
+            else:
+                # Token 更换或手动恢复为 active 时解除熔断
+                if current.token != account.auth_token or account.status == "active":
+                    current.breaker.reset()
+                current.name = account.name
+                current.token = account.auth_token
+                current.weight = self._weight_of(account)
+            self._rebuild()
+
+    def sync(self, accounts) -> None:
+        """其他 worker 修改账号后按数据库重新同步；与 load 不同，保留现有账号的在途数与熔断状态"""
+        seen = set()
+        for account in accounts:
+            seen.add(account.id)
+            self.upsert(account)
+        with self._lock:
+            removed = [account_id for account_id in self._accounts if account_id not in seen]
+            for account_id in removed:
+                del self._accounts[account_id]
+            if removed:
+                self._rebuild()
+
+    def remove(self, account_id: int) -> None:
+        with self._lock:
+            if self._accounts.pop(account_id, None) is not None:
+                self._rebuild()
+
+    def _rebuild(self) -> None:
+        if self.strategy == STRATEGY_WEIGHTED_ROUND_ROBIN:
+            self._rebuild_schedule()
+        else:
+            self._rebuild_heap()
+
+    def _rebuild_heap(self) -> None:
+        self._heap = []
+        for account in self._accounts.values():
+            account.heap_seq = next(self._seq)
+            self._heap.append((account.load, account.heap_seq, account.account_id))
+        heapq.heapify(self._heap)
+
+    def _rebuild_schedule(self) -> None:
+        # 平滑加权轮询展开成一个周期的调度表，acquire 时只需移动游标
+        schedule = []
+        current = {account_id: 0 for account_id in self._accounts}
+        total = sum(a.weight for a in self._accounts.values())
+        for _ in range(total):
+            for account_id, account in self._accounts.items():
+                current[account_id] += account.weight
+            chosen = max(current, key=current.get)
+            current[chosen] -= total
+            schedule.append(chosen)
+        self._schedule = schedule
+        self._cursor = 0
+
+    # ---- 调度 ----
+
+    def acquire(
+        self,
+        max_outstanding: Optional[int] = None,
+        exclude: Container[int] = (),
+        max_total: Optional[int] = None
+    ) -> Optional[PooledAccount]:
+        """
+        选出一个未熔断的账号并计入在途请求，调用方必须在请求结束后 release。
+        max_outstanding 为单账号在途上限，所有可用账号都已达到上限时返回 None；exclude 中的账号不会被选中。
+        多 worker 共享状态下在途数按所有 worker 合计，max_total 为合计的总在途上限（单进程时由准入控制计数）。
+        """
+        changes = []
+        with self._lock:
+            if not self._accounts:
+                return None
+            if shared_state.active:
+                with shared_state.acquire_transaction() as view:
+                    account = self._acquire_shared(view, max_outstanding, exclude, max_total, changes)
+            else:
+                account = self._acquire_local(max_outstanding, exclude, changes)
+        self._notify(changes)
+        return account
+
+    def _acquire_local(
+        self,
+        max_outstanding: Optional[int],
+        exclude: Container[int],
+        changes: List[Tuple[int, str]]
+    ) -> Optional[PooledAccount]:
+        now = time.monotonic()
+        if self.strategy == STRATEGY_WEIGHTED_ROUND_ROBIN:
+            account = self._next_round_robin(now, changes, max_outstanding, exclude)
+        else:
+            account = self._next_least_outstanding(now, changes, exclude)
+            # 堆顶是可用账号中在途最少的，它满了其余也都满了
+            if account is not None and max_outstanding and account.load >= max_outstanding:
+                account = None
+        if account is not None:
+            account.breaker.on_acquire()
+            account.outstanding += 1
+            self._push(account)
+        return account
+
+    def _acquire_shared(
+        self,
+        view: Optional[SharedView],
+        max_outstanding: Optional[int],
+        exclude: Container[int],
+        max_total: Optional[int],
+        changes: List[Tuple[int, str]]
+    ) -> Optional[PooledAccount]:
+        # view 为 None 表示共享写锁繁忙或文件不可用，按上次读到的其他 worker 在途数调度，在途数由后台线程写回
+        if view is not None:
+            self._apply_shared(view)
+        if max_total and sum(a.load for a in self._accounts.values()) >= max_total:
+            return None
+        account = self._acquire_local(max_outstanding, exclude, changes)
+        if account is not None:
+            shared_state.write_lease(account.account_id, account.outstanding)
+        return account
+
+    def _apply_shared(self, view: SharedView) -> None:
+        for account in self._accounts.values():
+            remote = view.outstanding.get(account.account_id, 0)
+            if remote != account.remote:
+                account.remote = remote
+                self._push(account)
+        # 其他 worker 的熔断 / 恢复；不触发监听器，数据库状态由发生变化的 worker 写入
+        for account_id, state in view.breakers:
+            account = self._accounts.get(account_id)
+            if account is not None:
+                account.breaker.restore(state)
+
+    def release(self, account_id: int, status_code: Optional[int] = None) -> None:
+        """归还账号；status_code 为上游 HTTP 状态（0 表示连接失败，None 表示未拿到结果）"""
+        changes = []
+        with self._lock:
+            account = self._accounts.get(account_id)
+            if account is None:
+                return
+            if account.outstanding > 0:
+                account.outstanding -= 1
+                self._push(account)
+                if shared_state.active:
+                    shared_state.write_lease(account_id, account.outstanding)
+            before = account.breaker.state
+            if status_code is None:
+                account.breaker.on_abandon()
+            else:
+                account.breaker.record(status_code, time.monotonic())
+            if account.breaker.state != before:
+                changes.append((account_id, account.breaker.state))
+                if shared_state.active and account.breaker.state in (STATE_OPEN, STATE_CLOSED):
+                    shared_state.publish_breaker(account_id, account.breaker.export())
+                if account.breaker.state != STATE_CLOSED:
+                    logger.warning(f"账号 {account.name} 熔断: 上游状态 {status_code}")
+                else:
+                    logger.info(f"账号 {account.name} 已恢复")
+        self._notify(changes)
+
+    def _allow(self, account: PooledAccount, now: float, changes: List[Tuple[int, str]]) -> bool:
+        before = account.breaker.state
+        allowed = account.breaker.allow(now)
+        if account.breaker.state != before:
+            changes.append((account.account_id, account.breaker.state))
+        return allowed
+
+    def _push(self, account: PooledAccount) -> None:
+        if self.strategy != STRATEGY_LEAST_OUTSTANDING:
+            return
+        account.heap_seq = next(self._seq)
+        heapq.heappush(self._heap, (account.load, account.heap_seq, account.account_id))
+        # 过期条目过多时压缩堆，避免无限增长
+        if len(self._heap) > 4 * len(self._accounts) + 16:
+            self._rebuild_heap()
+
+    def _next_least_outstanding(
+        self,
+        now: float,
+        changes: List[Tuple[int, str]],
+        exclude: Container[int] = ()
+    ) -> Optional[PooledAccount]:
+        skipped = []
+        chosen = None
+        while self._heap:
+            entry = self._heap[0]
+            account = self._accounts.get(entry[2])
+            if account is None or account.heap_seq != entry[1]:
+                heapq.heappop(self._heap)
+                continue
+            if account.account_id not in exclude and self._allow(account, now, changes):
+                chosen = account
+                break
+            # 熔断中或被排除的账号暂时移出堆顶，选完后放回
+            skipped.append(heapq.heappop(self._heap))
+        for entry in skipped:
+            heapq.heappush(self._heap, entry)
+        return chosen
+
+    def _next_round_robin(
+        self,
+        now: float,
+        changes: List[Tuple[int, str]],
+        max_outstanding: Optional[int] = None,
+        exclude: Container[int] = ()
+    ) -> Optional[PooledAccount]:
+        for _ in range(len(self._schedule)):
+            account = self._accounts[self._schedule[self._cursor]]
+            self._cursor = (self._cursor + 1) % len(self._schedule)
+            if account.account_id in exclude:
+                continue
+            if max_outstanding and account.load >= max_outstanding:
+                continue
+            if self._allow(account, now, changes):
+                return account
+        return None
+
+    def is_saturated(self, max_outstanding: int) -> bool:
+        """是否有未熔断的账号因达到在途上限而暂不可用（即等待其他请求结束后就能拿到账号）"""
+        with self._lock:
+            return any(
+                a.breaker.state == STATE_CLOSED and a.load >= max_outstanding
+                for a in self._accounts.values()
+            )
+
+    def total_load(self) -> int:
+        """所有账号的在途请求合计（多 worker 时含其他 worker 上次同步到的部分）"""
+        with self._lock:
+            return sum(a.load for a in self._accounts.values())
+
+    def retry_in(self) -> Optional[float]:
+        """
+        池中有账号但暂时都不可用（熔断冷却中）时，最早恢复探测的剩余秒数；
+        没有任何可用账号（未配置）时返回 None
+        """
+        with self._lock:
+            if not self._accounts:
+                return None
+            now = time.monotonic()
+            return min(
+                max(a.breaker.open_until - now, 0.0) if a.breaker.state == STATE_OPEN else 0.0
+                for a in self._accounts.values()
+            )
+
+    def circuit_state(self, account_id: int) -> Optional[Dict]:
+        with self._lock:
+            account = self._accounts.get(account_id)
+            return account.breaker.to_dict() if account else None
+
+    def snapshot(self) -> List[Dict[str, int]]:
+        with self._lock:
+            return [
+                {
+                    "account_id": a.account_id,
+                    "name": a.name,
+                    "weight": a.weight,
+                    "outstanding": a.outstanding,
+                    "remote_outstanding": a.remote,
+                    "circuit": a.breaker.state,
+                }
+                for a in self._accounts.values()
+            ]
+
+    def __len__(self) -> int:
+        return len(self._accounts)
+
+
+# 全局账号池实例
+account_pool = AccountPool(settings.account_strategy)
+
+metrics.registry.register(metrics.CallbackMetric(
+    "puter_account_outstanding_requests", "In-flight upstream requests per account", ("account", "circuit"),
+    lambda: {(a["name"], a["circuit"]): a["outstanding"] for a in account_pool.snapshot()},
+))
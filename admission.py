@@ -0,0 +1,248 @@
+import asyncio
+import logging
+import math
+import time
+from collections import deque
+from typing import Any, Container, Deque, Dict, Optional
+
+from account_pool import PooledAccount, account_pool
+from config import settings
+import metrics
+from shared_state import shared_state
+
+logger = logging.getLogger(__name__)
+
+# 优先级通道，按顺序出队
+LANES = ("high", "normal", "low")
+DEFAULT_LANE = "normal"
+PRIORITY_HEADER = "X-Priority"
+
+
+class AdmissionRejected(Exception):
+    """排队已满或等待超时；retry_after 为建议的重试秒数"""
+
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+    def to_openai(self) -> Dict[str, Any]:
+        return {
+            "error": {
+                "message": f"Too many concurrent requests ({self.reason}), retry after {self.retry_after}s",
+                "type": "rate_limit_error",
+                "code": "rate_limit_exceeded",
+            }
+        }
+
+
+def resolve_lane(header_value: Optional[str], api_key: Optional[str] = None) -> str:
+    """API Key 在 settings.admission_key_priorities 中有配置时优先，其次是 X-Priority 请求头"""
+    if api_key and api_key in settings.admission_key_priorities:
+        lane = settings.admission_key_priorities[api_key]
+    else:
+        lane = (header_value or "").strip().lower()
+    return lane if lane in LANES else DEFAULT_LANE
+
+
+class AdmissionController:
+    """
+    账号池前的准入控制：全局与单账号在途上限 + 有界的分优先级等待队列。
+    请求结束时 release 归还名额，并按通道优先级唤醒排队者。
+    """
+
+    def __init__(self):
+        self.inflight = 0
+        self._queues: Dict[str, Deque[asyncio.Future]] = {lane: deque() for lane in LANES}
+        self._queued = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.waited = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.wait_ewma = 0.0
+
+    @property
+    def max_inflight(self) -> int:
+        return settings.admission_max_inflight
+
+    @property
+    def per_account_limit(self) -> int:
+        return settings.admission_per_account_limit
+
+    def _try_acquire(self, exclude: Container[int] = ()) -> Optional[PooledAccount]:
+        if self.max_inflight and self.inflight >= self.max_inflight:
+            return None
+        account = account_pool.acquire(self.per_account_limit or None, exclude, self.max_inflight or None)
+        if account is not None:
+            self.inflight += 1
+        return account
+
+    def _can_wait(self) -> bool:
+        # 没有账号或账号全部熔断时排队也拿不到，直接返回让调用方报错
+        if not len(account_pool):
+            return False
+        if self.max_inflight and max(self.inflight, account_pool.total_load()) >= self.max_inflight:
+            return True
+        return bool(self.per_account_limit) and account_pool.is_saturated(self.per_account_limit)
+
+    def retry_after(self) -> int:
+        return max(1, math.ceil(self.wait_ewma or settings.admission_queue_timeout / 4))
+
+    async def acquire(self, lane: str = DEFAULT_LANE) -> Optional[PooledAccount]:
+        """拿到账号后返回；没有可用账号返回 None；排队已满或超时抛出 AdmissionRejected"""
+        if self._queued:
+            # 账号恢复或新增时没有 release 触发分发，借新请求补一次
+            self._dispatch()
+        if not self._queued:
+            account = self._try_acquire()
+            if account is not None:
+                self.admitted += 1
+                return account
+            if not self._can_wait():
+                return None
+
+        if self._queued >= settings.admission_queue_size:
+            self.rejected += 1
+            raise AdmissionRejected("queue_full", self.retry_after())
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._queues[lane].append(waiter)
+        self._queued += 1
+        start = time.monotonic()
+        try:
+            # shield：超时或调用方取消时由这里决定如何处理 waiter，避免与 _dispatch 竞争
+            account = await asyncio.wait_for(asyncio.shield(waiter), settings.admission_queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.done():
+                # 名额恰好在超时/取消的同时分到，归还给下一个排队者
+                if waiter.result() is not None:
+                    self.release(waiter.result().account_id)
+            else:
+                waiter.cancel()
+                self._queues[lane].remove(waiter)
+                self._queued -= 1
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            self.timed_out += 1
+            raise AdmissionRejected("timeout", self.retry_after())
+        finally:
+            self._record_wait(time.monotonic() - start)
+
+        if account is None:
+            return None
+        self.admitted += 1
+        return account
+
+    def try_acquire(self, exclude: Container[int] = (), held: bool = False) -> Optional[PooledAccount]:
+        """
+        不排队：立即有空闲名额时返回账号，否则返回 None；有请求在排队时不与它们争抢。
+        held=True 表示调用方已用 hold 占住一个名额（失败转移），用它换账号，不让给排队者；
+        拿不到账号时名额仍被占着，由调用方 unhold。
+        """
+        if held:
+            self.inflight -= 1
+            account = self._try_acquire(exclude)
+            if account is None:
+                self.inflight += 1
+            return account
+        if self._queued:
+            return None
+        account = self._try_acquire(exclude)
+        if account is not None:
+            self.admitted += 1
+        return account
+
+    def hold(self):
+        """失败转移：归还失败的账号之前占住一个准入名额，退避期间不被排队的请求拿走"""
+        self.inflight += 1
+
+    def unhold(self):
+        if self.inflight > 0:
+            self.inflight -= 1
+        self._dispatch()
+
+    def _record_wait(self, seconds: float):
+        self.waited += 1
+        self.wait_total += seconds
+        self.wait_max = max(self.wait_max, seconds)
+        self.wait_ewma = seconds if self.waited == 1 else 0.8 * self.wait_ewma + 0.2 * seconds
+
+    def release(self, account_id: int, status_code: Optional[int] = None):
+        account_pool.release(account_id, status_code)
+        if self.inflight > 0:
+            self.inflight -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        """按优先级把空出的名额交给排队者"""
+        while self._queued:
+            account = self._try_acquire()
+            if account is None:
+                if not self._can_wait():
+                    # 账号全部熔断或被移除：排队者不再等待
+                    self._fail_all()
+                return
+            self._next_waiter().set_result(account)
+
+    def _next_waiter(self) -> Optional[asyncio.Future]:
+        for lane in LANES:
+            queue = self._queues[lane]
+            if queue:
+                self._queued -= 1
+                return queue.popleft()
+        return None
+
+    def _fail_all(self):
+        logger.warning(f"没有可用账号，放弃 {self._queued} 个排队请求")
+        while self._queued:
+            self._next_waiter().set_result(None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "inflight": self.inflight,
+            "max_inflight": self.max_inflight,
+            "per_account_limit": self.per_account_limit,
+            "queue_depth": self._queued,
+            "queue_depth_by_lane": {lane: len(self._queues[lane]) for lane in LANES},
+            "queue_size": settings.admission_queue_size,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "wait_count": self.waited,
+            "wait_avg_ms": round(self.wait_total / self.waited * 1000, 1) if self.waited else 0.0,
+            "wait_max_ms": round(self.wait_max * 1000, 1),
+            "wait_recent_ms": round(self.wait_ewma * 1000, 1),
+        }
+
+
+# 全局准入控制实例
+admission = AdmissionController()
+
+
+async def _dispatch_on_heartbeat(reaped: int):
+    # 其他 worker 归还的名额不会触发本进程的 release，排队的请求在每次心跳时重试
+    if admission._queued:
+        admission._dispatch()
+
+shared_state.add_tick_listener(_dispatch_on_heartbeat)
+
+metrics.registry.register(metrics.CallbackMetric(
+    "puter_inflight_requests", "Requests currently holding an account", (),
+    lambda: {(): admission.inflight},
+))
+metrics.registry.register(metrics.CallbackMetric(
+    "puter_admission_queue_depth", "Requests waiting for admission, by priority lane", ("lane",),
+    lambda: {(lane,): len(queue) for lane, queue in admission._queues.items()},
+))
+metrics.registry.register(metrics.CallbackMetric(
+    "puter_admission_rejections_total", "Requests rejected by admission control", ("reason",),
+    lambda: {("queue_full",): admission.rejected, ("timeout",): admission.timed_out},
+    "counter",
+))
+metrics.registry.register(metrics.CallbackMetric(
+    "puter_admission_wait_seconds_total", "Total time requests spent queued for admission", (),
+    lambda: {(): admission.wait_total},
+    "counter",
+))
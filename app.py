@@ -1,35 +1,72 @@
+import time
+
+# 导入阶段计时的起点（在导入 FastAPI 等依赖之前）
+_import_started = time.perf_counter()
+
 import asyncio
-import platform
 import sys
 
 # 解决 Windows 上 Playwright 的 NotImplementedError 问题
 # 必须在任何其他导入之前设置，特别是 asyncio 被隐式使用之前
-if platform.system() == 'Windows':
+if sys.platform == 'win32':
     asyncio.set_event_loop_policy(asyncio.WindowsProactorEventLoopPolicy())
 
-from typing import Optional
+from typing import Any, Dict, List, Optional
 
-from fastapi import FastAPI, Depends, HTTPException, BackgroundTasks, Request, Header
+from fastapi import FastAPI, Depends, HTTPException, BackgroundTasks, Request, Header, UploadFile, File, Form
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse, FileResponse
-from sqlalchemy.orm import Session
+from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse, FileResponse, Response
+from sqlalchemy.ext.asyncio import AsyncSession
+import functools
 import logging
-import uvicorn
+import math
 import json
 import os
+from datetime import datetime
+
+_third_party_imported = time.perf_counter()
 
-logging.basicConfig(level=logging.INFO)
+from log_utils import setup_logging, StreamLog, PhaseTimer
+setup_logging()
 logger = logging.getLogger(__name__)
-from typing import List, Dict, Any
-from puter_bridge import PuterBridge
+from puter_bridge import PuterBridge, UpstreamError
+from http_client import UpstreamClientPool
+from stats_buffer import stats_buffer
+from response_cache import (
+    response_cache,
+    make_cache_key,
+    is_cacheable,
+    is_deterministic,
+    render_sse,
+    render_json,
+    CACHE_CONTROL_HEADER,
+    CACHE_STATUS_HEADER,
+)
+from singleflight import singleflight
+from shared_state import shared_state
+from account_pool import account_pool
+from hedging import hedger
+from failover import Failover, is_error_frame, is_error_result
+import sse_utils
+import metrics
+import token_usage
+from batch_runner import batch_runner
+from image_store import IMAGE_ROUTE, ImageFileResponse, image_store
+from admission import admission, AdmissionRejected, PRIORITY_HEADER, resolve_lane
+from streaming import CancellableStreamingResponse, record_cancellation, until_disconnected
+from starlette.requests import ClientDisconnect
+from coalesce import COALESCE_HEADER, CoalesceOptions, resolve_options as resolve_coalesce
 from pathlib import Path
-from config import settings
-from database import get_db, create_tables
+from config import settings, init_directories
+from database import get_async_db, create_tables, AsyncSessionLocal
 from models import Account, AppConfig, BrowserSession
 import schemas
 import services
-import providers
+
+import_timer = PhaseTimer("import", _import_started)
+import_timer.mark("third_party", _third_party_imported)
+import_timer.mark("modules")
 
 app = FastAPI(title=settings.app_name, version=settings.app_version)
 
@@ -47,13 +84,54 @@ static_dir = Path("./static")
 static_dir.mkdir(exist_ok=True)
 app.mount("/static", StaticFiles(directory=static_dir), name="static")
 
-# 初始化数据库
-create_tables()
-
-# 确保数据目录存在
-from config import settings
-for dir_path in [settings.data_dir, settings.accounts_dir, settings.logs_dir, settings.cache_dir]:
-    Path(dir_path).mkdir(parents=True, exist_ok=True)
+import_timer.mark("app")
+# python app.py 启动时 uvicorn 会以 "app" 再导入一次本模块（依赖均已加载），只报告第一次导入
+if __name__ == "__main__" or not hasattr(sys.modules.get("__main__"), "import_timer"):
+    import_timer.report()
+
+# 应用生命周期：共享上游连接池
+def _prepare_storage():
+    # 目录与表结构只在这里初始化（同一进程只执行一次，表结构未变时只读一次 user_version）；
+    # 多 worker 时先登记到共享状态，之后的账号调度与批处理认领都经过它
+    init_directories()
+    create_tables()
+    shared_state.open()
+
+async def _load_database():
+    async with AsyncSessionLocal() as db:
+        await services.AccountService.load_account_pool(db)
+        await services.ConfigService.load_config_cache(db)
+
+@app.on_event("startup")
+async def on_startup():
+    timer = PhaseTimer("startup")
+    loop = asyncio.get_running_loop()
+    await timer.timed("storage", loop.run_in_executor(None, _prepare_storage))
+    # 互不依赖的预热并行执行：数据库（账号池、配置缓存）、磁盘索引、分词器、上游连接
+    warmups = [
+        timer.timed("database", _load_database()),
+        timer.timed("image_index", loop.run_in_executor(None, image_store.load_index)),
+        timer.timed("tokenizer", loop.run_in_executor(None, token_usage.load_tokenizer)),
+        timer.timed("upstream", UpstreamClientPool.start()),
+    ]
+    if settings.response_cache_enabled:
+        warmups.append(timer.timed("response_index", loop.run_in_executor(None, response_cache.load_index)))
+    await asyncio.gather(*warmups)
+    stats_buffer.start()
+    # 批处理需要账号池，放在预热之后
+    await timer.timed("batches", batch_runner.resume())
+    shared_state.start()
+    app.state.started_at = time.time()
+    timer.report()
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    await batch_runner.stop()
+    await shared_state.stop()
+    await UpstreamClientPool.close()
+    await stats_buffer.stop()
+    # 持久化图片 LRU 的最近访问顺序
+    image_store.save_index()
 
 # 首页
 @app.get("/", response_class=HTMLResponse)
@@ -105,38 +183,43 @@ async def admin_console():
 async def puter_app():
     return FileResponse("static/app.html")
 
+@functools.lru_cache(maxsize=1)
+def _host_info() -> Dict[str, str]:
+    # platform.platform() 会读取解释器文件判断 libc 版本，只在第一次请求时计算
+    import platform
+    return {"platform": platform.platform(), "host_name": platform.node()}
+
 # 系统信息API
 @app.get("/api/system/info")
 def system_info():
-    import platform
-    import sys
-    from datetime import datetime
-    
+    started_at = getattr(app.state, "started_at", None)
     return {
         "app_name": settings.app_name,
         "app_version": settings.app_version,
         "python_version": f"{sys.version_info.major}.{sys.version_info.minor}.{sys.version_info.micro}",
-        "platform": platform.platform(),
-        "host_name": platform.node(),
+        **_host_info(),
         "working_dir": os.getcwd(),
-        "uptime": datetime.now().isoformat(),  # 简化，实际应记录启动时间
+        "uptime": round(time.time() - started_at, 1) if started_at else 0.0,
         "data_dir": settings.data_dir,
     }
 
 # 系统状态API
 @app.get("/api/system/status")
-def system_status(db: Session = Depends(get_db)):
-    from sqlalchemy import func
+async def system_status(db: AsyncSession = Depends(get_async_db)):
+    from sqlalchemy import func, select
+    
+    async def count(stmt):
+        return (await db.execute(stmt)).scalar() or 0
     
     # 账号统计
-    total_accounts = db.query(func.count(Account.id)).scalar() or 0
-    active_accounts = db.query(func.count(Account.id)).filter(Account.is_active == True).scalar() or 0
+    total_accounts = await count(select(func.count(Account.id)))
+    active_accounts = await count(select(func.count(Account.id)).where(Account.is_active == True))
     
     # 配置统计
-    total_configs = db.query(func.count(AppConfig.id)).scalar() or 0
+    total_configs = await count(select(func.count(AppConfig.id)))
     
     # 会话统计
-    active_sessions = db.query(func.count(BrowserSession.id)).filter(BrowserSession.status == "active").scalar() or 0
+    active_sessions = await count(select(func.count(BrowserSession.id)).where(BrowserSession.status == "active"))
     
     # 内存使用（简化）
     import psutil
@@ -150,15 +233,29 @@ def system_status(db: Session = Depends(get_db)):
         "total_configs": total_configs,
         "active_sessions": active_sessions,
         "memory_usage": memory_percent,
-        "api_requests": 0,  # 可扩展：记录请求计数
+        "api_requests": metrics.api_requests(shared_state.peer_metrics()),
+        "admission": admission.stats(),
+        "image_store": image_store.stats(),
     }
 
-# API密钥验证依赖
-async def verify_api_key(
-    authorization: Optional[str] = Header(None),
-    db: Session = Depends(get_db)
-):
-    api_key = services.ConfigService.get_config(db, key="api_key")
+# 准入控制：在途请求、各优先级队列深度与排队等待时间
+@app.get("/api/system/admission")
+async def admission_status():
+    return admission.stats()
+
+# 多 worker 部署：各 worker 的心跳与账号在途数（含其他 worker）
+@app.get("/api/system/workers")
+async def workers_status():
+    return {
+        "worker_id": shared_state.worker_id,
+        "shared_state": shared_state.active,
+        "workers": shared_state.workers(),
+        "accounts": account_pool.snapshot(),
+    }
+
+# API密钥验证依赖（读取进程内配置缓存，不访问数据库）
+def verify_api_key(authorization: Optional[str] = Header(None)):
+    api_key = services.ConfigService.get_cached_raw("api_key")
     if api_key and api_key != "1":  # 如果配置了API密钥且不是默认值
         if not authorization or "bearer" not in authorization.lower():
             raise HTTPException(status_code=401, detail="需要 Bearer Token 认证")
@@ -166,62 +263,365 @@ async def verify_api_key(
         if token != api_key:
             raise HTTPException(status_code=403, detail="无效的 API Key")
 
+# 流结束（含客户端断开）后归还账号，并把上游状态交给熔断器
+async def _stream_with_account(
+    request_data: Dict[str, Any],
+    account,
+    cache_key: Optional[str] = None,
+    coalesce: Optional[CoalesceOptions] = None,
+    outcome: Optional[List[int]] = None
+):
+    # outcome 收集上游状态码，调用方据此判断是否失败转移
+    outcome = outcome if outcome is not None else []
+    fragments = [] if cache_key else None
+    stream_log = StreamLog(request_data.get("model", PuterBridge.DEFAULT_CHAT_MODEL), account.name)
+    chunks = PuterBridge.chat_completion_stream(
+        request_data,
+        account.token,
+        on_status=outcome.append,
+        on_text=fragments.append if fragments is not None else None,
+        coalesce=coalesce,
+        on_usage=stream_log.on_usage
+    )
+    try:
+        async for chunk in chunks:
+            stream_log.on_chunk(chunk)
+            yield chunk
+    finally:
+        await chunks.aclose()
+        status_code = outcome[-1] if outcome else None
+        services.AccountService.release_account(account.account_id, status_code)
+        stream_log.finish(status_code if status_code is not None else "cancelled")
+    # 只缓存完整成功的回答
+    if cache_key and outcome and outcome[-1] == 200:
+        model = request_data.get("model", PuterBridge.DEFAULT_CHAT_MODEL)
+        await response_cache.put(cache_key, model, "".join(fragments))
+
+# 非流式请求：返回 (HTTP 状态码, 响应体)，以单个元素的异步迭代器形式产出，便于请求合并
+async def _complete_with_account(
+    request_data: Dict[str, Any],
+    account,
+    cache_key: Optional[str] = None,
+    outcome: Optional[List[int]] = None
+):
+    outcome = outcome if outcome is not None else []
+    stream_log = StreamLog(request_data.get("model", PuterBridge.DEFAULT_CHAT_MODEL), account.name, stream=False)
+    try:
+        result = await PuterBridge.chat_completion(request_data, account.token, on_status=outcome.append)
+        stream_log.on_usage(result["usage"])
+    except UpstreamError as e:
+        yield e.http_status, e.to_openai()
+        return
+    finally:
+        status_code = outcome[-1] if outcome else None
+        services.AccountService.release_account(account.account_id, status_code)
+        stream_log.finish(status_code if status_code is not None else "cancelled")
+    if cache_key:
+        await response_cache.put(cache_key, result["model"], result["choices"][0]["message"]["content"])
+    yield 200, result
+
+async def _json_result(request: Request, results, headers: Dict[str, str]) -> Response:
+    try:
+        status_code, body = await until_disconnected(request, results.__anext__())
+        return JSONResponse(body, status_code=status_code, headers=headers)
+    except StopAsyncIteration:
+        # 上游任务被取消时没有结果
+        return JSONResponse(UpstreamError("Upstream request cancelled", 0).to_openai(), status_code=502, headers=headers)
+    except ClientDisconnect:
+        # 客户端已断开，响应不会被读取
+        return Response(status_code=499)
+    finally:
+        await results.aclose()
+
+async def _prepend(first: bytes, rest):
+    # 预读出的首个分块放回流的开头
+    try:
+        yield first
+        async for chunk in rest:
+            yield chunk
+    finally:
+        await rest.aclose()
+
+def _error_frame_response(frame: bytes, headers: Dict[str, str]) -> JSONResponse:
+    """还没有发送任何内容时，流的错误帧改为带 HTTP 状态码的 JSON 错误返回"""
+    body = json.loads(frame[len(b"data: "):])
+    code = body.get("error", {}).get("code")
+    status_code = UpstreamError("", code).http_status if isinstance(code, int) else 502
+    return JSONResponse(body, status_code=status_code, headers=headers)
+
+SINGLEFLIGHT_HEADER = "X-Singleflight"
+
 # OpenAI兼容API端点
 @app.post("/v1/chat/completions")
-async def chat_completions(
-    request: Request,
-    db: Session = Depends(get_db)
-):
-    await verify_api_key(request.headers.get("Authorization"), db)
+async def chat_completions(request: Request):
+    verify_api_key(request.headers.get("Authorization"))
+    # 已登记为合并请求的发起者、但上游尚未开始时为 True，提前返回前需撤销登记
+    reserved = False
     try:
         request_data = await request.json()
-        token = services.AccountService.get_next_token(db)
-        if not token:
-             raise HTTPException(status_code=400, detail="未找到活跃的 Puter 账号。请先在管理后台连接账号。")
-
-        return StreamingResponse(
-            PuterBridge.chat_completion_stream(request_data, token),
-            media_type="text/event-stream"
+        # 与 OpenAI 一致：未指定 stream 时返回完整的 chat.completion JSON
+        stream = bool(request_data.get("stream", False))
+        coalesce = resolve_coalesce(request.headers.get(COALESCE_HEADER)) if stream else None
+
+        cache_key = None
+        headers = {}
+        if is_cacheable(request_data, request.headers.get(CACHE_CONTROL_HEADER)):
+            cache_key = make_cache_key(request_data, PuterBridge.DEFAULT_CHAT_MODEL)
+            cached = await response_cache.get(cache_key)
+            if cached is not None:
+                headers[CACHE_STATUS_HEADER] = "HIT"
+                metrics.chat_shortcuts.inc("cache_hit")
+                usage = token_usage.usage_for(request_data.get("messages"), cached["content"])
+                if not stream:
+                    return JSONResponse(render_json(cached, usage), headers=headers)
+                sse_usage = usage if token_usage.include_usage(request_data) else None
+                return StreamingResponse(render_sse(cached, sse_usage), media_type="text/event-stream", headers=headers)
+            headers[CACHE_STATUS_HEADER] = "MISS"
+
+        # 相同请求正在进行（或已登记、还在等账号）时直接订阅它的输出，不再占用账号；
+        # temperature>0 的请求各自需要独立采样，默认不合并
+        flight_key = None
+        if settings.singleflight_enabled and (
+            cache_key or settings.singleflight_nondeterministic or is_deterministic(request_data)
+        ):
+            request_key = cache_key or make_cache_key(request_data, PuterBridge.DEFAULT_CHAT_MODEL)
+            flight_key = f"{'stream' if stream else 'json'}:{request_key}"
+            if coalesce is not None:
+                flight_key += f":{coalesce.key()}"
+            if stream and token_usage.include_usage(request_data):
+                # 带 usage 的流多一个分块，不能与不带的请求共享输出
+                flight_key += ":usage"
+            # 发起者还在准入队列中时先等它发出（或放弃），排队的相同请求不各自占用账号名额
+            while True:
+                settled = singleflight.pending(flight_key)
+                if settled is None:
+                    break
+                try:
+                    await until_disconnected(request, settled.wait())
+                except ClientDisconnect:
+                    return Response(status_code=499)
+            shared = singleflight.join(flight_key)
+            if shared is not None:
+                headers[SINGLEFLIGHT_HEADER] = "follower"
+                metrics.chat_shortcuts.inc("singleflight_follower")
+                if not stream:
+                    return await _json_result(request, shared, headers)
+                return CancellableStreamingResponse(shared, media_type="text/event-stream", headers=headers)
+            reserved = True
+
+        # 客户端在排队或读取请求期间已断开时不再占用账号
+        if await request.is_disconnected():
+            record_cancellation("poll", request.url.path)
+            return Response(status_code=499)
+
+        authorization = request.headers.get("Authorization") or ""
+        lane = resolve_lane(request.headers.get(PRIORITY_HEADER), authorization.split(" ")[-1] or None)
+        try:
+            account = await until_disconnected(request, services.AccountService.acquire_account(lane))
+        except AdmissionRejected as e:
+            metrics.chat_shortcuts.inc(f"admission_{e.reason}")
+            return JSONResponse(
+                e.to_openai(),
+                status_code=429,
+                headers={**headers, "Retry-After": str(e.retry_after)}
+            )
+        except ClientDisconnect:
+            return Response(status_code=499)
+        if not account:
+            retry_in = account_pool.retry_in()
+            if retry_in is not None:
+                # 账号都在熔断冷却中：服务端的暂时状态，按最早恢复的时间提示重试
+                metrics.chat_shortcuts.inc("all_quarantined")
+                retry_after = max(1, math.ceil(retry_in))
+                return JSONResponse(
+                    {"error": {
+                        "message": f"All upstream accounts are temporarily unavailable, retry after {retry_after}s",
+                        "type": "service_unavailable",
+                        "code": "accounts_unavailable",
+                    }},
+                    status_code=503,
+                    headers={**headers, "Retry-After": str(retry_after)}
+                )
+            metrics.chat_shortcuts.inc("no_account")
+            raise HTTPException(status_code=400, detail="未找到活跃的 Puter 账号。请先在管理后台连接账号。")
+
+        # 首个内容之前上游失败时换账号重试；尝试次数写入 headers
+        model = request_data.get("model", PuterBridge.DEFAULT_CHAT_MODEL)
+
+        def open_attempt(attempt_account, outcome):
+            if not stream:
+                return _complete_with_account(request_data, attempt_account, cache_key, outcome)
+
+            def open_stream(stream_account, stream_outcome):
+                return _stream_with_account(request_data, failover.track(stream_account), cache_key, coalesce, stream_outcome)
+
+            if settings.hedge_enabled:
+                return hedger.stream(
+                    model,
+                    attempt_account,
+                    open_stream,
+                    lambda exclude: services.AccountService.try_acquire_account(failover.tried | set(exclude)),
+                    outcome
+                )
+            return open_stream(attempt_account, outcome)
+
+        failover = Failover(
+            model,
+            account,
+            open_attempt,
+            lambda exclude: services.AccountService.try_acquire_account(exclude, held=True),
+            is_error_frame if stream else is_error_result,
+            headers,
+            hold=services.AccountService.hold_slot,
+            unhold=services.AccountService.unhold_slot
         )
+        results = failover.stream()
+        if flight_key:
+            headers[SINGLEFLIGHT_HEADER] = "leader"
+            results = singleflight.start(flight_key, results)
+            reserved = False
+
+        if not stream:
+            return await _json_result(request, results, headers)
+
+        # 等到首个分块（或最终失败）再发送响应头，尝试次数才能放进 headers；全部失败时返回 HTTP 错误
+        try:
+            first = await until_disconnected(request, results.__anext__())
+        except StopAsyncIteration:
+            first = None
+        except ClientDisconnect:
+            await results.aclose()
+            return Response(status_code=499)
+        if first is None or is_error_frame(first):
+            await results.aclose()
+            frame = first or sse_utils.create_sse_data(UpstreamError("Upstream request cancelled", 0).to_openai())
+            return _error_frame_response(frame, headers)
+        return CancellableStreamingResponse(
+            _prepend(first, results),
+            media_type="text/event-stream",
+            headers=headers
+        )
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"处理聊天请求错误: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        if reserved:
+            singleflight.abandon(flight_key)
 
 @app.get("/v1/models")
-async def list_models(
-    authorization: Optional[str] = Header(None),
-    db: Session = Depends(get_db)
-):
-    await verify_api_key(authorization, db)
-    await verify_api_key(authorization, db)
+async def list_models(authorization: Optional[str] = Header(None)):
+    verify_api_key(authorization)
     return PuterBridge.get_models()
 
 # 健康检查
+# OpenAI 兼容文件接口（批处理输入/输出）
+@app.post("/v1/files")
+async def upload_file(
+    file: UploadFile = File(...),
+    purpose: str = Form("batch"),
+    authorization: Optional[str] = Header(None),
+    db: AsyncSession = Depends(get_async_db)
+):
+    verify_api_key(authorization)
+    stored = await services.FileService.create_from_upload(db, file, purpose)
+    return stored.to_dict()
+
+@app.get("/v1/files")
+async def list_files(purpose: Optional[str] = None, authorization: Optional[str] = Header(None), db: AsyncSession = Depends(get_async_db)):
+    verify_api_key(authorization)
+    files = await services.FileService.list_files(db, purpose)
+    return {"object": "list", "data": [f.to_dict() for f in files]}
+
+@app.get("/v1/files/{file_id}")
+async def get_file(file_id: str, authorization: Optional[str] = Header(None), db: AsyncSession = Depends(get_async_db)):
+    verify_api_key(authorization)
+    stored = await services.FileService.get_file(db, file_id)
+    if not stored:
+        raise HTTPException(status_code=404, detail="文件不存在")
+    return stored.to_dict()
+
+@app.get("/v1/files/{file_id}/content")
+async def get_file_content(file_id: str, authorization: Optional[str] = Header(None), db: AsyncSession = Depends(get_async_db)):
+    verify_api_key(authorization)
+    stored = await services.FileService.get_file(db, file_id)
+    if not stored or not os.path.isfile(stored.path):
+        raise HTTPException(status_code=404, detail="文件不存在")
+    return FileResponse(stored.path, media_type="application/jsonl")
+
+@app.delete("/v1/files/{file_id}")
+async def delete_file(file_id: str, authorization: Optional[str] = Header(None), db: AsyncSession = Depends(get_async_db)):
+    verify_api_key(authorization)
+    if not await services.FileService.delete_file(db, file_id):
+        raise HTTPException(status_code=404, detail="文件不存在")
+    return {"id": file_id, "object": "file", "deleted": True}
+
+# OpenAI 兼容批处理接口
+@app.post("/v1/batches")
+async def create_batch(batch_data: schemas.BatchCreate, authorization: Optional[str] = Header(None), db: AsyncSession = Depends(get_async_db)):
+    verify_api_key(authorization)
+    try:
+        batch = await services.BatchService.create_batch(db, batch_data)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    await batch_runner.start(batch.id)
+    return batch.to_dict()
+
+@app.get("/v1/batches")
+async def list_batches(limit: int = 20, authorization: Optional[str] = Header(None), db: AsyncSession = Depends(get_async_db)):
+    verify_api_key(authorization)
+    batches = await services.BatchService.list_batches(db, limit)
+    return {"object": "list", "data": [b.to_dict() for b in batches]}
+
+@app.get("/v1/batches/{batch_id}")
+async def get_batch(batch_id: str, authorization: Optional[str] = Header(None), db: AsyncSession = Depends(get_async_db)):
+    verify_api_key(authorization)
+    batch = await services.BatchService.get_batch(db, batch_id)
+    if not batch:
+        raise HTTPException(status_code=404, detail="批处理不存在")
+    return batch.to_dict()
+
+@app.post("/v1/batches/{batch_id}/cancel")
+async def cancel_batch(batch_id: str, authorization: Optional[str] = Header(None), db: AsyncSession = Depends(get_async_db)):
+    verify_api_key(authorization)
+    batch = await services.BatchService.cancel_batch(db, batch_id)
+    if not batch:
+        raise HTTPException(status_code=404, detail="批处理不存在")
+    batch_runner.cancel(batch_id)
+    return batch.to_dict()
+
+# Prometheus 指标
+@app.get("/metrics")
+async def prometheus_metrics():
+    # 多 worker 时合并其他 worker 最近一次心跳的指标，抓到任一 worker 都得到全局的值
+    return Response(metrics.registry.render(shared_state.peer_metrics()), media_type=metrics.CONTENT_TYPE)
+
 @app.get("/health")
 async def health():
-    return {"status": "healthy", "timestamp": __import__("datetime").datetime.now().isoformat()}
+    return {"status": "healthy", "timestamp": datetime.now().isoformat()}
 
 # 账号管理API
 @app.get("/api/accounts")
-def list_accounts(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    accounts = services.AccountService.list_accounts(db, skip=skip, limit=limit)
+async def list_accounts(skip: int = 0, limit: int = 100, db: AsyncSession = Depends(get_async_db)):
+    accounts = await services.AccountService.list_accounts(db, skip=skip, limit=limit)
     return {
         "success": True,
-        "accounts": [account.to_dict() for account in accounts],
+        "accounts": [services.AccountService.account_to_dict(account) for account in accounts],
         "total": len(accounts)
     }
 
 @app.get("/api/accounts/{account_id}")
-async def get_account(account_id: int, db: Session = Depends(get_db)):
-    account = services.AccountService.get_account(db, account_id)
+async def get_account(account_id: int, db: AsyncSession = Depends(get_async_db)):
+    account = await services.AccountService.get_account(db, account_id)
     if not account:
         raise HTTPException(status_code=404, detail="账号不存在")
-    return {"success": True, "account": account.to_dict()}
+    return {"success": True, "account": services.AccountService.account_to_dict(account)}
 
 @app.post("/api/accounts")
-async def create_account(account_data: schemas.AccountCreate, db: Session = Depends(get_db)):
+async def create_account(account_data: schemas.AccountCreate, db: AsyncSession = Depends(get_async_db)):
     try:
-        account = services.AccountService.create_account(db, account_data)
+        account = await services.AccountService.create_account(db, account_data)
         return {
             "success": True,
             "message": "账号创建成功",
@@ -231,12 +631,12 @@ async def create_account(account_data: schemas.AccountCreate, db: Session = Depe
         raise HTTPException(status_code=400, detail=str(e))
 
 @app.post("/api/account/create")
-async def create_account_compat(account_data: schemas.AccountCreate, db: Session = Depends(get_db)):
+async def create_account_compat(account_data: schemas.AccountCreate, db: AsyncSession = Depends(get_async_db)):
     """
     前端兼容性端点 - 重定向到/api/accounts
     """
     try:
-        account = services.AccountService.create_account(db, account_data)
+        account = await services.AccountService.create_account(db, account_data)
         return {
             "success": True,
             "message": "账号创建成功",
@@ -246,10 +646,10 @@ async def create_account_compat(account_data: schemas.AccountCreate, db: Session
         raise HTTPException(status_code=400, detail=str(e))
 
 @app.post("/api/account/{id}/bind")
-async def bind_account(id: int, request: Request, db: Session = Depends(get_db)):
+async def bind_account(id: int, request: Request, db: AsyncSession = Depends(get_async_db)):
     try:
         data = await request.json()
-        account = services.AccountService.bind_account(db, id, data)
+        account = await services.AccountService.bind_account(db, id, data)
         if not account:
             return JSONResponse({"success": False, "message": "账号不存在"})
         return JSONResponse({"success": True, "account_name": account.name})
@@ -261,12 +661,12 @@ async def bind_account(id: int, request: Request, db: Session = Depends(get_db))
 async def launch_browser_for_account_compat(
     account_id: int,
     background_tasks: BackgroundTasks = BackgroundTasks(),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     前端兼容性端点 - 启动浏览器进行账号登录
     """
-    account = services.AccountService.get_account(db, account_id)
+    account = await services.AccountService.get_account(db, account_id)
     if not account:
         raise HTTPException(status_code=404, detail="账号不存在")
     
@@ -283,11 +683,11 @@ async def launch_browser_for_account_compat(
     }
 
 @app.delete("/api/account/{account_id}")
-async def delete_account_compat(account_id: int, db: Session = Depends(get_db)):
+async def delete_account_compat(account_id: int, db: AsyncSession = Depends(get_async_db)):
     """
     前端兼容性端点 - 重定向到/api/accounts/{account_id}
     """
-    success = services.AccountService.delete_account(db, account_id)
+    success = await services.AccountService.delete_account(db, account_id)
     if not success:
         raise HTTPException(status_code=404, detail="账号不存在")
     return {"success": True, "message": "账号删除成功"}
@@ -296,9 +696,9 @@ async def delete_account_compat(account_id: int, db: Session = Depends(get_db)):
 async def update_account(
     account_id: int,
     update_data: schemas.AccountUpdate,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    account = services.AccountService.update_account(db, account_id, update_data)
+    account = await services.AccountService.update_account(db, account_id, update_data)
     if not account:
         raise HTTPException(status_code=404, detail="账号不存在")
     return {
@@ -308,8 +708,8 @@ async def update_account(
     }
 
 @app.delete("/api/accounts/{account_id}")
-async def delete_account(account_id: int, db: Session = Depends(get_db)):
-    success = services.AccountService.delete_account(db, account_id)
+async def delete_account(account_id: int, db: AsyncSession = Depends(get_async_db)):
+    success = await services.AccountService.delete_account(db, account_id)
     if not success:
         raise HTTPException(status_code=404, detail="账号不存在")
     return {"success": True, "message": "账号删除成功"}
@@ -318,13 +718,13 @@ async def delete_account(account_id: int, db: Session = Depends(get_db)):
 async def start_account_login(
     name: str = "新账号",
     background_tasks: BackgroundTasks = BackgroundTasks(),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     # 创建账号（如果不存在）
-    account = services.AccountService.get_account_by_name(db, name)
+    account = await services.AccountService.get_account_by_name(db, name)
     if not account:
         account_data = schemas.AccountCreate(name=name, display_name=name)
-        account = services.AccountService.create_account(db, account_data)
+        account = await services.AccountService.create_account(db, account_data)
     
     # 在后台启动浏览器登录流程
     background_tasks.add_task(
@@ -339,8 +739,8 @@ async def start_account_login(
     }
 
 @app.get("/api/accounts/{account_id}/data")
-async def get_account_data(account_id: int, db: Session = Depends(get_db)):
-    account = services.AccountService.get_account(db, account_id)
+async def get_account_data(account_id: int, db: AsyncSession = Depends(get_async_db)):
+    account = await services.AccountService.get_account(db, account_id)
     if not account:
         raise HTTPException(status_code=404, detail="账号不存在")
     
@@ -353,16 +753,16 @@ async def get_account_data(account_id: int, db: Session = Depends(get_db)):
 
 # 配置管理API
 @app.get("/api/configs")
-async def list_configs(db: Session = Depends(get_db)):
-    configs = services.ConfigService.list_configs(db)
+async def list_configs(db: AsyncSession = Depends(get_async_db)):
+    configs = await services.ConfigService.list_configs(db)
     return {
         "success": True,
         "configs": [config.to_dict() for config in configs]
     }
 
 @app.get("/api/configs/{key}")
-async def get_config(key: str, db: Session = Depends(get_db)):
-    value = services.ConfigService.get_config(db, key)
+async def get_config(key: str, db: AsyncSession = Depends(get_async_db)):
+    value = await services.ConfigService.get_config(db, key)
     if value is None:
         raise HTTPException(status_code=404, detail="配置不存在")
     return {"success": True, "key": key, "value": value}
@@ -370,9 +770,9 @@ async def get_config(key: str, db: Session = Depends(get_db)):
 @app.post("/api/configs")
 async def set_config(
     config_data: schemas.ConfigCreate,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    config = services.ConfigService.set_config(
+    config = await services.ConfigService.set_config(
         db,
         config_data.key,
         config_data.value,
@@ -386,15 +786,15 @@ async def set_config(
     }
 
 @app.delete("/api/configs/{key}")
-async def delete_config(key: str, db: Session = Depends(get_db)):
-    success = services.ConfigService.delete_config(db, key)
+async def delete_config(key: str, db: AsyncSession = Depends(get_async_db)):
+    success = await services.ConfigService.delete_config(db, key)
     if not success:
         raise HTTPException(status_code=404, detail="配置不存在")
     return {"success": True, "message": "配置删除成功"}
 
 # AI功能API
 @app.post("/api/ai/chat")
-async def ai_chat(chat_request: schemas.ChatRequest, db: Session = Depends(get_db)):
+async def ai_chat(chat_request: schemas.ChatRequest, db: AsyncSession = Depends(get_async_db)):
     result = await services.AIService.chat(
         db,
         chat_request.message,
@@ -404,7 +804,7 @@ async def ai_chat(chat_request: schemas.ChatRequest, db: Session = Depends(get_d
     return {"success": True, "result": result}
 
 @app.post("/api/ai/generate-image")
-async def generate_image(image_request: schemas.ImageGenerationRequest, db: Session = Depends(get_db)):
+async def generate_image(request: Request, image_request: schemas.ImageGenerationRequest, db: AsyncSession = Depends(get_async_db)):
     result = await services.AIService.generate_image(
         db,
         image_request.prompt,
@@ -413,15 +813,31 @@ async def generate_image(image_request: schemas.ImageGenerationRequest, db: Sess
         height=image_request.height,
         steps=image_request.steps,
         seed=image_request.seed,
-        disable_safety_checker=image_request.disable_safety_checker
+        disable_safety_checker=image_request.disable_safety_checker,
+        response_format=image_request.response_format
     )
-    return {"success": True, "result": result}
+    return {"success": True, "result": _absolute_image_urls(request, result)}
+
+# response_format=url 时图片链接为相对路径，按本次请求的地址补全
+def _absolute_image_urls(request: Request, result: Dict[str, Any]) -> Dict[str, Any]:
+    base_url = str(request.base_url).rstrip("/")
+    for item in result.get("data") or []:
+        if isinstance(item.get("url"), str) and item["url"].startswith("/"):
+            item["url"] = base_url + item["url"]
+    return result
+
+@app.api_route(IMAGE_ROUTE + "/{name}", methods=["GET", "HEAD"])
+async def get_image_file(name: str, request: Request):
+    path = image_store.resolve(name)
+    if path is None:
+        raise HTTPException(status_code=404, detail="图片不存在")
+    return ImageFileResponse(path, request.headers, method=request.method)
 
 # Cookie解析API
 @app.post("/api/cookie/parse")
 async def parse_cookie(
     request: schemas.CookieParseRequest,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     # 简单解析示例，实际应实现更复杂的解析逻辑
     try:
@@ -434,14 +850,14 @@ async def parse_cookie(
     
     # 创建账号
     account_name = request.account_name or "导入的账号"
-    account = services.AccountService.get_account_by_name(db, account_name)
+    account = await services.AccountService.get_account_by_name(db, account_name)
     if not account:
         account_data = schemas.AccountCreate(
             name=account_name,
             display_name=account_name,
             account_type="custom"
         )
-        account = services.AccountService.create_account(db, account_data)
+        account = await services.AccountService.create_account(db, account_data)
     
     # 保存cookie数据
     account_dir = Path(account.data_dir)
@@ -464,20 +880,20 @@ async def get_system_status():
         "success": True,
         "status": "running",
         "version": "1.0.0",
-        "uptime": "0 days",
+        "uptime": f"{int((time.time() - getattr(app.state, 'started_at', time.time())) // 86400)} days",
         "timestamp": datetime.now().isoformat()
     }
 
 # 前端兼容性API - 配置信息
 @app.get("/api/config")
-async def get_config_compat(db: Session = Depends(get_db)):
+async def get_config_compat():
     """
     获取配置信息 - 前端兼容性端点
     返回系统配置和设置
     """
     # 获取浏览器配置
-    browser_headless = services.ConfigService.get_config(db, "browser_headless")
-    browser_timeout = services.ConfigService.get_config(db, "browser_timeout")
+    browser_headless = services.ConfigService.get_cached("browser_headless")
+    browser_timeout = services.ConfigService.get_cached("browser_timeout")
     
     return {
         "success": True,
@@ -495,19 +911,19 @@ async def get_config_compat(db: Session = Depends(get_db)):
 
 # 前端兼容性API - 获取所有账号列表
 @app.get("/api/accounts")
-async def list_accounts_compat(db: Session = Depends(get_db)):
+async def list_accounts_compat(db: AsyncSession = Depends(get_async_db)):
     """
     获取所有账号列表 - 前端兼容性端点
     """
-    accounts = services.AccountService.list_accounts(db)
+    accounts = await services.AccountService.list_accounts(db)
     return {
         "success": True,
-        "accounts": [account.to_dict() for account in accounts]
+        "accounts": [services.AccountService.account_to_dict(account) for account in accounts]
     }
 
 # 前端兼容性API - 设置配置
 @app.post("/api/config/set")
-async def set_config_compat(config_data: dict, db: Session = Depends(get_db)):
+async def set_config_compat(config_data: dict, db: AsyncSession = Depends(get_async_db)):
     """
     设置配置信息 - 前端兼容性端点
     """
@@ -520,7 +936,7 @@ async def set_config_compat(config_data: dict, db: Session = Depends(get_db)):
         if not key or value is None:
             raise HTTPException(status_code=400, detail="Missing key or value")
         
-        services.ConfigService.set_config(db, key, str(value), value_type, description)
+        await services.ConfigService.set_config(db, key, str(value), value_type, description)
         
         return {
             "success": True,
@@ -561,10 +977,15 @@ async def restart_system():
 
 # 启动服务器
 if __name__ == "__main__":
+    import uvicorn
+    # 多 worker 时在主进程中先完成目录与表结构初始化，避免各 worker 同时建表
+    init_directories()
+    create_tables()
     uvicorn.run(
         "app:app",
         host=settings.host,
         port=settings.port,
         reload=False, # Windows 上使用 Playwright 时必须禁用 reload，否则会因多进程导致 NotImplementedError
-        workers=1
+        # 多个 worker 通过 shared_state 共享账号调度状态；Windows 上使用 Playwright 时保持 1
+        workers=settings.workers
     )
\ No newline at end of file
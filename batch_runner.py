@@ -0,0 +1,379 @@
+import asyncio
+import itertools
+import json
+import logging
+import os
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from sqlalchemy import select, update
+
+from admission import AdmissionRejected
+from config import settings
+from database import AsyncSessionLocal
+from models import Batch, BatchProgress, StoredFile
+from puter_bridge import PuterBridge, UpstreamError
+import metrics
+import services
+from shared_state import shared_state
+import sse_utils
+
+logger = logging.getLogger(__name__)
+
+# 进程重启后需要继续执行的状态
+RESUMABLE_STATUSES = ("validating", "in_progress", "finalizing", "cancelling")
+
+# 批处理请求在准入控制中使用低优先级通道，不挤占在线请求
+BATCH_LANE = "low"
+
+_READ_LINES = 256
+
+
+class _BatchJob:
+    """单个批处理任务的运行状态：待落盘的结果在检查点时与进度一起提交"""
+
+    def __init__(self, batch: Batch, input_path: Path):
+        self.batch_id = batch.id
+        self.endpoint = batch.endpoint
+        self.input_path = input_path
+        self.output_path = services.FileService.files_dir() / f"{batch.id}_output.jsonl"
+        self.error_path = services.FileService.files_dir() / f"{batch.id}_error.jsonl"
+        self.output_offset = batch.output_offset or 0
+        self.error_offset = batch.error_offset or 0
+        self.completed = batch.completed or 0
+        self.failed = batch.failed or 0
+        # (行号, 是否成功, 编码后的 JSONL 行)
+        self.pending: List[Tuple[int, bool, bytes]] = []
+        self.flush_lock = asyncio.Lock()
+        self.output_file = None
+        self.error_file = None
+
+
+class BatchRunner:
+    """
+    /v1/batches 的执行器：每个批处理一个后台任务，内部用有界的 worker 池并发调用 PuterBridge.chat_completion。
+    账号经准入控制分配（按账号池策略分散到所有可用账号）；
+    结果追加写入输出 JSONL，并定期把已完成的行号与文件偏移一起写入 SQLite，重启后从检查点继续。
+    """
+
+    def __init__(self):
+        self._tasks: Dict[str, asyncio.Task] = {}
+
+    async def start(self, batch_id: str) -> bool:
+        """启动批处理任务；已在执行或（多 worker 时）已由其他 worker 认领时返回 False"""
+        if batch_id in self._tasks:
+            return False
+        # 多 worker 时每个批处理只由认领到它的 worker 执行
+        claim_key = f"batch:{batch_id}"
+        if shared_state.active and not await shared_state.claim(claim_key):
+            return False
+        if batch_id in self._tasks:
+            # 等待认领期间已由本 worker 的另一处启动
+            return False
+        task = asyncio.get_running_loop().create_task(self._run(batch_id))
+        self._tasks[batch_id] = task
+
+        def on_done(_):
+            self._tasks.pop(batch_id, None)
+            if shared_state.active:
+                shared_state.release_claim(claim_key)
+
+        task.add_done_callback(on_done)
+        return True
+
+    def cancel(self, batch_id: str):
+        task = self._tasks.get(batch_id)
+        if task is not None:
+            task.cancel()
+
+    async def resume(self):
+        """启动时继续执行未完成的批处理"""
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(select(Batch.id).where(Batch.status.in_(RESUMABLE_STATUSES)))
+            batch_ids = result.scalars().all()
+        for batch_id in batch_ids:
+            if await self.start(batch_id):
+                logger.info(f"继续执行批处理: {batch_id}")
+
+    async def on_heartbeat(self, reaped: int):
+        """多 worker：继续失联 worker 未完成的批处理；其他 worker 收到的取消请求通过数据库状态传达"""
+        if reaped:
+            await self.resume()
+        if not self._tasks:
+            return
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(
+                select(Batch.id).where(Batch.id.in_(list(self._tasks)), Batch.status == "cancelling")
+            )
+            for batch_id in result.scalars().all():
+                self.cancel(batch_id)
+
+    async def stop(self):
+        """关闭时停止所有批处理；已完成的结果写入检查点，状态保持不变以便下次启动继续"""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def running(self) -> int:
+        return len(self._tasks)
+
+    # ---- 执行 ----
+
+    async def _run(self, batch_id: str):
+        job = None
+        try:
+            async with AsyncSessionLocal() as db:
+                batch = await db.get(Batch, batch_id)
+                if batch is None:
+                    return
+                if batch.status == "cancelling":
+                    await self._finish(db, batch, None, "cancelled")
+                    return
+                input_file = await db.get(StoredFile, batch.input_file_id)
+                if input_file is None or not Path(input_file.path).is_file():
+                    await self._fail(db, batch, "input_file_missing", f"输入文件不存在: {batch.input_file_id}")
+                    return
+                job = _BatchJob(batch, Path(input_file.path))
+
+                if batch.status == "validating":
+                    total = await asyncio.get_running_loop().run_in_executor(None, self._count_lines, job.input_path)
+                    if total == 0:
+                        await self._fail(db, batch, "empty_file", "输入文件没有请求")
+                        return
+                    batch.total = total
+                    batch.status = "in_progress"
+                    batch.in_progress_at = int(time.time())
+                    await db.commit()
+
+                done = set((await db.execute(
+                    select(BatchProgress.line_no).where(BatchProgress.batch_id == batch_id)
+                )).scalars().all())
+
+            await asyncio.get_running_loop().run_in_executor(None, self._open_outputs, job)
+            await self._process(job, done)
+
+            async with AsyncSessionLocal() as db:
+                batch = await db.get(Batch, batch_id)
+                await self._finish(db, batch, job, "cancelled" if batch.status == "cancelling" else "completed")
+        except asyncio.CancelledError:
+            if job is not None:
+                await self._checkpoint(job)
+                async with AsyncSessionLocal() as db:
+                    batch = await db.get(Batch, batch_id)
+                    if batch is not None and batch.status == "cancelling":
+                        await self._finish(db, batch, job, "cancelled")
+            raise
+        except Exception as e:
+            logger.error(f"批处理 {batch_id} 执行失败: {e}", exc_info=True)
+            async with AsyncSessionLocal() as db:
+                batch = await db.get(Batch, batch_id)
+                if batch is not None:
+                    await self._fail(db, batch, "internal_error", str(e))
+        finally:
+            if job is not None:
+                for file in (job.output_file, job.error_file):
+                    if file is not None:
+                        file.close()
+
+    @staticmethod
+    def _count_lines(path: Path) -> int:
+        with open(path, "rb") as file:
+            return sum(1 for line in file if line.strip())
+
+    @staticmethod
+    def _open_outputs(job: _BatchJob):
+        # 截断到上次检查点的偏移：检查点之后写入的结果没有记录进度，会重新执行
+        job.output_path.parent.mkdir(parents=True, exist_ok=True)
+        for attr, path, offset in (
+            ("output_file", job.output_path, job.output_offset),
+            ("error_file", job.error_path, job.error_offset),
+        ):
+            file = open(path, "ab")
+            file.truncate(offset)
+            file.seek(offset)
+            setattr(job, attr, file)
+
+    async def _process(self, job: _BatchJob, done: Set[int]):
+        queue: asyncio.Queue = asyncio.Queue(maxsize=settings.batch_concurrency * 2)
+        workers = [asyncio.create_task(self._worker(job, queue)) for _ in range(settings.batch_concurrency)]
+        checkpointer = asyncio.create_task(self._checkpoint_loop(job))
+        try:
+            await self._read_input(job, done, queue)
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers + [checkpointer]:
+                task.cancel()
+            await asyncio.gather(*workers, checkpointer, return_exceptions=True)
+        await self._checkpoint(job)
+
+    async def _read_input(self, job: _BatchJob, done: Set[int], queue: asyncio.Queue):
+        """分批读取输入文件，跳过已完成的行；队列有界，读取速度受 worker 限制"""
+        loop = asyncio.get_running_loop()
+        line_no = 0
+        with open(job.input_path, "rb") as file:
+            while True:
+                lines = await loop.run_in_executor(None, lambda: list(itertools.islice(file, _READ_LINES)))
+                if not lines:
+                    return
+                for line in lines:
+                    if line.strip() and line_no not in done:
+                        await queue.put((line_no, line))
+                    line_no += 1
+
+    async def _worker(self, job: _BatchJob, queue: asyncio.Queue):
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            line_no, line = item
+            ok, record = await self._execute(job, line)
+            job.pending.append((line_no, ok, sse_utils.dumps_bytes(record) + b"\n"))
+            if len(job.pending) >= settings.batch_checkpoint_every:
+                await self._checkpoint(job)
+
+    async def _execute(self, job: _BatchJob, line: bytes) -> Tuple[bool, Dict[str, Any]]:
+        record_id = f"batch_req_{uuid.uuid4().hex[:24]}"
+        custom_id = None
+        try:
+            request = json.loads(line)
+            custom_id = request.get("custom_id")
+            if request.get("url", job.endpoint) != job.endpoint or not isinstance(request.get("body"), dict):
+                raise ValueError(f"请求必须包含 body，且 url 为 {job.endpoint}")
+        except (ValueError, AttributeError) as e:
+            return False, self._error_record(record_id, custom_id, "invalid_request", str(e))
+
+        body = dict(request["body"], stream=False)
+        account = await self._acquire_account()
+        if account is None:
+            return False, self._error_record(record_id, custom_id, "no_account", "没有可用的 Puter 账号")
+
+        outcome = []
+        try:
+            result = await PuterBridge.chat_completion(body, account.token, on_status=outcome.append)
+        except UpstreamError as e:
+            return False, {
+                "id": record_id,
+                "custom_id": custom_id,
+                "response": {"status_code": e.http_status, "request_id": None, "body": e.to_openai()},
+                "error": None,
+            }
+        finally:
+            services.AccountService.release_account(account.account_id, outcome[-1] if outcome else None)
+        return True, {
+            "id": record_id,
+            "custom_id": custom_id,
+            "response": {"status_code": 200, "request_id": result["id"], "body": result},
+            "error": None,
+        }
+
+    @staticmethod
+    async def _acquire_account():
+        # 排队满或超时时等待后重试；账号池为空时重试几次后放弃该行
+        for attempt in range(settings.batch_account_retries):
+            try:
+                account = await services.AccountService.acquire_account(BATCH_LANE)
+            except AdmissionRejected as e:
+                await asyncio.sleep(e.retry_after)
+                continue
+            if account is not None:
+                return account
+            await asyncio.sleep(min(2 ** attempt, 30))
+        return None
+
+    @staticmethod
+    def _error_record(record_id: str, custom_id: Optional[str], code: str, message: str) -> Dict[str, Any]:
+        return {"id": record_id, "custom_id": custom_id, "response": None, "error": {"code": code, "message": message}}
+
+    # ---- 检查点 ----
+
+    async def _checkpoint_loop(self, job: _BatchJob):
+        while True:
+            await asyncio.sleep(settings.batch_checkpoint_interval)
+            await self._checkpoint(job)
+
+    async def _checkpoint(self, job: _BatchJob):
+        """结果先写入并 fsync 到输出文件，再把行号和文件偏移在同一事务中写入数据库"""
+        async with job.flush_lock:
+            if not job.pending:
+                return
+            pending, job.pending = job.pending, []
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self._write_results, job, pending)
+
+            completed = sum(1 for _, ok, _ in pending if ok)
+            job.completed += completed
+            job.failed += len(pending) - completed
+            async with AsyncSessionLocal() as db:
+                await db.execute(
+                    BatchProgress.__table__.insert(),
+                    [{"batch_id": job.batch_id, "line_no": line_no} for line_no, _, _ in pending]
+                )
+                await db.execute(
+                    update(Batch)
+                    .where(Batch.id == job.batch_id)
+                    .values(
+                        completed=job.completed,
+                        failed=job.failed,
+                        output_offset=job.output_offset,
+                        error_offset=job.error_offset,
+                    )
+                    .execution_options(synchronize_session=False)
+                )
+                await db.commit()
+
+    @staticmethod
+    def _write_results(job: _BatchJob, pending: List[Tuple[int, bool, bytes]]):
+        job.output_file.write(b"".join(data for _, ok, data in pending if ok))
+        job.error_file.write(b"".join(data for _, ok, data in pending if not ok))
+        for file in (job.output_file, job.error_file):
+            file.flush()
+            os.fsync(file.fileno())
+        job.output_offset = job.output_file.tell()
+        job.error_offset = job.error_file.tell()
+
+    # ---- 结束 ----
+
+    async def _finish(self, db, batch: Batch, job: Optional[_BatchJob], status: str):
+        now = int(time.time())
+        if job is not None:
+            batch.finalizing_at = now
+            if job.output_offset:
+                batch.output_file_id = self._register_output(db, job.output_path, job.output_offset)
+            if job.error_offset:
+                batch.error_file_id = self._register_output(db, job.error_path, job.error_offset)
+        batch.status = status
+        if status == "cancelled":
+            batch.cancelled_at = now
+        else:
+            batch.completed_at = now
+        await db.commit()
+        logger.info(f"批处理 {batch.id} 结束: {status} (完成 {batch.completed}, 失败 {batch.failed})")
+
+    @staticmethod
+    def _register_output(db, path: Path, size: int) -> str:
+        file_id = services.FileService.new_id()
+        db.add(StoredFile(id=file_id, filename=path.name, purpose="batch_output", path=str(path), bytes=size))
+        return file_id
+
+    @staticmethod
+    async def _fail(db, batch: Batch, code: str, message: str):
+        batch.status = "failed"
+        batch.failed_at = int(time.time())
+        batch.errors = {"object": "list", "data": [{"code": code, "message": message}]}
+        await db.commit()
+        logger.error(f"批处理 {batch.id} 失败: {message}")
+
+
+# 全局批处理执行器
+batch_runner = BatchRunner()
+shared_state.add_tick_listener(batch_runner.on_heartbeat)
+
+metrics.registry.register(metrics.CallbackMetric(
+    "puter_batches_running", "Batches currently executing", (),
+    lambda: {(): batch_runner.running()},
+))
@@ -0,0 +1,311 @@
+"""
+网关压测：以固定并发驱动 /v1/chat/completions，输出 RPS、首字延迟 p50/p99 和每个流的网关 CPU 时间。
+
+默认在临时目录里启动两个子进程：providers.py 模拟的 Puter 上游，以及指向它的网关
+（独立数据库，预先写入 --accounts 个账号）。CPU 时间取自网关进程，不包含压测客户端和模拟上游。
+--target 可改为压测已在运行的网关（此时只有传入 --gateway-pid 才统计 CPU）。
+
+用录制的真实流量代替模拟上游：--env UPSTREAM_REPLAY_DIR=<trace 目录>（见 upstream_trace.py）。
+--workers N 以 N 个 uvicorn worker 启动网关（共享状态见 shared_state.py），CPU 时间为所有 worker 之和。
+
+结果以 JSON 输出（--output 同时写入文件），附带 git 版本，便于不同版本之间对比。
+
+用法（在项目根目录）:
+    python benchmarks/bench_load.py [--concurrency 32] [--requests 500] [--rate 50] [--tokens 100] [--latency-ms 300]
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import List, Optional
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import httpx  # noqa: E402
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(q / 100 * len(values) + 0.5) - 1))
+    return round(values[index], 2)
+
+
+def git_version() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def process_cpu_seconds(pid: int) -> Optional[float]:
+    try:
+        import psutil
+    except ImportError:
+        return None
+    try:
+        process = psutil.Process(pid)
+        # 多 worker 时 uvicorn 的 worker 是子进程
+        processes = [process] + process.children(recursive=True)
+        total = 0.0
+        for item in processes:
+            times = item.cpu_times()
+            total += times.user + times.system
+    except psutil.Error:
+        return None
+    return total
+
+
+def serve_gateway(port: int, accounts: int, workers: int = 1):
+    """子进程入口：在 DATABASE_URL 指向的库中写入测试账号后启动网关"""
+    os.chdir(ROOT)
+    from database import SessionLocal, create_tables
+    from models import Account
+
+    create_tables()
+    with SessionLocal() as db:
+        for i in range(accounts):
+            db.add(Account(name=f"bench-{i}", status="active", auth_token=f"bench-token-{i}"))
+        db.commit()
+
+    import uvicorn
+    if workers > 1:
+        # 多 worker 需要以导入字符串启动，各 worker 进程自行导入 app
+        uvicorn.run("app:app", host="127.0.0.1", port=port, workers=workers, log_level="warning", access_log=False)
+        return
+    import app as gateway
+    uvicorn.run(gateway.app, host="127.0.0.1", port=port, log_level="warning", access_log=False)
+
+
+async def wait_ready(url: str, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while True:
+            try:
+                await client.get(url, timeout=1.0)
+                return
+            except httpx.TransportError:
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f"{url} 未能在 {timeout:g}s 内启动")
+                await asyncio.sleep(0.1)
+
+
+def request_body(args, index: int) -> dict:
+    # 默认每个请求内容不同，避免被 singleflight / 回答缓存合并；--identical 用于测量合并效果
+    content = "benchmark" if args.identical else f"benchmark {index}"
+    return {"model": args.model, "messages": [{"role": "user", "content": content}], "stream": not args.no_stream}
+
+
+async def one_request(client: httpx.AsyncClient, body: dict, stream: bool) -> dict:
+    start = time.perf_counter()
+    first = None
+    size = 0
+    if stream:
+        async with client.stream("POST", "/v1/chat/completions", json=body) as response:
+            status = response.status_code
+            async for data in response.aiter_raw():
+                if first is None:
+                    first = time.perf_counter()
+                size += len(data)
+    else:
+        response = await client.post("/v1/chat/completions", json=body)
+        status = response.status_code
+        first = time.perf_counter()
+        size = len(response.content)
+    end = time.perf_counter()
+    return {
+        "ok": status == 200,
+        "status": status,
+        "ttft_ms": (first - start) * 1000 if first is not None else None,
+        "latency_ms": (end - start) * 1000,
+        "bytes": size,
+    }
+
+
+async def drive(args, base_url: str, gateway_pid: Optional[int], upstream_pid: Optional[int] = None) -> dict:
+    headers = {"Authorization": f"Bearer {args.api_key}"}
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=base_url, headers=headers, limits=limits, timeout=120) as client:
+        # 预热：建立连接，避免首轮包含导入和连接建立开销
+        await asyncio.gather(*(
+            one_request(client, request_body(args, -i - 1), not args.no_stream) for i in range(min(args.concurrency, 8))
+        ))
+
+        pending = iter(range(args.requests))
+        results: List[dict] = []
+
+        async def worker():
+            for index in pending:
+                try:
+                    results.append(await one_request(client, request_body(args, index), not args.no_stream))
+                except httpx.HTTPError as e:
+                    results.append({"ok": False, "status": type(e).__name__, "ttft_ms": None, "latency_ms": None, "bytes": 0})
+
+        cpu_start = process_cpu_seconds(gateway_pid) if gateway_pid else None
+        upstream_cpu_start = process_cpu_seconds(upstream_pid) if upstream_pid else None
+        wall_start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        wall = time.perf_counter() - wall_start
+        cpu_end = process_cpu_seconds(gateway_pid) if gateway_pid else None
+        upstream_cpu_end = process_cpu_seconds(upstream_pid) if upstream_pid else None
+
+    ok = [r for r in results if r["ok"]]
+    errors = {}
+    for r in results:
+        if not r["ok"]:
+            errors[str(r["status"])] = errors.get(str(r["status"]), 0) + 1
+    ttfts = [r["ttft_ms"] for r in ok if r["ttft_ms"] is not None]
+    latencies = [r["latency_ms"] for r in ok]
+    cpu = cpu_end - cpu_start if cpu_start is not None and cpu_end is not None else None
+    upstream_cpu = (
+        upstream_cpu_end - upstream_cpu_start
+        if upstream_cpu_start is not None and upstream_cpu_end is not None else None
+    )
+    return {
+        "requests": len(results),
+        "ok": len(ok),
+        "errors": errors,
+        "wall_s": round(wall, 3),
+        "rps": round(len(ok) / wall, 2) if wall else None,
+        "ttft_p50_ms": percentile(ttfts, 50),
+        "ttft_p99_ms": percentile(ttfts, 99),
+        "latency_p50_ms": percentile(latencies, 50),
+        "latency_p99_ms": percentile(latencies, 99),
+        "bytes_per_request": round(sum(r["bytes"] for r in ok) / len(ok)) if ok else 0,
+        "gateway_cpu_s": round(cpu, 3) if cpu is not None else None,
+        "cpu_ms_per_stream": round(cpu / len(ok) * 1000, 3) if cpu is not None and ok else None,
+        # 模拟上游接近占满一个核时，延迟数据反映的是压测环境而不是网关
+        "upstream_cpu_s": round(upstream_cpu, 3) if upstream_cpu is not None else None,
+    }
+
+
+def spawn(args_list: List[str], env: dict) -> subprocess.Popen:
+    return subprocess.Popen(
+        [sys.executable] + args_list, cwd=ROOT, env=env,
+        stdout=subprocess.DEVNULL, stderr=None if os.environ.get("BENCH_VERBOSE") else subprocess.DEVNULL,
+    )
+
+
+async def main_async(args) -> dict:
+    if args.target:
+        return await drive(args, args.target.rstrip("/"), args.gateway_pid)
+
+    processes = []
+    with tempfile.TemporaryDirectory(prefix="puter-bench-") as workdir:
+        upstream_port = args.upstream_port or free_port()
+        gateway_port = args.port or free_port()
+        env = dict(os.environ)
+        upstream = spawn([
+            "providers.py", "--port", str(upstream_port), "--rate", str(args.rate),
+            "--latency-ms", str(args.latency_ms), "--jitter-ms", str(args.jitter_ms), "--tokens", str(args.tokens),
+        ], env)
+        processes.append(upstream)
+
+        data_dir = Path(workdir) / "data"
+        env.update({
+            "PUTER_API_BASE": f"http://127.0.0.1:{upstream_port}",
+            "DATABASE_URL": f"sqlite+aiosqlite:///{workdir}/bench.db",
+            "DATA_DIR": str(data_dir),
+            "ACCOUNTS_DIR": str(data_dir / "accounts"),
+            "LOGS_DIR": str(data_dir / "logs"),
+            "CACHE_DIR": str(data_dir / "cache"),
+            "LOG_LEVEL": args.log_level,
+            "WORKERS": str(args.workers),
+            "SHARED_STATE_PATH": str(data_dir / "shared_state.db"),
+        })
+        for item in args.env:
+            key, _, value = item.partition("=")
+            env[key] = value
+        gateway = spawn([
+            str(Path(__file__).resolve()), "--serve-gateway", "--port", str(gateway_port), "--accounts", str(args.accounts),
+            "--workers", str(args.workers),
+        ], env)
+        processes.append(gateway)
+        try:
+            await wait_ready(f"http://127.0.0.1:{upstream_port}/")
+            await wait_ready(f"http://127.0.0.1:{gateway_port}/health")
+            return await drive(args, f"http://127.0.0.1:{gateway_port}", gateway.pid, upstream.pid)
+        finally:
+            for process in processes:
+                process.terminate()
+            for process in processes:
+                try:
+                    process.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=32, help="并发连接数")
+    parser.add_argument("--requests", type=int, default=500, help="总请求数（不含预热）")
+    parser.add_argument("--model", default="gpt-4o-mini")
+    parser.add_argument("--no-stream", action="store_true", help="压测非流式请求")
+    parser.add_argument("--identical", action="store_true", help="所有请求内容相同（测量 singleflight 合并）")
+    parser.add_argument("--api-key", default="1")
+    parser.add_argument("--target", help="已在运行的网关地址；不指定时自动启动网关和模拟上游")
+    parser.add_argument("--gateway-pid", type=int, help="配合 --target 统计该进程的 CPU 时间")
+    # 自动启动时的参数
+    parser.add_argument("--accounts", type=int, default=16, help="写入测试库的账号数")
+    parser.add_argument("--workers", type=int, default=1, help="网关 uvicorn worker 数")
+    parser.add_argument("--rate", type=float, default=50.0, help="模拟上游每秒 token 数")
+    parser.add_argument("--latency-ms", type=float, default=300.0, help="模拟上游首字延迟")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="模拟上游首字延迟长尾")
+    parser.add_argument("--tokens", type=int, default=100, help="模拟上游每个回答的 token 数")
+    parser.add_argument("--log-level", default="WARNING", help="网关日志级别")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="传给网关的额外配置，可重复")
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--upstream-port", type=int, default=0)
+    parser.add_argument("--output", help="同时把 JSON 结果写入该文件")
+    parser.add_argument("--serve-gateway", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve_gateway:
+        serve_gateway(args.port, args.accounts, args.workers)
+        return
+
+    result = asyncio.run(main_async(args))
+    report = {
+        "benchmark": "load",
+        "version": git_version(),
+        "python": platform.python_version(),
+        "config": {
+            "concurrency": args.concurrency,
+            "stream": not args.no_stream,
+            "identical": args.identical,
+            "model": args.model,
+            "target": args.target,
+            "accounts": None if args.target else args.accounts,
+            "workers": None if args.target else args.workers,
+            "upstream": None if args.target else {
+                "rate": args.rate, "latency_ms": args.latency_ms, "jitter_ms": args.jitter_ms, "tokens": args.tokens,
+            },
+            "env": args.env,
+        },
+        "result": result,
+    }
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    print(output)
+    if args.output:
+        Path(args.output).write_text(output + "\n", encoding="utf-8")
+
+
+if __name__ == "__main__":
+    main()
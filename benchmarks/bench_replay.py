@@ -0,0 +1,126 @@
+"""
+回放基准：用录制的上游 trace（UPSTREAM_RECORD_DIR 录制）驱动 PuterBridge 的解析与 SSE 编码路径，
+测量每个流的 CPU 时间、帧数，以及按原速回放时的首字延迟，用真实流量的分块分布评估解析 / 编码改动。
+
+--speed 0（默认）不等待，尽快输出，适合比较 CPU；--speed 1 按录制时序回放。
+
+用法（在项目根目录）:
+    python benchmarks/bench_replay.py TRACE_DIR [--speed 0] [--concurrency 16] [--repeat 5] [--coalesce-ms 0] [--json]
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+from collections import defaultdict
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import httpx  # noqa: E402
+
+from coalesce import CoalesceOptions  # noqa: E402
+from http_client import UpstreamClientPool  # noqa: E402
+from puter_bridge import PuterBridge  # noqa: E402
+from upstream_trace import ReplayTransport, load_traces  # noqa: E402
+
+
+async def replay_one(model: str, coalesce) -> dict:
+    request = {"model": model, "messages": [{"role": "user", "content": "replay"}], "stream": True}
+    start = time.perf_counter()
+    first = None
+    frames = 0
+    size = 0
+    async for chunk in PuterBridge.chat_completion_stream(request, "replay-token", coalesce=coalesce):
+        if first is None:
+            first = time.perf_counter()
+        frames += 1
+        size += len(chunk)
+    return {"model": model, "frames": frames, "bytes": size, "ttft_ms": (first - start) * 1000 if first else None}
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(q / 100 * len(values)))], 2)
+
+
+async def main_async(args) -> dict:
+    # 客户端中途断开时录下的不完整 trace 不参与比较
+    traces = [
+        t for t in load_traces(args.traces)
+        if t.request.get("interface") == "puter-chat-completion" and t.complete and t.status == 200
+    ]
+    if not traces:
+        raise SystemExit(f"{args.traces} 中没有聊天 trace")
+    UpstreamClientPool._client = httpx.AsyncClient(transport=ReplayTransport(traces, args.speed))
+    coalesce = CoalesceOptions(args.coalesce_ms / 1000, args.max_bytes) if args.coalesce_ms > 0 else None
+
+    # 每个 trace 回放 repeat 次；请求按 trace 的模型发出，由 ReplayTransport 匹配
+    models = [t.request.get("model") or PuterBridge.DEFAULT_CHAT_MODEL for t in traces] * args.repeat
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def bounded(model):
+        async with semaphore:
+            return await replay_one(model, coalesce)
+
+    try:
+        await replay_one(models[0], coalesce)
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        results = await asyncio.gather(*(bounded(model) for model in models))
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+    finally:
+        await UpstreamClientPool.close()
+
+    upstream_chunks = sum(len(t.chunks) for t in traces) * args.repeat
+    by_model = defaultdict(list)
+    for result in results:
+        by_model[result["model"]].append(result)
+    return {
+        "benchmark": "replay",
+        "traces": len(traces),
+        "streams": len(results),
+        "speed": args.speed,
+        "coalesce_ms": args.coalesce_ms,
+        "wall_s": round(wall, 3),
+        "streams_per_sec": round(len(results) / wall, 2),
+        "cpu_ms_per_stream": round(cpu / len(results) * 1000, 3),
+        "cpu_us_per_upstream_chunk": round(cpu / upstream_chunks * 1e6, 2) if upstream_chunks else None,
+        "frames_per_stream": round(sum(r["frames"] for r in results) / len(results), 1),
+        "ttft_p50_ms": percentile([r["ttft_ms"] for r in results if r["ttft_ms"] is not None], 50),
+        "ttft_p99_ms": percentile([r["ttft_ms"] for r in results if r["ttft_ms"] is not None], 99),
+        "models": {
+            model: {"streams": len(items), "frames_per_stream": round(sum(r["frames"] for r in items) / len(items), 1)}
+            for model, items in by_model.items()
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("traces", help="trace 目录")
+    parser.add_argument("--speed", type=float, default=0.0, help="回放倍速，0 表示不等待")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--repeat", type=int, default=5, help="每个 trace 的回放次数")
+    parser.add_argument("--coalesce-ms", type=float, default=0.0, help="开启增量合并的时间窗口（毫秒）")
+    parser.add_argument("--max-bytes", type=int, default=1024)
+    parser.add_argument("--json", action="store_true", help="以 JSON 输出结果")
+    args = parser.parse_args()
+
+    result = asyncio.run(main_async(args))
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False))
+        return
+    print(
+        f"traces {result['traces']}, streams {result['streams']}, speed {args.speed:g}x: "
+        f"{result['streams_per_sec']} streams/s, cpu/stream {result['cpu_ms_per_stream']} ms, "
+        f"cpu/upstream chunk {result['cpu_us_per_upstream_chunk']} us, frames/stream {result['frames_per_stream']}, "
+        f"ttft p50 {result['ttft_p50_ms']} ms p99 {result['ttft_p99_ms']} ms"
+    )
+
+
+if __name__ == "__main__":
+    main()
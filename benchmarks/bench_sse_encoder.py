@@ -0,0 +1,80 @@
+"""
+SSE 分块编码微基准：对比旧的逐块 dict + json.dumps + f-string 与 sse_utils.ChunkEncoder。
+
+用法（在项目根目录）:
+    python benchmarks/bench_sse_encoder.py [--chunks 200000] [--json]
+"""
+import argparse
+import json
+import sys
+import time
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import sse_utils  # noqa: E402
+
+MODEL = "claude-3-5-sonnet"
+# 典型的上游文本片段：短英文、中文、带引号和换行
+FRAGMENTS = ["Hello", " world", "，你好", ' "quoted"', "\n", " token", "s", " and more text"]
+
+
+def legacy_chunk(text: str) -> bytes:
+    """修改前 PuterBridge.chat_completion_stream 的逐块编码方式"""
+    chunk = {
+        "id": f"chatcmpl-{int(time.time())}",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": MODEL,
+        "choices": [{
+            "index": 0,
+            "delta": {"content": text},
+            "finish_reason": None
+        }]
+    }
+    # StreamingResponse 最终还要把 str 编码成 bytes
+    return f"data: {json.dumps(chunk)}\n\n".encode("utf-8")
+
+
+def run(label: str, fn, chunks: int) -> dict:
+    fragments = FRAGMENTS
+    count = len(fragments)
+
+    def loop():
+        for i in range(chunks):
+            fn(fragments[i % count])
+
+    best = min(timeit.repeat(loop, number=1, repeat=5))
+    ns_per_chunk = best / chunks * 1e9
+    print(f"{label:<28} {ns_per_chunk:8.1f} ns/chunk")
+    return {"name": label, "ns_per_chunk": round(ns_per_chunk, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunks", type=int, default=200000)
+    parser.add_argument("--json", action="store_true", help="以 JSON 输出结果")
+    args = parser.parse_args()
+
+    encoder = sse_utils.ChunkEncoder(MODEL)
+    print(f"JSON backend: {sse_utils.JSON_BACKEND}, chunks: {args.chunks}")
+    results = [
+        run("legacy dict+json.dumps", legacy_chunk, args.chunks),
+        run("ChunkEncoder.content", encoder.content, args.chunks),
+    ]
+    speedup = results[0]["ns_per_chunk"] / results[1]["ns_per_chunk"]
+    print(f"speedup: {speedup:.2f}x")
+
+    if args.json:
+        print(json.dumps({
+            "benchmark": "sse_encoder",
+            "backend": sse_utils.JSON_BACKEND,
+            "chunks": args.chunks,
+            "results": results,
+            "speedup": round(speedup, 2),
+        }))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+"""
+流式增量合并基准：同一个高频上游（大量很短的文本片段），对比关闭 / 开启合并时
+每个请求发出的 SSE 帧数、帧速率、单请求 CPU 时间和首字延迟。
+
+上游用 httpx.MockTransport 在进程内模拟，PuterBridge 走真实的 NDJSON 解析和 SSE 编码路径。
+--transport http（默认）通过本机 uvicorn + StreamingResponse 发送到真实 socket，CPU 时间包含
+服务端逐帧发送和同进程客户端的读取；--transport direct 只迭代生成器本身。
+
+用法（在项目根目录）:
+    python benchmarks/bench_stream_coalesce.py [--requests 50] [--tokens 2000] [--rate 2000] [--transport http] [--json]
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import httpx  # noqa: E402
+import uvicorn  # noqa: E402
+from fastapi import FastAPI  # noqa: E402
+from fastapi.responses import StreamingResponse  # noqa: E402
+
+from coalesce import CoalesceOptions  # noqa: E402
+from http_client import UpstreamClientPool  # noqa: E402
+from puter_bridge import PuterBridge  # noqa: E402
+
+REQUEST = {"model": "claude-3-5-sonnet", "messages": [{"role": "user", "content": "hi"}], "stream": True}
+FRAGMENTS = ["Hel", "lo", " wor", "ld", "，", "你", "好", " to", "ken", "s"]
+
+
+def install_upstream(tokens: int, rate: float, burst: int):
+    """每 burst/rate 秒一次性写出 burst 行 NDJSON，模拟上游高频小片段"""
+    lines = [
+        (json.dumps({"type": "text", "text": FRAGMENTS[i % len(FRAGMENTS)]}) + "\n").encode()
+        for i in range(tokens)
+    ]
+    interval = burst / rate
+
+    async def handler(request):
+        async def body():
+            for start in range(0, tokens, burst):
+                await asyncio.sleep(interval)
+                yield b"".join(lines[start:start + burst])
+        return httpx.Response(200, content=body())
+
+    UpstreamClientPool._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+
+def build_app() -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/stream")
+    async def stream(delay_ms: float = 0, max_bytes: int = 1024):
+        coalesce = CoalesceOptions(delay_ms / 1000, max_bytes) if delay_ms > 0 else None
+        return StreamingResponse(
+            PuterBridge.chat_completion_stream(REQUEST, "token", coalesce=coalesce),
+            media_type="text/event-stream",
+        )
+
+    return app
+
+
+async def direct_request(coalesce):
+    start = time.perf_counter()
+    first = None
+    frames = 0
+    size = 0
+    async for chunk in PuterBridge.chat_completion_stream(REQUEST, "token", coalesce=coalesce):
+        if first is None:
+            first = time.perf_counter()
+        frames += 1
+        size += len(chunk)
+    return frames, size, (first - start) * 1000, time.perf_counter() - start
+
+
+async def http_request(client: httpx.AsyncClient, coalesce):
+    params = {"delay_ms": coalesce.max_delay * 1000, "max_bytes": coalesce.max_bytes} if coalesce else {}
+    start = time.perf_counter()
+    first = None
+    frames = 0
+    size = 0
+    async with client.stream("GET", "/stream", params=params) as response:
+        async for data in response.aiter_raw():
+            if first is None:
+                first = time.perf_counter()
+            # TCP 读取边界与帧边界无关，按帧分隔符计数
+            frames += data.count(b"\n\n")
+            size += len(data)
+    return frames, size, (first - start) * 1000, time.perf_counter() - start
+
+
+async def run(label: str, one_request, coalesce, requests: int) -> dict:
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    results = await asyncio.gather(*(one_request(coalesce) for _ in range(requests)))
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+
+    frames = sum(r[0] for r in results)
+    ttfts = sorted(r[2] for r in results)
+    result = {
+        "name": label,
+        "frames_per_request": round(frames / requests, 1),
+        "frames_per_sec": round(frames / wall, 1),
+        "bytes_per_request": round(sum(r[1] for r in results) / requests),
+        "cpu_ms_per_request": round(cpu / requests * 1000, 2),
+        "ttft_p50_ms": round(ttfts[len(ttfts) // 2], 2),
+        "wall_s": round(wall, 3),
+    }
+    print(
+        f"{label:<22} frames/req {result['frames_per_request']:8.1f}  frames/s {result['frames_per_sec']:10.1f}  "
+        f"cpu/req {result['cpu_ms_per_request']:7.2f} ms  ttft p50 {result['ttft_p50_ms']:6.2f} ms"
+    )
+    return result
+
+
+async def main_async(args):
+    install_upstream(args.tokens, args.rate, args.burst)
+    cases = [("off", None)] + [
+        (f"{delay:g}ms,{args.max_bytes}B", CoalesceOptions(delay / 1000, args.max_bytes))
+        for delay in args.delays
+    ]
+    server = client = None
+    if args.transport == "http":
+        server = uvicorn.Server(uvicorn.Config(build_app(), host="127.0.0.1", port=args.port, log_level="warning"))
+        serve_task = asyncio.create_task(server.serve())
+        while not server.started:
+            await asyncio.sleep(0.01)
+        client = httpx.AsyncClient(
+            base_url=f"http://127.0.0.1:{args.port}",
+            limits=httpx.Limits(max_connections=args.requests),
+            timeout=60,
+        )
+
+        async def one_request(coalesce):
+            return await http_request(client, coalesce)
+    else:
+        one_request = direct_request
+
+    try:
+        # 预热一次，避免首轮包含导入和连接建立开销
+        await one_request(None)
+        return [await run(label, one_request, options, args.requests) for label, options in cases]
+    finally:
+        if client is not None:
+            await client.aclose()
+        if server is not None:
+            server.should_exit = True
+            await serve_task
+        await UpstreamClientPool.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=50, help="并发请求数")
+    parser.add_argument("--tokens", type=int, default=2000, help="每个请求的上游片段数")
+    parser.add_argument("--rate", type=float, default=2000, help="每个请求每秒的上游片段数")
+    parser.add_argument("--burst", type=int, default=4, help="每次网络读取到的片段数")
+    parser.add_argument("--delays", type=float, nargs="+", default=[5, 20, 50], help="合并时间窗口（毫秒）")
+    parser.add_argument("--max-bytes", type=int, default=1024)
+    parser.add_argument("--transport", choices=["http", "direct"], default="http")
+    parser.add_argument("--port", type=int, default=18765)
+    parser.add_argument("--json", action="store_true", help="以 JSON 输出结果")
+    args = parser.parse_args()
+
+    print(
+        f"transport: {args.transport}, requests: {args.requests}, tokens/request: {args.tokens}, "
+        f"rate: {args.rate:g}/s, burst: {args.burst}"
+    )
+    results = asyncio.run(main_async(args))
+    baseline = results[0]
+    for result in results[1:]:
+        print(
+            f"{result['name']}: {baseline['frames_per_request'] / result['frames_per_request']:.1f}x fewer frames, "
+            f"{baseline['cpu_ms_per_request'] / result['cpu_ms_per_request']:.2f}x less CPU per request"
+        )
+
+    if args.json:
+        print(json.dumps({
+            "benchmark": "stream_coalesce",
+            "transport": args.transport,
+            "requests": args.requests,
+            "tokens": args.tokens,
+            "rate": args.rate,
+            "burst": args.burst,
+            "results": results,
+        }))
+
+
+if __name__ == "__main__":
+    main()
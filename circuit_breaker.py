@@ -0,0 +1,120 @@
+import time
+from typing import Any, Dict, Optional
+
+from config import settings
+
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half_open"
+
+# 熔断状态对应写入 Account.status 的值
+ACCOUNT_STATUS_BY_STATE = {
+    STATE_CLOSED: "active",
+    STATE_OPEN: "quarantined",
+    STATE_HALF_OPEN: "probing",
+}
+STATE_BY_ACCOUNT_STATUS = {v: k for k, v in ACCOUNT_STATUS_BY_STATE.items()}
+
+# 认证失效 / 限流：立即熔断
+TRIP_IMMEDIATELY = {401, 403, 429}
+
+
+def is_failure_status(status_code: int) -> bool:
+    """0 表示连接失败等没有拿到 HTTP 状态码的情况"""
+    return status_code == 0 or status_code in TRIP_IMMEDIATELY or status_code >= 500
+
+
+class CircuitBreaker:
+    """单个账号的熔断器：closed -> open（指数退避冷却）-> half_open（探测）-> closed"""
+
+    def __init__(self, state: str = STATE_CLOSED):
+        self.state = state
+        self.consecutive_failures = 0
+        self.trips = 1 if state != STATE_CLOSED else 0
+        self.open_until = time.monotonic() + self._cooldown() if state == STATE_OPEN else 0.0
+        self.probes_in_flight = 0
+        self.last_status: Optional[int] = None
+
+    def _cooldown(self) -> float:
+        exponent = max(self.trips - 1, 0)
+        return min(settings.breaker_base_cooldown * (2 ** exponent), settings.breaker_max_cooldown)
+
+    def allow(self, now: float) -> bool:
+        """是否允许向该账号发送请求；冷却结束时转入 half_open"""
+        if self.state == STATE_CLOSED:
+            return True
+        if self.state == STATE_OPEN:
+            if now < self.open_until:
+                return False
+            self.state = STATE_HALF_OPEN
+            self.probes_in_flight = 0
+        return self.probes_in_flight < settings.breaker_half_open_probes
+
+    def on_acquire(self):
+        if self.state == STATE_HALF_OPEN:
+            self.probes_in_flight += 1
+
+    def on_abandon(self):
+        # 请求未拿到上游结果（例如客户端提前断开），释放探测名额
+        if self.state == STATE_HALF_OPEN and self.probes_in_flight > 0:
+            self.probes_in_flight -= 1
+
+    def record(self, status_code: int, now: float):
+        self.last_status = status_code
+        if not is_failure_status(status_code):
+            self.consecutive_failures = 0
+            if self.state != STATE_CLOSED:
+                self.state = STATE_CLOSED
+                self.trips = 0
+                self.probes_in_flight = 0
+            return
+
+        self.consecutive_failures += 1
+        if (
+            self.state == STATE_HALF_OPEN
+            or status_code in TRIP_IMMEDIATELY
+            or self.consecutive_failures >= settings.breaker_failure_threshold
+        ):
+            self._trip(now)
+
+    def _trip(self, now: float):
+        self.trips += 1
+        self.state = STATE_OPEN
+        self.open_until = now + self._cooldown()
+        self.probes_in_flight = 0
+
+    def reset(self):
+        self.state = STATE_CLOSED
+        self.consecutive_failures = 0
+        self.trips = 0
+        self.probes_in_flight = 0
+
+    def export(self) -> Dict[str, Any]:
+        """多 worker 共享的状态；open_until 换算成墙上时间，各进程的 monotonic 时钟不可比较"""
+        retry_in = max(self.open_until - time.monotonic(), 0.0) if self.state == STATE_OPEN else 0.0
+        return {
+            "state": self.state,
+            "open_until": time.time() + retry_in if self.state == STATE_OPEN else 0.0,
+            "trips": self.trips,
+            "consecutive_failures": self.consecutive_failures,
+            "last_status": self.last_status,
+        }
+
+    def restore(self, data: Dict[str, Any]):
+        """采用其他 worker 导出的状态；本进程的探测名额重新计数"""
+        self.state = data["state"]
+        self.trips = data["trips"]
+        self.consecutive_failures = data["consecutive_failures"]
+        self.last_status = data["last_status"]
+        self.open_until = time.monotonic() + max(data["open_until"] - time.time(), 0.0) if self.state == STATE_OPEN else 0.0
+        self.probes_in_flight = 0
+
+    def to_dict(self) -> Dict[str, Any]:
+        retry_in = max(self.open_until - time.monotonic(), 0.0) if self.state == STATE_OPEN else 0.0
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "trips": self.trips,
+            "retry_in": round(retry_in, 1),
+            "last_status": self.last_status,
+        }
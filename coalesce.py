@@ -0,0 +1,145 @@
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import AsyncIterator, List, Optional
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+# 客户端按请求控制合并："off" 关闭；"20" 或 "20ms" 指定时间窗口；"20,512" 同时指定字节阈值
+COALESCE_HEADER = "X-Stream-Coalesce"
+
+
+@dataclass(frozen=True)
+class CoalesceOptions:
+    max_delay: float  # 秒
+    max_bytes: int
+
+    def key(self) -> str:
+        return f"{self.max_delay * 1000:g}ms,{self.max_bytes}"
+
+
+def resolve_options(header_value: Optional[str]) -> Optional[CoalesceOptions]:
+    """根据请求头和全局配置决定本次请求的合并参数，返回 None 表示不合并；无法解析的请求头按全局配置处理"""
+    enabled = settings.stream_coalesce_enabled
+    delay_ms = settings.stream_coalesce_max_delay_ms
+    max_bytes = settings.stream_coalesce_max_bytes
+
+    value = (header_value or "").strip().lower()
+    if value in ("off", "0", "false", "no"):
+        return None
+    if value in ("on", "true", "yes"):
+        enabled = True
+    elif value:
+        delay_part, _, bytes_part = value.partition(",")
+        try:
+            delay_ms = float(delay_part.strip().removesuffix("ms"))
+            if bytes_part.strip():
+                max_bytes = int(bytes_part.strip())
+            enabled = True
+        except ValueError:
+            logger.warning(f"无法解析 {COALESCE_HEADER}: {header_value}")
+
+    if not enabled or delay_ms <= 0:
+        return None
+    return CoalesceOptions(delay_ms / 1000, max(max_bytes, 1))
+
+
+class _Coalescer:
+    """后台任务读取上游并追加到缓冲区；只在需要发帧时唤醒消费者，每个片段只做一次追加"""
+
+    def __init__(self, source: AsyncIterator[str], options: CoalesceOptions):
+        self.source = source
+        self.options = options
+        self.loop = asyncio.get_running_loop()
+        self.buffer: List[str] = []
+        self.size = 0
+        self.first = True
+        self.done = False
+        self.error: Optional[Exception] = None
+        self.ready = False
+        self.waiter: Optional[asyncio.Future] = None
+        self.timer: Optional[asyncio.TimerHandle] = None
+        # 背压：消费者（客户端）跟不上时缓冲区达到上限即暂停读取上游
+        self.limit = max(settings.stream_buffer_max_bytes, options.max_bytes)
+        self.drained: Optional[asyncio.Future] = None
+        self.task = self.loop.create_task(self._pump())
+
+    async def _pump(self):
+        try:
+            async for text in self.source:
+                self._append(text)
+                if self.size >= self.limit:
+                    self.drained = self.loop.create_future()
+                    await self.drained
+        except Exception as e:
+            self.error = e
+        self.done = True
+        self._wake()
+
+    def _append(self, text: str):
+        if not self.buffer and not self.first:
+            # 缓冲区从空变为非空时开始计时
+            self.timer = self.loop.call_later(self.options.max_delay, self._wake)
+        self.buffer.append(text)
+        self.size += len(text.encode("utf-8"))
+        if self.first or self.size >= self.options.max_bytes:
+            self._wake()
+
+    def _wake(self):
+        self.ready = True
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    def take(self) -> str:
+        text = "".join(self.buffer)
+        self.buffer, self.size, self.first = [], 0, False
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.drained is not None and not self.drained.done():
+            self.drained.set_result(None)
+        return text
+
+    async def wait(self):
+        if not self.ready:
+            self.waiter = self.loop.create_future()
+            try:
+                await self.waiter
+            finally:
+                self.waiter = None
+        self.ready = False
+
+    async def close(self):
+        if self.timer is not None:
+            self.timer.cancel()
+        if not self.task.done():
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        await self.source.aclose()
+
+
+async def coalesce_text(source: AsyncIterator[str], options: CoalesceOptions) -> AsyncIterator[str]:
+    """
+    合并高频的小文本片段：首个片段立即发出以保证首字延迟，
+    之后累积到字节阈值或时间窗口到期再发出一帧。
+    上游在后台任务中读取，等待窗口时不会打断正在进行的上游读取。
+    """
+    state = _Coalescer(source, options)
+    try:
+        while True:
+            await state.wait()
+            if state.buffer:
+                yield state.take()
+            if state.done:
+                if state.buffer:
+                    yield state.take()
+                if state.error is not None:
+                    raise state.error
+                return
+    finally:
+        await state.close()
@@ -1,5 +1,6 @@
 import os
 from pathlib import Path
+from typing import Dict
 from pydantic_settings import BaseSettings
 
 class Settings(BaseSettings):
@@ -9,6 +10,10 @@ class Settings(BaseSettings):
     
     # 数据库配置
     database_url: str = "sqlite+aiosqlite:///./puter.db"
+    db_pool_size: int = 5
+    db_max_overflow: int = 10
+    db_pool_timeout: float = 30.0
+    db_busy_timeout_ms: int = 5000
     
     # 本地存储配置
     data_dir: str = "./data"
@@ -20,9 +25,115 @@ class Settings(BaseSettings):
     host: str = "127.0.0.1"
     port: int = 8000
     api_key: str = "1"
+    # uvicorn worker 进程数；大于 1 时自动启用下面的多进程共享状态
+    workers: int = 1
     
     # Puter.js 配置
     puter_js_url: str = "https://js.puter.com/v2/"
+    # Puter API 地址；压测时可指向本地模拟上游（python providers.py）
+    puter_api_base: str = "https://api.puter.com"
+    
+    # 上游 HTTP 连接池配置
+    upstream_max_connections: int = 100
+    upstream_max_keepalive_connections: int = 20
+    upstream_keepalive_expiry: float = 30.0
+    upstream_http2: bool = True
+    upstream_connect_timeout: float = 10.0
+    upstream_prewarm_connections: int = 2
+    
+    # 上游流量录制 / 回放：录制目录非空时把上游响应的时序与分块写成 trace 文件（不含 auth token，text 默认替换为等长占位）；
+    # 回放目录非空时不访问上游，按 trace 返回响应，speed 为回放倍速（0 表示不等待）
+    upstream_record_dir: str = ""
+    upstream_record_redact: bool = True
+    upstream_replay_dir: str = ""
+    upstream_replay_speed: float = 1.0
+    
+    # 账号调度策略: least_outstanding（最少在途请求）或 weighted_round_robin（加权轮询）
+    account_strategy: str = "least_outstanding"
+    
+    # 账号熔断配置（冷却时间单位：秒）
+    breaker_failure_threshold: int = 3
+    breaker_base_cooldown: float = 30.0
+    breaker_max_cooldown: float = 1800.0
+    breaker_half_open_probes: int = 1
+    
+    # 账号调用统计写回间隔（秒）
+    stats_flush_interval: float = 5.0
+    
+    # 回答缓存（仅缓存 temperature=0 等确定性请求，默认关闭）
+    response_cache_enabled: bool = False
+    response_cache_ttl: float = 86400.0
+    response_cache_memory_entries: int = 1024
+    response_cache_disk_max_bytes: int = 256 * 1024 * 1024
+    
+    # 合并相同的并发聊天请求，共用一个上游流；默认只合并确定性请求（temperature=0 或会被缓存的请求），
+    # 开启 singleflight_nondeterministic 后 temperature>0 的相同请求也共用同一个回答
+    singleflight_enabled: bool = True
+    singleflight_nondeterministic: bool = False
+    
+    # 流式增量合并：首个片段立即发出，之后按时间窗口 / 字节阈值合并成一帧；可用 X-Stream-Coalesce 请求头按请求覆盖
+    stream_coalesce_enabled: bool = False
+    stream_coalesce_max_delay_ms: float = 20.0
+    stream_coalesce_max_bytes: int = 1024
+    
+    # 失败转移：首个内容分块之前上游失败（连接失败、401/403/408/429、5xx）时换一个空闲账号重试，
+    # 最多 failover_max_attempts 次（含首次）；重试前按指数退避加全抖动等待（base * 2^n 秒，不超过 max）
+    failover_max_attempts: int = 3
+    failover_backoff_base: float = 0.1
+    failover_backoff_max: float = 2.0
+    
+    # 对冲请求（仅流式）：首个分块在阈值内未到达时用另一个账号发起同样的请求，先产出内容的一方胜出，另一方取消。
+    # 阈值为该模型最近 hedge_window 个首字延迟的 hedge_percentile 分位（样本不足时用 hedge_initial_delay），限制在 [min, max] 内；
+    # 每个请求最多对冲 hedge_max_per_request 次，对冲总数不超过请求数的 hedge_budget_ratio
+    hedge_enabled: bool = False
+    hedge_percentile: float = 95.0
+    hedge_window: int = 200
+    hedge_min_samples: int = 20
+    hedge_initial_delay: float = 2.0
+    hedge_min_delay: float = 0.2
+    hedge_max_delay: float = 10.0
+    hedge_max_per_request: int = 1
+    hedge_budget_ratio: float = 0.1
+    
+    # 客户端断开检测与背压：非流式请求的断开轮询间隔；合并缓冲区超过上限时暂停读取上游
+    disconnect_poll_interval: float = 0.5
+    stream_buffer_max_bytes: int = 65536
+    
+    # 日志配置：structured 输出 JSON 行；queue 模式由后台线程写日志；原始分块按比例抽样
+    log_level: str = "INFO"
+    log_structured: bool = False
+    log_queue: bool = True
+    log_raw_chunk_sample_rate: float = 0.0
+    
+    # 图片存储：生成的图片文件总大小上限（LRU 淘汰）；开启缓存后相同生成参数（模型/提示词/质量）直接返回已有图片
+    image_store_max_bytes: int = 1024 * 1024 * 1024
+    image_cache_enabled: bool = False
+    
+    # 准入控制：全局 / 单账号在途上限（0 表示不限制），等待队列长度与超时；API Key -> 优先级通道(high/normal/low)
+    admission_max_inflight: int = 64
+    admission_per_account_limit: int = 4
+    admission_queue_size: int = 256
+    admission_queue_timeout: float = 30.0
+    admission_key_priorities: Dict[str, str] = {}
+    
+    # 批处理：每个批处理的并发 worker 数；每 N 条结果或每隔若干秒写一次检查点；账号不可用时的重试次数
+    batch_concurrency: int = 8
+    batch_checkpoint_every: int = 100
+    batch_checkpoint_interval: float = 2.0
+    batch_account_retries: int = 5
+    
+    # token 用量统计：tiktoken 编码名（需安装 tiktoken，启动时加载一次）；为空、未安装或加载失败时使用内置估算
+    usage_tokenizer: str = "o200k_base"
+    
+    # 多进程共享状态：账号在途数、熔断状态、准入上限与指标通过该 SQLite（WAL）文件在 worker 之间共享。
+    # workers > 1 时自动启用；用 gunicorn 等外部方式启动多个进程时设置 shared_state_enabled。
+    # 心跳超过 worker_timeout 秒未更新的 worker 视为失联，清除其在途数并由其他 worker 接管它的批处理
+    shared_state_enabled: bool = False
+    shared_state_path: str = "./data/shared_state.db"
+    shared_state_heartbeat: float = 1.0
+    shared_state_worker_timeout: float = 10.0
+    # 选账号时在事件循环上等待共享写锁的上限（毫秒），超时按本 worker 状态调度；其余共享状态读写在专用线程中进行
+    shared_state_acquire_timeout_ms: int = 20
     
     # 浏览器配置
     browser_headless: bool = False
@@ -33,8 +144,13 @@ class Settings(BaseSettings):
 
 settings = Settings()
 
-# 创建必要的目录
+_directories_ready = False
+
+# 创建必要的目录；由启动流程调用，导入配置时不访问文件系统，同一进程内只执行一次
 def init_directories():
+    global _directories_ready
+    if _directories_ready:
+        return
     directories = [
         settings.data_dir,
         settings.accounts_dir,
@@ -43,6 +159,4 @@ def init_directories():
     ]
     for directory in directories:
         Path(directory).mkdir(parents=True, exist_ok=True)
-
-# 初始化
-init_directories()
\ No newline at end of file
+    _directories_ready = True
\ No newline at end of file
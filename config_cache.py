@@ -0,0 +1,63 @@
+import json
+import logging
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def parse_config_value(value: Optional[str], value_type: Optional[str]) -> Any:
+    """按 AppConfig.value_type 把字符串配置转换为对应类型，转换失败时返回原字符串"""
+    if value is None:
+        return None
+    try:
+        if value_type == "boolean":
+            return value.strip().lower() in ("true", "1", "yes", "on")
+        if value_type == "number":
+            number = float(value)
+            return int(number) if number.is_integer() and "." not in value else number
+        if value_type == "json":
+            return json.loads(value)
+    except (ValueError, TypeError):
+        logger.warning(f"配置值无法按 {value_type} 解析: {value!r}")
+    return value
+
+
+class ConfigCache:
+    """进程内配置缓存：启动时从 app_configs 表加载，set/delete 时同步更新，热路径读取无 I/O"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # key -> (原始字符串, 解析后的值)
+        self._entries: Dict[str, Tuple[Optional[str], Any]] = {}
+        self.loaded = False
+
+    def load(self, configs) -> None:
+        entries = {
+            config.key: (config.value, parse_config_value(config.value, config.value_type))
+            for config in configs
+        }
+        with self._lock:
+            self._entries = entries
+            self.loaded = True
+        logger.info(f"配置缓存已加载 {len(entries)} 项")
+
+    def put(self, key: str, value: Optional[str], value_type: Optional[str]) -> None:
+        with self._lock:
+            self._entries[key] = (value, parse_config_value(value, value_type))
+
+    def invalidate(self, key: str) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def get_raw(self, key: str, default: Optional[str] = None) -> Optional[str]:
+        entry = self._entries.get(key)
+        return entry[0] if entry is not None else default
+
+    def get(self, key: str, default: Any = None) -> Any:
+        entry = self._entries.get(key)
+        return entry[1] if entry is not None else default
+
+
+# 全局配置缓存实例
+config_cache = ConfigCache()
@@ -1,17 +1,52 @@
-from sqlalchemy import create_engine
+import hashlib
+import logging
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from config import settings
-import os
 
-# 同步引擎（用于迁移等）
+logger = logging.getLogger(__name__)
+
+IS_SQLITE = "sqlite" in settings.database_url
+
+# 同步引擎（用于建表、迁移等）
 engine = create_engine(
     settings.database_url.replace("+aiosqlite", ""),  # 移除异步前缀
-    connect_args={"check_same_thread": False} if "sqlite" in settings.database_url else {}
+    connect_args={"check_same_thread": False} if IS_SQLITE else {}
 )
 
+# 异步引擎（请求路径使用，避免阻塞事件循环）
+# aiosqlite 对文件数据库默认使用 NullPool，每个会话都会新建连接线程，这里改为复用连接
+async_engine = create_async_engine(
+    settings.database_url,
+    poolclass=AsyncAdaptedQueuePool,
+    pool_size=settings.db_pool_size,
+    max_overflow=settings.db_max_overflow,
+    pool_timeout=settings.db_pool_timeout,
+    pool_pre_ping=True,
+)
+
+def _set_sqlite_pragma(dbapi_connection, connection_record):
+    # WAL 模式下读写互不阻塞；NORMAL 同步级别在 WAL 下仍能保证一致性
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={settings.db_busy_timeout_ms}")
+    cursor.close()
+
+if IS_SQLITE:
+    event.listen(engine, "connect", _set_sqlite_pragma)
+    event.listen(async_engine.sync_engine, "connect", _set_sqlite_pragma)
+
 # 会话工厂
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+AsyncSessionLocal = sessionmaker(
+    async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False
+)
 
 # 依赖项
 def get_db():
@@ -21,12 +56,41 @@ def get_db():
     finally:
         db.close()
 
-# 创建表
-def create_tables():
-    from models import Base
-    Base.metadata.create_all(bind=engine)
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+_tables_ready = False
 
-# 初始化数据库
-if not os.path.exists("./puter.db"):
-    create_tables()
-    print("数据库表已创建")
\ No newline at end of file
+def _schema_fingerprint(metadata) -> int:
+    # 表名与列定义的摘要（SQLite user_version 为 32 位有符号整数）
+    text = ";".join(
+        f"{table.name}:" + ",".join(f"{column.name} {column.type}" for column in table.columns)
+        for table in metadata.sorted_tables
+    )
+    return int.from_bytes(hashlib.sha1(text.encode("utf-8")).digest()[:4], "big") & 0x7FFFFFFF
+
+# 创建表：同一进程只执行一次；SQLite 的 user_version 与当前模型一致时只读一次 PRAGMA，跳过逐表检查
+def create_tables() -> bool:
+    """返回是否执行了建表"""
+    global _tables_ready
+    if _tables_ready:
+        return False
+    from models import Base
+    fingerprint = _schema_fingerprint(Base.metadata)
+    if IS_SQLITE:
+        with engine.connect() as conn:
+            if conn.exec_driver_sql("PRAGMA user_version").scalar() == fingerprint:
+                _tables_ready = True
+                return False
+    try:
+        Base.metadata.create_all(bind=engine)
+    except OperationalError:
+        # 多个 worker 同时建表时，其他进程可能已先建好；再检查一次
+        Base.metadata.create_all(bind=engine)
+    if IS_SQLITE:
+        with engine.begin() as conn:
+            conn.exec_driver_sql(f"PRAGMA user_version = {fingerprint}")
+    _tables_ready = True
+    logger.info("数据库表结构已初始化")
+    return True
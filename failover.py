@@ -0,0 +1,132 @@
+import asyncio
+import logging
+import random
+from typing import Any, AsyncGenerator, Callable, Container, Dict, List, Optional, Set
+
+from config import settings
+import metrics
+from sse_utils import ERROR_FRAME_PREFIX
+
+logger = logging.getLogger(__name__)
+
+ATTEMPTS_HEADER = "X-Upstream-Attempts"
+FAILOVERS_HEADER = "X-Upstream-Failovers"
+
+
+def is_retryable(status_code: Optional[int]) -> bool:
+    """换账号可能成功的失败：连接失败、账号认证失效、限流、超时和上游 5xx；400 等请求本身的问题不重试"""
+    if status_code is None:
+        return False
+    return status_code == 0 or status_code in (401, 403, 408, 429) or status_code >= 500
+
+
+def backoff_delay(failures: int) -> float:
+    # 指数退避 + 全抖动，避免多个请求同时重试
+    return random.uniform(0, min(settings.failover_backoff_max, settings.failover_backoff_base * 2 ** (failures - 1)))
+
+
+class Failover:
+    """
+    单个请求的失败转移：首个结果是可重试的失败时，退避后换一个未用过的空闲账号重新请求，
+    最多 settings.failover_max_attempts 次；一旦开始产出内容就不再重试（之后的失败由流本身以错误帧结束）。
+    尝试次数与触发转移的上游状态写入 headers（在首个结果产出前更新，随响应一起返回）。
+    hold / unhold 在归还失败账号之前占住 / 放回准入名额，退避期间名额不会被排队的请求拿走；
+    提供时 acquire 应使用这个名额换账号。
+    """
+
+    def __init__(
+        self,
+        model: str,
+        account,
+        open_attempt: Callable[[Any, List[int]], AsyncGenerator],
+        acquire: Callable[[Container[int]], Optional[Any]],
+        is_error: Callable[[Any], bool],
+        headers: Optional[Dict[str, str]] = None,
+        hold: Optional[Callable[[], None]] = None,
+        unhold: Optional[Callable[[], None]] = None
+    ):
+        self.model = model
+        self.account = account
+        self.open_attempt = open_attempt
+        self.acquire = acquire
+        self.is_error = is_error
+        self.headers = headers if headers is not None else {}
+        self.hold = hold
+        self.unhold = unhold
+        self.attempts = 0
+        self.failover_statuses: List[int] = []
+        self.tried: Set[int] = set()
+
+    def track(self, account) -> Any:
+        """open_attempt 每使用一个账号都要经过这里（含对冲账号），之后的转移不再选它"""
+        self.tried.add(account.account_id)
+        return account
+
+    def _update_headers(self):
+        self.headers[ATTEMPTS_HEADER] = str(self.attempts)
+        if self.failover_statuses:
+            self.headers[FAILOVERS_HEADER] = ",".join(str(status) for status in self.failover_statuses)
+
+    async def stream(self) -> AsyncGenerator:
+        account = self.account
+        while True:
+            self.attempts += 1
+            self._update_headers()
+            outcome: List[int] = []
+            results = self.open_attempt(self.track(account), outcome)
+            try:
+                first = await results.__anext__()
+            except StopAsyncIteration:
+                first = None
+            except BaseException:
+                await results.aclose()
+                raise
+
+            if first is not None and not self.is_error(first):
+                try:
+                    yield first
+                    async for item in results:
+                        yield item
+                finally:
+                    await results.aclose()
+                return
+
+            # 上游状态在首个结果之前已回调
+            status_code = outcome[-1] if outcome else None
+            retryable = self.attempts < settings.failover_max_attempts and is_retryable(status_code)
+            held = retryable and self.hold is not None
+            if held:
+                self.hold()
+            next_account = None
+            try:
+                # 读完失败的尝试（错误帧之后的结束标记等），生成器随之归还账号
+                tail = [item async for item in results]
+                if retryable:
+                    await asyncio.sleep(backoff_delay(self.attempts))
+                    next_account = self.acquire(self.tried)
+            finally:
+                if held and next_account is None:
+                    self.unhold()
+
+            if next_account is None:
+                if retryable:
+                    # 可以重试但其余账号都已试过或达到单账号在途上限
+                    metrics.chat_failover_skips.inc(metrics.model_label(self.model), str(status_code))
+                    logger.warning(f"上游状态 {status_code}，没有空闲账号可转移，直接返回错误")
+                for item in ([first] if first is not None else []) + tail:
+                    yield item
+                return
+
+            self.failover_statuses.append(status_code)
+            metrics.chat_failovers.inc(metrics.model_label(self.model), str(status_code))
+            logger.warning(f"上游状态 {status_code}，第 {self.attempts} 次尝试失败，转移到账号 {next_account.name}")
+            account = next_account
+
+
+def is_error_frame(chunk: bytes) -> bool:
+    return chunk.startswith(ERROR_FRAME_PREFIX)
+
+
+def is_error_result(result) -> bool:
+    # 非流式结果为 (HTTP 状态码, 响应体)
+    return result[0] != 200
@@ -0,0 +1,212 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import AsyncGenerator, AsyncIterator, Callable, Container, Deque, Dict, List, Optional
+
+from config import settings
+import metrics
+from sse_utils import ERROR_FRAME_PREFIX
+
+logger = logging.getLogger(__name__)
+
+# open_stream(account, outcome)：使用该账号的流，上游状态码追加到 outcome，结束时自行归还账号
+OpenStream = Callable[[object, List[int]], AsyncGenerator[bytes, None]]
+
+
+class TTFTTracker:
+    """按模型保存最近的首字延迟样本，计算对冲阈值"""
+
+    def __init__(self):
+        self._samples: Dict[str, Deque[float]] = {}
+
+    def observe(self, model: str, seconds: float):
+        samples = self._samples.get(model)
+        if samples is None or samples.maxlen != settings.hedge_window:
+            samples = self._samples[model] = deque(samples or (), maxlen=settings.hedge_window)
+        samples.append(seconds)
+
+    def threshold(self, model: str) -> float:
+        samples = self._samples.get(model)
+        if not samples or len(samples) < settings.hedge_min_samples:
+            value = settings.hedge_initial_delay
+        else:
+            ordered = sorted(samples)
+            index = min(len(ordered) - 1, int(len(ordered) * settings.hedge_percentile / 100))
+            value = ordered[index]
+        return min(max(value, settings.hedge_min_delay), settings.hedge_max_delay)
+
+    def models(self) -> List[str]:
+        return list(self._samples)
+
+
+class HedgeBudget:
+    """令牌桶：每个请求存入 hedge_budget_ratio 个令牌，每次对冲取出一个，保证对冲数不超过请求数的该比例"""
+
+    def __init__(self):
+        self.tokens = self.capacity
+
+    @property
+    def capacity(self) -> float:
+        # 允许短时间内集中对冲少量请求
+        return max(1.0, settings.hedge_budget_ratio * 100)
+
+    def deposit(self):
+        self.tokens = min(self.capacity, self.tokens + settings.hedge_budget_ratio)
+
+    def take(self) -> bool:
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class _Attempt:
+    __slots__ = ("account_id", "outcome", "stream", "task", "started", "hedge")
+
+    def __init__(self, account_id: int, open_stream: "OpenStream", account, hedge: bool):
+        self.account_id = account_id
+        # 每个尝试单独收集上游状态码，各自按自己的结果归还账号
+        self.outcome: List[int] = []
+        self.stream = open_stream(account, self.outcome)
+        self.task = asyncio.ensure_future(self.stream.__anext__())
+        self.started = time.monotonic()
+        self.hedge = hedge
+
+    async def close(self):
+        # 先取消进行中的 __anext__（生成器的 finally 归还账号），再关闭生成器
+        if not self.task.done():
+            self.task.cancel()
+        try:
+            await self.task
+        except (asyncio.CancelledError, StopAsyncIteration, Exception):
+            pass
+        await self.stream.aclose()
+
+
+class Hedger:
+    """
+    流式请求的对冲：主请求在阈值内没有产出首个分块时，用另一个账号发起同样的请求，
+    先产出内容的一方胜出，其余的取消（各自的生成器负责归还账号）。
+    """
+
+    def __init__(self):
+        self.tracker = TTFTTracker()
+        self.budget = HedgeBudget()
+
+    async def stream(
+        self,
+        model: str,
+        account,
+        open_stream: OpenStream,
+        acquire: Callable[[Container[int]], Optional[object]],
+        outcome: Optional[List[int]] = None
+    ) -> AsyncIterator[bytes]:
+        """
+        acquire(exclude) 不排队地取另一个账号，没有时返回 None。
+        outcome 只收到最终采用的尝试（胜出者，或全部失败时最后一个）的上游状态码，供失败转移判断。
+        """
+        outcome = outcome if outcome is not None else []
+        # 样本与指标按已知模型归类，请求体中任意填写的 model 共用 other
+        model = metrics.model_label(model)
+        self.budget.deposit()
+        primary = _Attempt(account.account_id, open_stream, account, hedge=False)
+        attempts = [primary]
+        hedges = 0
+        deadline = primary.started + self.tracker.threshold(model)
+        winner: Optional[_Attempt] = None
+        first: Optional[bytes] = None
+        try:
+            while winner is None:
+                live = [a for a in attempts if not a.task.done()]
+                can_hedge = hedges < settings.hedge_max_per_request
+                timeout = max(0.0, deadline - time.monotonic()) if can_hedge else None
+                done, _ = await asyncio.wait({a.task for a in live}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+                # 同一轮可能同时有失败和成功的尝试完成：先找成功的，失败的只在没有其他尝试可等时才采用
+                finished = [(a, self._first_chunk(a)) for a in attempts if a.task in done]
+                succeeded = [(a, chunk) for a, chunk in finished if chunk is not None and not chunk.startswith(ERROR_FRAME_PREFIX)]
+                if succeeded:
+                    winner, first = succeeded[0]
+                elif finished:
+                    if any(not a.task.done() for a in attempts):
+                        # 失败的请求直接关闭，继续等待其余仍在进行的请求，而不是把错误返回给客户端
+                        for attempt, _ in finished:
+                            attempts.remove(attempt)
+                            await attempt.close()
+                    else:
+                        winner, first = finished[-1]
+
+                if winner is None and not done:
+                    hedges += 1
+                    if self._launch_hedge(model, attempts, open_stream, acquire):
+                        deadline = time.monotonic() + self.tracker.threshold(model)
+                    else:
+                        # 预算用尽或没有空闲账号，本请求不再尝试对冲
+                        hedges = settings.hedge_max_per_request
+
+            now = time.monotonic()
+            if first and not first.startswith(ERROR_FRAME_PREFIX):
+                self.tracker.observe(model, now - winner.started)
+                if winner.hedge:
+                    metrics.chat_hedges.inc(model, "won")
+                if primary is not winner and primary in attempts:
+                    # 主请求被取消时尚未产出首字，它的实际首字延迟至少为已等待的时间
+                    self.tracker.observe(model, now - primary.started)
+            for attempt in attempts:
+                if attempt is not winner:
+                    await attempt.close()
+            attempts = [winner]
+            outcome.extend(winner.outcome)
+
+            if first is None:
+                return
+            forwarded = len(winner.outcome)
+            yield first
+            async for chunk in winner.stream:
+                yield chunk
+            outcome.extend(winner.outcome[forwarded:])
+        finally:
+            for attempt in attempts:
+                await attempt.close()
+
+    @staticmethod
+    def _first_chunk(attempt: _Attempt) -> Optional[bytes]:
+        try:
+            return attempt.task.result()
+        except (StopAsyncIteration, asyncio.CancelledError):
+            return None
+        except Exception as e:
+            logger.warning(f"对冲请求失败: {e}")
+            return None
+
+    def _launch_hedge(
+        self,
+        model: str,
+        attempts: List[_Attempt],
+        open_stream: OpenStream,
+        acquire: Callable[[Container[int]], Optional[object]]
+    ) -> bool:
+        if not self.budget.take():
+            metrics.chat_hedges.inc(model, "skipped_budget")
+            return False
+        account = acquire({a.account_id for a in attempts})
+        if account is None:
+            # 没用上的令牌退回
+            self.budget.tokens += 1
+            metrics.chat_hedges.inc(model, "skipped_no_account")
+            return False
+        metrics.chat_hedges.inc(model, "launched")
+        logger.info(f"首字超过 {self.tracker.threshold(model):.2f}s，对冲到账号 {account.name}")
+        attempts.append(_Attempt(account.account_id, open_stream, account, hedge=True))
+        return True
+
+
+# 全局对冲实例
+hedger = Hedger()
+
+metrics.registry.register(metrics.CallbackMetric(
+    "puter_chat_hedge_threshold_seconds", "Current hedging threshold (rolling TTFT percentile) per model", ("model",),
+    lambda: {(model,): hedger.tracker.threshold(model) for model in hedger.tracker.models()},
+    merge="max",
+))
@@ -0,0 +1,92 @@
+import asyncio
+import logging
+from typing import Optional
+
+import httpx
+
+from config import settings
+from upstream_trace import RecordingTransport, ReplayTransport, load_traces
+
+logger = logging.getLogger(__name__)
+
+
+class UpstreamClientPool:
+    """应用生命周期内共享的上游 httpx 客户端（启动时创建，关闭时释放）"""
+
+    _client: Optional[httpx.AsyncClient] = None
+
+    @staticmethod
+    def timeout(seconds: float) -> httpx.Timeout:
+        """单次请求的超时；连接阶段始终使用 upstream_connect_timeout，上游不可达时尽快失败（可触发失败转移）"""
+        return httpx.Timeout(seconds, connect=settings.upstream_connect_timeout)
+
+    @staticmethod
+    def _http2_available() -> bool:
+        try:
+            import h2  # noqa: F401
+            return True
+        except ImportError:
+            return False
+
+    @classmethod
+    def _build_client(cls) -> httpx.AsyncClient:
+        http2 = settings.upstream_http2
+        if http2 and not cls._http2_available():
+            logger.warning("未安装 h2，上游连接回退到 HTTP/1.1")
+            http2 = False
+
+        limits = httpx.Limits(
+            max_connections=settings.upstream_max_connections,
+            max_keepalive_connections=settings.upstream_max_keepalive_connections,
+            keepalive_expiry=settings.upstream_keepalive_expiry,
+        )
+        timeout = cls.timeout(60.0)
+        if settings.upstream_replay_dir:
+            traces = load_traces(settings.upstream_replay_dir)
+            logger.info(f"上游回放模式：{len(traces)} 个 trace，{settings.upstream_replay_speed:g}x")
+            return httpx.AsyncClient(transport=ReplayTransport(traces, settings.upstream_replay_speed), timeout=timeout)
+        if settings.upstream_record_dir:
+            logger.info(f"上游录制模式：trace 写入 {settings.upstream_record_dir}")
+            transport = RecordingTransport(
+                httpx.AsyncHTTPTransport(http2=http2, limits=limits),
+                settings.upstream_record_dir,
+                settings.upstream_record_redact,
+            )
+            return httpx.AsyncClient(transport=transport, timeout=timeout)
+        return httpx.AsyncClient(http2=http2, limits=limits, timeout=timeout)
+
+    @classmethod
+    async def start(cls):
+        if cls._client is None:
+            cls._client = cls._build_client()
+            logger.info("上游 HTTP 连接池已创建")
+        await cls.prewarm()
+
+    @classmethod
+    async def prewarm(cls):
+        count = settings.upstream_prewarm_connections
+        if count <= 0 or settings.upstream_replay_dir:
+            return
+
+        async def _touch():
+            try:
+                # 只需建立 TCP+TLS 连接，不关心响应内容
+                await cls.get_client().head(settings.puter_api_base.rstrip("/") + "/", timeout=settings.upstream_connect_timeout)
+            except Exception as e:
+                logger.warning(f"上游连接预热失败: {e}")
+
+        await asyncio.gather(*[_touch() for _ in range(count)])
+
+    @classmethod
+    async def close(cls):
+        if cls._client is not None:
+            await cls._client.aclose()
+            cls._client = None
+            logger.info("上游 HTTP 连接池已关闭")
+
+    @classmethod
+    def get_client(cls) -> httpx.AsyncClient:
+        # 未经过 FastAPI 启动流程（如脚本直接调用）时按需创建
+        if cls._client is None:
+            cls._client = cls._build_client()
+        return cls._client
@@ -0,0 +1,340 @@
+import asyncio
+import base64
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, AsyncIterator, Callable, Dict, Optional, Tuple
+
+import anyio
+from starlette.responses import FileResponse, Response
+from starlette.types import Receive, Scope, Send
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+# 生成的图片文件通过该路由以 FileResponse 返回
+IMAGE_ROUTE = "/v1/images/files"
+
+# 参与图片缓存键计算的生成参数（即发送给上游的参数）
+IMAGE_KEY_FIELDS = ("model", "prompt", "quality")
+
+INDEX_FILE = "index.json"
+
+_EXTENSIONS = {
+    "image/png": ".png",
+    "image/jpeg": ".jpg",
+    "image/jpg": ".jpg",
+    "image/webp": ".webp",
+    "image/gif": ".gif",
+}
+
+_RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def extension_for(content_type: Optional[str]) -> str:
+    media_type = (content_type or "").split(";")[0].strip().lower()
+    return _EXTENSIONS.get(media_type, ".png")
+
+
+def make_image_key(request_data: Dict[str, Any], default_model: str) -> str:
+    canonical = {field: request_data.get(field) for field in IMAGE_KEY_FIELDS if request_data.get(field) is not None}
+    canonical.setdefault("model", default_model)
+    encoded = json.dumps(canonical, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+class Base64Builder:
+    """增量 base64 编码：按 3 字节对齐编码每个分块，原始字节用完即丢弃"""
+
+    def __init__(self):
+        self._encoded = bytearray()
+        self._carry = b""
+
+    def feed(self, chunk: bytes):
+        data = self._carry + chunk if self._carry else chunk
+        aligned = len(data) - len(data) % 3
+        view = memoryview(data)
+        self._encoded += base64.b64encode(view[:aligned])
+        self._carry = bytes(view[aligned:])
+
+    def result(self) -> str:
+        if self._carry:
+            self._encoded += base64.b64encode(self._carry)
+            self._carry = b""
+        return self._encoded.decode("ascii")
+
+
+async def encode_stream(chunks: AsyncIterator[bytes]) -> str:
+    builder = Base64Builder()
+    async for chunk in chunks:
+        builder.feed(chunk)
+    return builder.result()
+
+
+class ImageStore:
+    """
+    cache_dir/images 下的图片文件存储。
+    按生成参数哈希命名的文件可被再次命中（内容寻址），其余按随机名保存；
+    所有文件共用一个按总字节数限制的 LRU，索引保存在 index.json，重启后恢复。
+    """
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+        self._lock = threading.Lock()
+        # name -> size，按最近使用排序
+        self._index: "OrderedDict[str, int]" = OrderedDict()
+        self._bytes = 0
+        self._dirty = False
+
+    @property
+    def max_bytes(self) -> int:
+        return settings.image_store_max_bytes
+
+    # ---- 索引 ----
+
+    def load_index(self):
+        """读取 index.json；文件缺失或损坏时扫描目录重建（按修改时间排序）"""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        names = []
+        try:
+            names = json.loads((self.directory / INDEX_FILE).read_text(encoding="utf-8"))["entries"]
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+        on_disk = {}
+        for path in self.directory.iterdir():
+            if not path.is_file() or path.name == INDEX_FILE:
+                continue
+            if path.name.endswith((".part", ".tmp")):
+                # 上次退出时未写完的文件
+                path.unlink(missing_ok=True)
+            else:
+                on_disk[path.name] = path.stat()
+
+        # 索引中已有的按索引顺序，索引外的文件按修改时间排在最旧的一端
+        known = [name for name in names if name in on_disk]
+        orphans = sorted((name for name in on_disk if name not in set(known)), key=lambda n: on_disk[n].st_mtime)
+        with self._lock:
+            self._index = OrderedDict((name, on_disk[name].st_size) for name in orphans + known)
+            self._bytes = sum(self._index.values())
+            self._dirty = True
+        self._evict()
+        self.save_index()
+        logger.info(f"图片存储已加载 {len(self._index)} 个文件，共 {self._bytes} 字节")
+
+    def save_index(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            data = json.dumps({"entries": list(self._index)})
+            self._dirty = False
+        self.directory.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.directory / (INDEX_FILE + ".tmp")
+        tmp_path.write_text(data, encoding="utf-8")
+        os.replace(tmp_path, self.directory / INDEX_FILE)
+
+    def _evict(self):
+        evicted = []
+        with self._lock:
+            while self._bytes > self.max_bytes and len(self._index) > 1:
+                name, size = self._index.popitem(last=False)
+                self._bytes -= size
+                evicted.append(name)
+            if evicted:
+                self._dirty = True
+        for name in evicted:
+            (self.directory / name).unlink(missing_ok=True)
+
+    def _register(self, name: str, size: int):
+        with self._lock:
+            self._bytes -= self._index.pop(name, 0)
+            self._index[name] = size
+            self._bytes += size
+            self._dirty = True
+        self._evict()
+
+    # ---- 查找 ----
+
+    def resolve(self, name: str) -> Optional[Path]:
+        """按文件名查找图片并刷新 LRU 位置；拒绝索引之外的名字（含路径穿越）"""
+        with self._lock:
+            if name not in self._index:
+                return None
+            self._index.move_to_end(name)
+            self._dirty = True
+        path = self.directory / name
+        if not path.is_file():
+            with self._lock:
+                self._bytes -= self._index.pop(name, 0)
+            return None
+        return path
+
+    def lookup(self, key: str) -> Optional[str]:
+        """按缓存键查找已生成的图片，返回文件名"""
+        with self._lock:
+            names = [name for name in (key + ext for ext in set(_EXTENSIONS.values())) if name in self._index]
+        for name in names:
+            if self.resolve(name) is not None:
+                return name
+        return None
+
+    # ---- 写入 ----
+
+    async def save_stream(
+        self,
+        chunks: AsyncIterator[bytes],
+        content_type: Optional[str],
+        key: Optional[str] = None,
+        on_chunk: Optional[Callable[[bytes], None]] = None
+    ) -> str:
+        """
+        把上游图片分块直接写入磁盘，返回文件名；写入过程中不在内存中保留整张图片。
+        key 为缓存键时以它命名，供之后相同参数的请求命中；on_chunk 用于同时做增量编码。
+        """
+        name = f"{key or uuid.uuid4().hex}{extension_for(content_type)}"
+        path = self.directory / name
+        tmp_path = self.directory / f"{name}.{uuid.uuid4().hex[:8]}.part"
+        loop = asyncio.get_running_loop()
+
+        def open_tmp():
+            self.directory.mkdir(parents=True, exist_ok=True)
+            return open(tmp_path, "wb")
+
+        file = await loop.run_in_executor(None, open_tmp)
+        size = 0
+        try:
+            async for chunk in chunks:
+                if on_chunk is not None:
+                    on_chunk(chunk)
+                size += len(chunk)
+                await loop.run_in_executor(None, file.write, chunk)
+            await loop.run_in_executor(None, file.close)
+            os.replace(tmp_path, path)
+        except BaseException:
+            file.close()
+            tmp_path.unlink(missing_ok=True)
+            raise
+
+        self._register(name, size)
+        await loop.run_in_executor(None, self.save_index)
+        return name
+
+    async def read_base64(self, name: str) -> Optional[str]:
+        path = self.resolve(name)
+        if path is None:
+            return None
+
+        def encode():
+            builder = Base64Builder()
+            with open(path, "rb") as file:
+                while chunk := file.read(256 * 1024):
+                    builder.feed(chunk)
+            return builder.result()
+
+        return await asyncio.get_running_loop().run_in_executor(None, encode)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"files": len(self._index), "bytes": self._bytes, "max_bytes": self.max_bytes}
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """
+    解析单个 Range: bytes=a-b / a- / -n，返回闭区间 (start, end)。
+    没有或无法识别（含多段）时返回 None 表示整文件；范围不可满足时抛出 ValueError。
+    """
+    if not header:
+        return None
+    match = _RANGE_RE.match(header.strip())
+    if match is None:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        length = int(last)
+        if length == 0:
+            raise ValueError("unsatisfiable range")
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise ValueError("unsatisfiable range")
+    return start, end
+
+
+class ImageFileResponse(FileResponse):
+    """
+    图片文件响应：ETag 取内容寻址的文件名，支持 If-None-Match 与单段 Range。
+    服务器提供 http.response.zerocopysend 扩展时用 sendfile 发送，否则按块读取。
+    """
+
+    def __init__(self, path: Path, request_headers: Any, method: str = "GET"):
+        self.request_headers = request_headers
+        super().__init__(path, method=method, stat_result=path.stat(), headers={
+            "etag": f'"{path.stem}"',
+            "accept-ranges": "bytes",
+            "cache-control": "public, max-age=31536000, immutable",
+        })
+        self.size = self.stat_result.st_size
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if_none_match = self.request_headers.get("if-none-match")
+        if if_none_match and (if_none_match.strip() == "*" or self.headers["etag"] in if_none_match):
+            await Response(status_code=304, headers={"etag": self.headers["etag"]})(scope, receive, send)
+            return
+
+        try:
+            byte_range = parse_range(self.request_headers.get("range"), self.size)
+        except ValueError:
+            await Response(status_code=416, headers={"content-range": f"bytes */{self.size}"})(scope, receive, send)
+            return
+        # If-Range 与当前 ETag 不一致时返回整个文件
+        if_range = self.request_headers.get("if-range")
+        if byte_range is not None and if_range and if_range.strip() != self.headers["etag"]:
+            byte_range = None
+
+        start, end = byte_range if byte_range is not None else (0, self.size - 1)
+        count = end - start + 1 if self.size else 0
+        if byte_range is not None:
+            self.status_code = 206
+            self.headers["content-range"] = f"bytes {start}-{end}/{self.size}"
+        self.headers["content-length"] = str(count)
+
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if self.send_header_only or count == 0:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+
+        zerocopy = "http.response.zerocopysend" in scope.get("extensions", {})
+        async with await anyio.open_file(self.path, mode="rb") as file:
+            if zerocopy:
+                await send({
+                    "type": "http.response.zerocopysend",
+                    "file": file.wrapped.fileno(),
+                    "offset": start,
+                    "count": count,
+                    "more_body": False,
+                })
+                return
+            await file.seek(start)
+            remaining = count
+            while remaining > 0:
+                chunk = await file.read(min(self.chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": remaining > 0})
+            if remaining > 0:
+                await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+
+# 全局图片存储实例
+image_store = ImageStore(Path(settings.cache_dir) / "images")
@@ -0,0 +1,160 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import time
+from typing import Any, Dict, Optional
+
+from config import settings
+import metrics
+from sse_utils import DONE_CHUNK, ERROR_FRAME_PREFIX
+
+logger = logging.getLogger("puter.requests")
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+class JsonFormatter(logging.Formatter):
+    """每条日志一行 JSON；通过 extra={"fields": {...}} 附带结构化字段"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data: Dict[str, Any] = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        fields = getattr(record, "fields", None)
+        if fields:
+            data.update(fields)
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+def setup_logging():
+    """配置根日志；启用队列模式时由后台线程写出，请求路径上只做入队"""
+    global _listener
+    if _listener is not None:
+        return
+
+    handler = logging.StreamHandler()
+    if settings.log_structured:
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(levelname)s:%(name)s:%(message)s"))
+
+    root = logging.getLogger()
+    root.setLevel(settings.log_level.upper())
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+
+    if settings.log_queue:
+        log_queue: queue.SimpleQueue = queue.SimpleQueue()
+        root.addHandler(logging.handlers.QueueHandler(log_queue))
+        _listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+        _listener.start()
+        atexit.register(stop_logging)
+    else:
+        root.addHandler(handler)
+
+
+def stop_logging():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def sample_raw_chunk() -> bool:
+    """按 settings.log_raw_chunk_sample_rate 抽样记录上游原始分块"""
+    rate = settings.log_raw_chunk_sample_rate
+    return rate > 0 and (rate >= 1 or random.random() < rate)
+
+
+class StreamLog:
+    """单个流式请求的统计，结束时只输出一条汇总日志"""
+
+    __slots__ = ("model", "account", "stream", "start", "first_chunk_at", "chunks", "bytes", "usage")
+
+    def __init__(self, model: str, account: Optional[str], stream: bool = True):
+        self.model = model
+        self.account = account
+        self.stream = stream
+        self.start = time.perf_counter()
+        self.first_chunk_at: Optional[float] = None
+        self.chunks = 0
+        self.bytes = 0
+        self.usage: Optional[Dict[str, int]] = None
+
+    def on_usage(self, usage: Dict[str, int]):
+        self.usage = usage
+
+    def on_chunk(self, data: bytes):
+        if self.first_chunk_at is None:
+            # 内容之前的错误帧（及其后的结束标记）不算首字：失败的尝试不计首字延迟，也不计入输出分块 / 字节
+            if data.startswith(ERROR_FRAME_PREFIX) or data == DONE_CHUNK:
+                return
+            self.first_chunk_at = time.perf_counter()
+        self.chunks += 1
+        self.bytes += len(data)
+
+    def finish(self, outcome: Any):
+        end = time.perf_counter()
+        ttft = self.first_chunk_at - self.start if self.first_chunk_at else None
+        metrics.observe_chat(
+            self.model, self.account, self.stream, outcome, ttft, end - self.start, self.chunks, self.bytes, self.usage
+        )
+        ttft_ms = round(ttft * 1000, 1) if ttft is not None else None
+        fields = {
+            "stream": self.stream,
+            "model": self.model,
+            "account": self.account,
+            "ttft_ms": ttft_ms,
+            "duration_ms": round((end - self.start) * 1000, 1),
+            "chunks": self.chunks,
+            "bytes": self.bytes,
+            "prompt_tokens": self.usage["prompt_tokens"] if self.usage else None,
+            "completion_tokens": self.usage["completion_tokens"] if self.usage else None,
+            "outcome": outcome,
+        }
+        if settings.log_structured:
+            message = "chat completion"
+        else:
+            message = "chat completion " + " ".join(f"{key}={value}" for key, value in fields.items())
+        logger.info(message, extra={"fields": fields})
+
+
+class PhaseTimer:
+    """启动等一次性流程的分阶段计时，结束时只输出一条汇总日志"""
+
+    def __init__(self, name: str, start: Optional[float] = None):
+        self.name = name
+        self.start = start if start is not None else time.perf_counter()
+        self._last = self.start
+        self.phases: Dict[str, float] = {}
+
+    def mark(self, phase: str, now: Optional[float] = None):
+        """顺序执行的阶段：记录自上一个 mark 以来的耗时"""
+        now = now if now is not None else time.perf_counter()
+        self.phases[phase] = now - self._last
+        self._last = now
+
+    async def timed(self, phase: str, awaitable):
+        """并行执行的阶段：记录 awaitable 自身的耗时"""
+        start = time.perf_counter()
+        try:
+            return await awaitable
+        finally:
+            self.phases[phase] = time.perf_counter() - start
+
+    def report(self):
+        fields = {"phase": self.name, "total_ms": round((time.perf_counter() - self.start) * 1000, 1)}
+        fields.update({f"{phase}_ms": round(seconds * 1000, 1) for phase, seconds in self.phases.items()})
+        if settings.log_structured:
+            message = f"{self.name} timing"
+        else:
+            message = f"{self.name} timing " + " ".join(f"{key}={value}" for key, value in fields.items() if key != "phase")
+        logging.getLogger("puter.startup").info(message, extra={"fields": fields})
@@ -0,0 +1,256 @@
+import bisect
+import math
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+# Prometheus 文本格式指标。所有记录都发生在事件循环线程内，
+# 计数器就是普通 dict 上的加法，不加锁；抓取时才做格式化。
+
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _number(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class Counter:
+    merge = "sum"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, *labelvalues: str, amount: float = 1):
+        self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def total(self) -> float:
+        return sum(self._values.values())
+
+    def values(self) -> Dict[LabelValues, float]:
+        return self._values
+
+    def render(self, values: Optional[Dict[LabelValues, float]] = None) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} counter"
+        for labelvalues, value in (self._values if values is None else values).items():
+            yield f"{self.name}{_labels(self.labelnames, labelvalues)} {_number(value)}"
+
+
+class Histogram:
+    merge = "sum"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str], buckets: Sequence[float]):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = sorted(buckets)
+        # 每组标签：各桶的（非累计）计数 + 总和 + 总数
+        self._values: Dict[LabelValues, List[float]] = {}
+
+    def observe(self, value: float, *labelvalues: str):
+        data = self._values.get(labelvalues)
+        if data is None:
+            data = self._values[labelvalues] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+        data[bisect.bisect_left(self.buckets, value)] += 1
+        data[-2] += value
+        data[-1] += 1
+
+    def values(self) -> Dict[LabelValues, List[float]]:
+        return self._values
+
+    def render(self, values: Optional[Dict[LabelValues, List[float]]] = None) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} histogram"
+        bounds = self.buckets + [math.inf]
+        for labelvalues, data in (self._values if values is None else values).items():
+            cumulative = 0
+            for bound, count in zip(bounds, data):
+                cumulative += count
+                le = f'le="{_number(bound)}"'
+                yield f"{self.name}_bucket{_labels(self.labelnames, labelvalues, le)} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.labelnames, labelvalues)} {_number(data[-2])}"
+            yield f"{self.name}_count{_labels(self.labelnames, labelvalues)} {data[-1]}"
+
+
+class CallbackMetric:
+    """
+    抓取时才读取的指标（在途数、队列深度等已由其他模块维护的状态）。
+    merge 为多 worker 合并方式：sum（各进程相加）或 max（如各进程各自估计的阈值）。
+    """
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str],
+        collect: Callable[[], Dict[LabelValues, float]],
+        metric_type: str = "gauge",
+        merge: str = "sum"
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.collect = collect
+        self.metric_type = metric_type
+        self.merge = merge
+
+    def values(self) -> Dict[LabelValues, float]:
+        return self.collect()
+
+    def render(self, values: Optional[Dict[LabelValues, float]] = None) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.metric_type}"
+        for labelvalues, value in (self.collect() if values is None else values).items():
+            yield f"{self.name}{_labels(self.labelnames, labelvalues)} {_number(value)}"
+
+
+def _merge(metric, values: Dict, peers: Iterable[List]) -> Dict:
+    merged = {labelvalues: list(value) if isinstance(value, list) else value for labelvalues, value in values.items()}
+    for peer in peers:
+        for labelvalues, value in peer:
+            labelvalues = tuple(labelvalues)
+            current = merged.get(labelvalues)
+            if current is None:
+                merged[labelvalues] = list(value) if isinstance(value, list) else value
+            elif isinstance(current, list):
+                # 直方图：各桶计数、总和、总数逐项相加
+                merged[labelvalues] = [a + b for a, b in zip(current, value)]
+            elif metric.merge == "max":
+                merged[labelvalues] = max(current, value)
+            else:
+                merged[labelvalues] = current + value
+    return merged
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def snapshot(self) -> Dict[str, List]:
+        """本进程的全部指标值（可 JSON 序列化），多 worker 时经共享状态交给其他 worker 合并"""
+        return {
+            metric.name: [[list(labelvalues), value] for labelvalues, value in metric.values().items()]
+            for metric in self._metrics
+        }
+
+    def render(self, peers: Sequence[Dict[str, List]] = ()) -> str:
+        """peers 为其他 worker 的 snapshot，与本进程的值合并后输出"""
+        lines = []
+        for metric in self._metrics:
+            if peers:
+                lines.extend(metric.render(_merge(metric, metric.values(), (peer.get(metric.name, ()) for peer in peers))))
+            else:
+                lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+TTFT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32)
+DURATION_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 20, 40, 80, 160)
+
+chat_requests = registry.register(Counter(
+    "puter_chat_requests_total",
+    "Chat completions sent upstream, by outcome (upstream status code or cancelled)",
+    ("model", "account", "stream", "outcome"),
+))
+chat_shortcuts = registry.register(Counter(
+    "puter_chat_shortcuts_total",
+    "Chat completions answered without a new upstream call, or rejected before one",
+    ("kind",),
+))
+chat_ttft = registry.register(Histogram(
+    "puter_chat_ttft_seconds", "Time to first chunk", ("model", "account"), TTFT_BUCKETS,
+))
+chat_duration = registry.register(Histogram(
+    "puter_chat_duration_seconds", "Total chat completion duration", ("model", "account"), DURATION_BUCKETS,
+))
+chat_output_bytes = registry.register(Counter(
+    "puter_chat_output_bytes_total", "Bytes sent to clients by chat completions", ("model", "account"),
+))
+chat_chunks = registry.register(Counter(
+    "puter_chat_chunks_total", "Stream chunks sent to clients by chat completions", ("model", "account"),
+))
+chat_tokens = registry.register(Counter(
+    "puter_chat_tokens_total", "Prompt and completion tokens of chat completions", ("model", "account", "type"),
+))
+chat_hedges = registry.register(Counter(
+    "puter_chat_hedges_total",
+    "Hedged stream attempts: launched, won by the hedge, or skipped (budget / no idle account)",
+    ("model", "result"),
+))
+chat_failovers = registry.register(Counter(
+    "puter_chat_failovers_total",
+    "Chat requests retried on another account before any content was sent, by failed upstream status",
+    ("model", "status"),
+))
+chat_failover_skips = registry.register(Counter(
+    "puter_chat_failover_skips_total",
+    "Retryable chat failures returned to the client because no account was free for a retry, by upstream status",
+    ("model", "status"),
+))
+upstream_responses = registry.register(Counter(
+    "puter_upstream_responses_total",
+    "Upstream results by HTTP status (0 = connection failure, none = abandoned before a result)",
+    ("status",),
+))
+
+
+# model 标签只保留登记过的模型，其余（请求体中可以任意填写）统一记为 other，避免时间序列无限增长
+OTHER_MODEL = "other"
+_known_models: Set[str] = set()
+
+
+def register_models(models: Iterable[str]):
+    _known_models.update(models)
+
+
+def model_label(model: Optional[str]) -> str:
+    return model if model in _known_models else OTHER_MODEL
+
+
+def observe_chat(
+    model: str, account: str, stream: bool, outcome, ttft: float, duration: float, chunks: int, size: int,
+    usage: Optional[Dict[str, int]] = None
+):
+    """StreamLog.finish 调用：一次请求结束时更新全部请求级指标"""
+    account = account or ""
+    model = model_label(model)
+    chat_requests.inc(model, account, "true" if stream else "false", str(outcome))
+    if ttft is not None:
+        chat_ttft.observe(ttft, model, account)
+    chat_duration.observe(duration, model, account)
+    if size:
+        chat_output_bytes.inc(model, account, amount=size)
+        chat_chunks.inc(model, account, amount=chunks)
+    if usage:
+        chat_tokens.inc(model, account, "prompt", amount=usage["prompt_tokens"])
+        chat_tokens.inc(model, account, "completion", amount=usage["completion_tokens"])
+
+
+def api_requests(peers: Sequence[Dict[str, List]] = ()) -> int:
+    total = chat_requests.total() + chat_shortcuts.total()
+    for peer in peers:
+        for name in (chat_requests.name, chat_shortcuts.name):
+            total += sum(value for _, value in peer.get(name, ()))
+    return int(total)
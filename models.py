@@ -2,6 +2,7 @@ from sqlalchemy import Column, Integer, String, Boolean, DateTime, Text, JSON, F
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.sql import func
 import datetime
+import time
 
 Base = declarative_base()
 
@@ -98,4 +99,89 @@ class BrowserSession(Base):
             "status": self.status,
             "last_used": self.last_used.isoformat() if self.last_used else None,
             "created_at": self.created_at.isoformat() if self.created_at else None,
-        }
\ No newline at end of file
+        }
+def _now() -> int:
+    return int(time.time())
+
+class StoredFile(Base):
+    """/v1/files 上传的文件及批处理输出文件；时间为 Unix 秒，与 OpenAI 一致"""
+    __tablename__ = "files"
+    
+    id = Column(String(64), primary_key=True)
+    filename = Column(String(255))
+    purpose = Column(String(50), default="batch")  # batch, batch_output
+    bytes = Column(Integer, default=0)
+    path = Column(String(500), nullable=False)
+    
+    created_at = Column(Integer, default=_now)
+    
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "object": "file",
+            "bytes": self.bytes,
+            "created_at": self.created_at,
+            "filename": self.filename,
+            "purpose": self.purpose,
+        }
+
+class Batch(Base):
+    __tablename__ = "batches"
+    
+    id = Column(String(64), primary_key=True)
+    endpoint = Column(String(100), default="/v1/chat/completions")
+    input_file_id = Column(String(64), nullable=False)
+    output_file_id = Column(String(64))
+    error_file_id = Column(String(64))
+    completion_window = Column(String(20), default="24h")
+    status = Column(String(20), default="validating", index=True)  # validating, in_progress, finalizing, completed, failed, cancelling, cancelled
+    errors = Column(JSON)
+    batch_metadata = Column("metadata", JSON)
+    
+    # 进度与断点：输出/错误文件已落盘的字节数，与 batch_progress 中已完成的行在同一事务提交
+    total = Column(Integer, default=0)
+    completed = Column(Integer, default=0)
+    failed = Column(Integer, default=0)
+    output_offset = Column(Integer, default=0)
+    error_offset = Column(Integer, default=0)
+    
+    created_at = Column(Integer, default=_now)
+    in_progress_at = Column(Integer)
+    finalizing_at = Column(Integer)
+    completed_at = Column(Integer)
+    failed_at = Column(Integer)
+    cancelling_at = Column(Integer)
+    cancelled_at = Column(Integer)
+    
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "object": "batch",
+            "endpoint": self.endpoint,
+            "errors": self.errors,
+            "input_file_id": self.input_file_id,
+            "completion_window": self.completion_window,
+            "status": self.status,
+            "output_file_id": self.output_file_id,
+            "error_file_id": self.error_file_id,
+            "created_at": self.created_at,
+            "in_progress_at": self.in_progress_at,
+            "finalizing_at": self.finalizing_at,
+            "completed_at": self.completed_at,
+            "failed_at": self.failed_at,
+            "cancelling_at": self.cancelling_at,
+            "cancelled_at": self.cancelled_at,
+            "request_counts": {
+                "total": self.total,
+                "completed": self.completed,
+                "failed": self.failed,
+            },
+            "metadata": self.batch_metadata,
+        }
+
+class BatchProgress(Base):
+    """批处理中已写入结果的输入行号，重启后跳过这些行"""
+    __tablename__ = "batch_progress"
+    
+    batch_id = Column(String(64), ForeignKey("batches.id"), primary_key=True)
+    line_no = Column(Integer, primary_key=True)
@@ -1,29 +1,57 @@
+"""
+本地模拟的 Puter 上游（api.puter.com/drivers/call），用于压测网关而不消耗真实额度。
+
+聊天请求按设定的首字延迟和 token 速率输出 NDJSON（{"type": "text", "text": ...}），
+图片请求返回一张固定的 PNG。启动后把网关的 PUTER_API_BASE 指向它即可：
+
+    python providers.py --port 9100 --rate 50 --latency-ms 300 --tokens 200
+    PUTER_API_BASE=http://127.0.0.1:9100 python app.py
+"""
+import argparse
 import asyncio
+import base64
 import json
+import random
 import time
-import uuid
 import logging
 from typing import Dict, Any, AsyncGenerator, List, Optional
-from fastapi import HTTPException
-from fastapi.responses import StreamingResponse, JSONResponse
-
-from config import settings
-import sse_utils
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse, JSONResponse, Response
 
 logger = logging.getLogger(__name__)
 
+# 1x1 透明 PNG
+FAKE_PNG = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg=="
+)
+
 class BaseProvider:
     async def chat_completion(
         self,
         request_data: Dict[str, Any]
     ) -> StreamingResponse:
         raise NotImplementedError
-    
+
     async def get_models(self) -> JSONResponse:
         raise NotImplementedError
 
 class PuterProvider(BaseProvider):
-    def __init__(self):
+    """
+    模拟 Puter drivers/call 接口。
+    rate 为每秒输出的 token 数（0 表示不限速），latency 为首个 token 前的等待秒数，
+    latency_jitter 不为 0 时额外叠加均值为该值的指数分布延迟（模拟长尾）；
+    error_rate 为以 error_status 直接失败的请求比例。
+    """
+
+    def __init__(
+        self,
+        rate: float = 50.0,
+        latency: float = 0.3,
+        tokens: int = 100,
+        latency_jitter: float = 0.0,
+        error_rate: float = 0.0,
+        error_status: int = 500
+    ):
         self.default_model = "puter-ai-model"
         self.known_models = [
             "gpt-5-nano",
@@ -33,40 +61,68 @@ class PuterProvider(BaseProvider):
             "black-forest-labs/FLUX.2-max",
             "black-forest-labs/FLUX.1-schnell"
         ]
-    
+        self.rate = rate
+        self.latency = latency
+        self.tokens = tokens
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.calls = 0
+
+    def _response_tokens(self, model: str, messages: List[Dict[str, Any]]) -> List[str]:
+        user_message = messages[-1].get("content") if messages else "Hello"
+        if not isinstance(user_message, str):
+            user_message = json.dumps(user_message, ensure_ascii=False)
+        words = f"这是通过Puter.js AI模型 '{model}' 生成的模拟响应。用户说: {user_message}".split()
+        return [words[i % len(words)] + " " for i in range(self.tokens)]
+
+    def _first_token_delay(self) -> float:
+        delay = self.latency
+        if self.latency_jitter > 0:
+            delay += random.expovariate(1 / self.latency_jitter)
+        return delay
+
     async def chat_completion(self, request_data: Dict[str, Any]) -> StreamingResponse:
-        # 模拟流式响应，实际应调用Puter.js API
-        # 这里返回一个简单的模拟响应
-        
-        request_id = f"chatcmpl-{uuid.uuid4()}"
+        """request_data 为 drivers/call 的 args；按固定节奏输出，落后时把到期的 token 合并成一次写出"""
         model = request_data.get("model", self.default_model)
-        messages = request_data.get("messages", [])
-        user_message = messages[-1].get("content") if messages else "Hello"
-        
-        # 检查是否流式传输
-        stream = request_data.get("stream", False)
-        
-        if stream:
-            async def stream_generator() -> AsyncGenerator[bytes, None]:
-                # 模拟思考过程
-                response_text = f"这是通过Puter.js AI模型 '{model}' 生成的模拟响应。用户说: {user_message}"
-                words = response_text.split()
-                for word in words:
-                    chunk = sse_utils.create_chat_completion_chunk(request_id, model, word + " ")
-                    yield sse_utils.create_sse_data(chunk)
-                    await asyncio.sleep(0.05)
-                
-                final_chunk = sse_utils.create_chat_completion_chunk(request_id, model, "", "stop")
-                yield sse_utils.create_sse_data(final_chunk)
-                yield sse_utils.DONE_CHUNK
-            
-            return StreamingResponse(stream_generator(), media_type="text/event-stream")
-        else:
-            # 非流式响应
-            response_text = f"这是通过Puter.js AI模型 '{model}' 生成的模拟响应。用户说: {user_message}"
-            response_data = sse_utils.create_chat_completion_response(request_id, model, response_text)
-            return JSONResponse(content=response_data)
-    
+        tokens = self._response_tokens(model, request_data.get("messages", []))
+        lines = [(json.dumps({"type": "text", "text": token}, ensure_ascii=False) + "\n").encode("utf-8") for token in tokens]
+        interval = 1 / self.rate if self.rate > 0 else 0.0
+        delay = self._first_token_delay()
+
+        async def stream_generator() -> AsyncGenerator[bytes, None]:
+            await asyncio.sleep(delay)
+            start = time.monotonic()
+            sent = 0
+            while sent < len(lines):
+                due = len(lines) if not interval else min(len(lines), int((time.monotonic() - start) / interval) + 1)
+                if due > sent:
+                    yield b"".join(lines[sent:due])
+                    sent = due
+                else:
+                    await asyncio.sleep(start + sent * interval - time.monotonic())
+
+        return StreamingResponse(stream_generator(), media_type="application/x-ndjson")
+
+    async def generate_image(self, request_data: Dict[str, Any]) -> Response:
+        await asyncio.sleep(self._first_token_delay())
+        return Response(content=FAKE_PNG, media_type="image/png")
+
+    async def drivers_call(self, payload: Dict[str, Any]) -> Response:
+        self.calls += 1
+        if self.error_rate > 0 and random.random() < self.error_rate:
+            return JSONResponse(status_code=self.error_status, content={"success": False, "error": "injected error"})
+        if not payload.get("auth_token"):
+            return JSONResponse(status_code=401, content={"success": False, "error": "Missing auth token"})
+
+        interface = payload.get("interface")
+        args = payload.get("args") or {}
+        if interface == "puter-chat-completion":
+            return await self.chat_completion(args)
+        if interface == "puter-image-generation":
+            return await self.generate_image(args)
+        return JSONResponse(status_code=400, content={"success": False, "error": f"Unknown interface: {interface}"})
+
     async def get_models(self) -> JSONResponse:
         model_data = {
             "object": "list",
@@ -82,5 +138,50 @@ class PuterProvider(BaseProvider):
         }
         return JSONResponse(content=model_data)
 
+    def build_app(self) -> FastAPI:
+        app = FastAPI(title="Fake Puter upstream")
+
+        @app.post("/drivers/call")
+        async def drivers_call(request: Request):
+            return await self.drivers_call(await request.json())
+
+        # 网关启动时 HEAD / 预热连接
+        @app.api_route("/", methods=["GET", "HEAD"])
+        async def root():
+            return {"calls": self.calls}
+
+        @app.get("/models")
+        async def models():
+            return await self.get_models()
+
+        return app
+
 # 全局提供者实例
-provider = PuterProvider()
\ No newline at end of file
+provider = PuterProvider()
+
+def main(argv: Optional[List[str]] = None):
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="本地模拟 Puter 上游")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--rate", type=float, default=50.0, help="每秒输出的 token 数，0 表示不限速")
+    parser.add_argument("--latency-ms", type=float, default=300.0, help="首个 token 前的等待时间")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="首字延迟长尾（指数分布均值）")
+    parser.add_argument("--tokens", type=int, default=100, help="每个回答的 token 数")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=500)
+    args = parser.parse_args(argv)
+
+    fake = PuterProvider(
+        rate=args.rate,
+        latency=args.latency_ms / 1000,
+        tokens=args.tokens,
+        latency_jitter=args.jitter_ms / 1000,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+    )
+    uvicorn.run(fake.build_app(), host=args.host, port=args.port, log_level="warning", access_log=False)
+
+if __name__ == "__main__":
+    main()
@@ -1,217 +1,317 @@
-import json
-import httpx
-import time
-import logging
-import asyncio
-from typing import List, Dict, Any, AsyncGenerator, Optional
-
-logger = logging.getLogger(__name__)
-
-class PuterBridge:
-    UPSTREAM_URL = "https://api.puter.com/drivers/call"
-    
-    # 从JS配置中移植的模型列表
-    CHAT_MODELS = [
-        "gpt-4o-mini", "gpt-4o", "claude-3-5-sonnet",
-        "gemini-2.0-flash", "deepseek-chat", "deepseek-reasoner",
-        "gpt-4o-2024-11-20", "o1", "o1-mini", "o1-pro", "o3-mini",
-        "claude-3-5-sonnet-20241022", "claude-3-5-haiku-20241022",
-        "claude-3-7-sonnet-20250219", "claude-3-7-sonnet-latest",
-        "gemini-2.0-flash-lite-001", "gemini-2.0-flash-001",
-        "grok-2", "grok-2-vision", "grok-3", "grok-3-mini",
-        "mistral-large-latest", "mistral-small-latest",
-        "qwen-2.5-72b-instruct", "qwen-2.5-coder-32b-instruct",
-        "llama-3.1-405b-instruct", "llama-3.3-70b-instruct"
-    ]
-    
-    IMAGE_MODELS = ["gpt-image-1"]
-    
-    DEFAULT_CHAT_MODEL = "gpt-4o-mini"
-    DEFAULT_IMAGE_MODEL = "gpt-image-1"
-
-    @staticmethod
-    def _get_driver_from_model(model: str) -> str:
-        if model.startswith(("gpt", "o1", "o3", "o4")): return "openai-completion"
-        if model.startswith("claude"): return "claude"
-        if model.startswith("gemini"): return "gemini"
-        if model.startswith("grok"): return "xai"
-        return "openai-completion"
-
-    @staticmethod
-    def _create_upstream_headers() -> Dict[str, str]:
-        return {
-            "Content-Type": "application/json",
-            "Accept": "*/*",
-            "Origin": "https://docs.puter.com",
-            "Referer": "https://docs.puter.com/",
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
-        }
-
-    @classmethod
-    async def chat_completion_stream(cls, request_data: Dict[str, Any], token: str) -> AsyncGenerator[str, None]:
-        if not token:
-            yield f"data: {json.dumps({'error': 'No available account token'})}\n\n"
-            return
-
-        model = request_data.get("model", cls.DEFAULT_CHAT_MODEL)
-        payload = {
-            "interface": "puter-chat-completion",
-            "driver": cls._get_driver_from_model(model),
-            "test_mode": False,
-            "method": "complete",
-            "args": {
-                "messages": request_data.get("messages", []),
-                "model": model,
-                "stream": True
-            },
-            "auth_token": token
-        }
-
-        async with httpx.AsyncClient() as client:
-            try:
-                async with client.stream("POST", cls.UPSTREAM_URL, json=payload, headers=cls._create_upstream_headers(), timeout=60.0) as response:
-                    if response.status_code != 200:
-                        error_text = await response.aread()
-                        logger.error(f"Upstream error: {response.status_code} - {error_text}")
-                        yield f"data: {json.dumps({'error': f'Upstream error: {response.status_code}'})}\n\n"
-                        return
-
-                    async for line in response.aiter_lines():
-                        if not line or not line.strip():
-                            continue
-                        
-                        try:
-                            # Puter returns raw JSON streams (NDJSON), not SSE "data: ..." format
-                            data = json.loads(line)
-                            logger.info(f"Puter Raw Chunk: {data}")
-                            
-                            # Handle upstream errors (e.g. Model not found)
-                            if isinstance(data, dict) and (data.get("error") or data.get("success") is False):
-                                error_msg = data.get("error", "Unknown upstream error")
-                                logger.error(f"Puter API Error: {error_msg}")
-                                yield f"data: {json.dumps({'error': error_msg})}\n\n"
-                                return
-
-                            if data.get("type") == "text" and isinstance(data.get("text"), str):
-                                chunk = {
-                                    "id": f"chatcmpl-{int(time.time())}",
-                                    "object": "chat.completion.chunk",
-                                    "created": int(time.time()),
-                                    "model": model,
-                                    "choices": [{
-                                        "index": 0,
-                                        "delta": {"content": data["text"]},
-                                        "finish_reason": None
-                                    }]
-                                }
-                                yield f"data: {json.dumps(chunk)}\n\n"
-                        except json.JSONDecodeError:
-                            continue
-                    
-                    # End of stream
-                    final_chunk = {
-                        "id": f"chatcmpl-{int(time.time())}",
-                        "object": "chat.completion.chunk",
-                        "created": int(time.time()),
-                        "model": model,
-                        "choices": [{
-                            "index": 0,
-                            "delta": {},
-                            "finish_reason": "stop"
-                        }]
-                    }
-                    yield f"data: {json.dumps(final_chunk)}\n\n"
-                    yield "data: [DONE]\n\n"
-
-            except Exception as e:
-                logger.error(f"Stream error: {e}")
-                yield f"data: {json.dumps({'error': str(e)})}\n\n"
-
-    @classmethod
-    async def chat_completion(cls, request_data: Dict[str, Any], token: str) -> Dict[str, Any]:
-        # Non-streaming implementation (wraps internal call)
-        # For simplicity, we can reuse the stream generator or implement a separate call
-        # But Puter API seems to favor streaming in the referenced JS code (stream: true is hardcoded in JS payload helper for chat)
-        # So we'll accumulate the stream.
-        
-        full_content = ""
-        model = request_data.get("model", cls.DEFAULT_CHAT_MODEL)
-        
-        async for chunk_str in cls.chat_completion_stream(request_data, token):
-            if chunk_str.startswith("data: ") and not chunk_str.strip().endswith("[DONE]"):
-                try:
-                    chunk_json = json.loads(chunk_str[6:])
-                    if "choices" in chunk_json:
-                        delta = chunk_json["choices"][0].get("delta", {})
-                        full_content += delta.get("content", "")
-                except:
-                    pass
-        
-        return {
-            "id": f"chatcmpl-{int(time.time())}",
-            "object": "chat.completion",
-            "created": int(time.time()),
-            "model": model,
-            "choices": [{
-                "index": 0,
-                "message": {
-                    "role": "assistant",
-                    "content": full_content
-                },
-                "finish_reason": "stop"
-            }],
-            "usage": {
-                "prompt_tokens": 0,
-                "completion_tokens": 0, # Calculation would require tokenizer
-                "total_tokens": 0
-            }
-        }
-
-    @classmethod
-    async def generate_image(cls, request_data: Dict[str, Any], token: str) -> Dict[str, Any]:
-        if not token:
-            raise ValueError("No available account token")
-
-        model = request_data.get("model", cls.DEFAULT_IMAGE_MODEL)
-        payload = {
-            "interface": "puter-image-generation",
-            "driver": "openai-image-generation",
-            "test_mode": False,
-            "method": "generate",
-            "args": {
-                "model": model,
-                "quality": request_data.get("quality", "high"),
-                "prompt": request_data.get("prompt")
-            },
-            "auth_token": token
-        }
-
-        async with httpx.AsyncClient() as client:
-            response = await client.post(cls.UPSTREAM_URL, json=payload, headers=cls._create_upstream_headers(), timeout=120.0)
-            
-            if response.status_code != 200:
-                raise Exception(f"Upstream error: {response.status_code} - {response.text}")
-            
-            # Puter returns raw binary image data
-            import base64
-            b64_json = base64.b64encode(response.content).decode('utf-8')
-            
-            return {
-                "created": int(time.time()),
-                "data": [{"b64_json": b64_json}]
-            }
-
-    @classmethod
-    def get_models(cls) -> Dict[str, Any]:
-        all_models = cls.CHAT_MODELS + cls.IMAGE_MODELS
-        return {
-            "object": "list",
-            "data": [
-                {
-                    "id": m,
-                    "object": "model",
-                    "created": int(time.time()),
-                    "owned_by": "puter-bridge"
-                } for m in all_models
-            ]
-        }
+import json
+import httpx
+import time
+import logging
+import asyncio
+from typing import List, Dict, Any, AsyncGenerator, Optional, Callable
+
+from config import settings
+from http_client import UpstreamClientPool
+import sse_utils
+from image_store import image_store, encode_stream, Base64Builder, IMAGE_ROUTE
+from log_utils import sample_raw_chunk
+from coalesce import CoalesceOptions, coalesce_text
+import token_usage
+import metrics
+
+logger = logging.getLogger(__name__)
+
+class UpstreamError(Exception):
+    """上游请求失败；status_code 为上游 HTTP 状态，0 表示连接失败"""
+
+    def __init__(self, message: Any, status_code: int):
+        super().__init__(str(message))
+        self.message = message
+        self.status_code = status_code
+
+    @property
+    def http_status(self) -> int:
+        # 返回给客户端的状态码：限流透传，其余统一视为网关错误
+        return 429 if self.status_code == 429 else 502
+
+    def to_openai(self) -> Dict[str, Any]:
+        message = self.message
+        if isinstance(message, dict) and isinstance(message.get("message"), str):
+            message = message["message"]
+        elif not isinstance(message, str):
+            message = json.dumps(message, ensure_ascii=False)
+        return {
+            "error": {
+                "message": message,
+                "type": "upstream_error",
+                "code": self.status_code,
+            }
+        }
+
+class PuterBridge:
+    UPSTREAM_PATH = "/drivers/call"
+    
+    # 从JS配置中移植的模型列表
+    CHAT_MODELS = [
+        "gpt-4o-mini", "gpt-4o", "claude-3-5-sonnet",
+        "gemini-2.0-flash", "deepseek-chat", "deepseek-reasoner",
+        "gpt-4o-2024-11-20", "o1", "o1-mini", "o1-pro", "o3-mini",
+        "claude-3-5-sonnet-20241022", "claude-3-5-haiku-20241022",
+        "claude-3-7-sonnet-20250219", "claude-3-7-sonnet-latest",
+        "gemini-2.0-flash-lite-001", "gemini-2.0-flash-001",
+        "grok-2", "grok-2-vision", "grok-3", "grok-3-mini",
+        "mistral-large-latest", "mistral-small-latest",
+        "qwen-2.5-72b-instruct", "qwen-2.5-coder-32b-instruct",
+        "llama-3.1-405b-instruct", "llama-3.3-70b-instruct"
+    ]
+    
+    IMAGE_MODELS = ["gpt-image-1"]
+    
+    DEFAULT_CHAT_MODEL = "gpt-4o-mini"
+    DEFAULT_IMAGE_MODEL = "gpt-image-1"
+
+    @staticmethod
+    def _get_driver_from_model(model: str) -> str:
+        if model.startswith(("gpt", "o1", "o3", "o4")): return "openai-completion"
+        if model.startswith("claude"): return "claude"
+        if model.startswith("gemini"): return "gemini"
+        if model.startswith("grok"): return "xai"
+        return "openai-completion"
+
+    @classmethod
+    def upstream_url(cls) -> str:
+        return settings.puter_api_base.rstrip("/") + cls.UPSTREAM_PATH
+
+    @staticmethod
+    def _create_upstream_headers() -> Dict[str, str]:
+        return {
+            "Content-Type": "application/json",
+            "Accept": "*/*",
+            "Origin": "https://docs.puter.com",
+            "Referer": "https://docs.puter.com/",
+            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+        }
+
+    @staticmethod
+    def _error_status(data: Dict[str, Any]) -> int:
+        # 流内错误帧：优先使用其中的 HTTP 状态，否则视为请求本身的问题（不触发熔断）
+        error = data.get("error")
+        for source in (error if isinstance(error, dict) else {}, data):
+            status = source.get("status") or source.get("code")
+            if isinstance(status, int):
+                return status
+        return 400
+
+    @classmethod
+    def _chat_payload(cls, request_data: Dict[str, Any], token: str, model: str) -> Dict[str, Any]:
+        return {
+            "interface": "puter-chat-completion",
+            "driver": cls._get_driver_from_model(model),
+            "test_mode": False,
+            "method": "complete",
+            "args": {
+                "messages": request_data.get("messages", []),
+                "model": model,
+                "stream": True
+            },
+            "auth_token": token
+        }
+
+    @classmethod
+    async def _iter_upstream_text(
+        cls,
+        request_data: Dict[str, Any],
+        token: str,
+        model: str,
+        report: Callable[[int], None]
+    ) -> AsyncGenerator[str, None]:
+        """读取上游 NDJSON，逐个产出文本片段；失败时上报状态并抛出 UpstreamError"""
+        payload = cls._chat_payload(request_data, token, model)
+        client = UpstreamClientPool.get_client()
+        try:
+            async with client.stream("POST", cls.upstream_url(), json=payload, headers=cls._create_upstream_headers()) as response:
+                if response.status_code != 200:
+                    error_text = await response.aread()
+                    logger.error(f"Upstream error: {response.status_code} - {error_text}")
+                    report(response.status_code)
+                    raise UpstreamError(f"Upstream error: {response.status_code}", response.status_code)
+
+                async for line in response.aiter_lines():
+                    if not line or not line.strip():
+                        continue
+                    
+                    try:
+                        # Puter returns raw JSON streams (NDJSON), not SSE "data: ..." format
+                        data = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if sample_raw_chunk():
+                        logger.info("Puter Raw Chunk: %s", line)
+                    if not isinstance(data, dict):
+                        continue
+
+                    # Handle upstream errors (e.g. Model not found)
+                    if data.get("error") or data.get("success") is False:
+                        error_msg = data.get("error", "Unknown upstream error")
+                        logger.error(f"Puter API Error: {error_msg}")
+                        status_code = cls._error_status(data)
+                        report(status_code)
+                        raise UpstreamError(error_msg, status_code)
+
+                    if data.get("type") == "text" and isinstance(data.get("text"), str):
+                        yield data["text"]
+
+                report(200)
+        except UpstreamError:
+            raise
+        except Exception as e:
+            logger.error(f"Stream error: {e}")
+            report(0)
+            raise UpstreamError(str(e), 0) from e
+
+    @classmethod
+    async def chat_completion_stream(
+        cls,
+        request_data: Dict[str, Any],
+        token: str,
+        on_status: Optional[Callable[[int], None]] = None,
+        on_text: Optional[Callable[[str], None]] = None,
+        coalesce: Optional[CoalesceOptions] = None,
+        on_usage: Optional[Callable[[Dict[str, int]], None]] = None
+    ) -> AsyncGenerator[bytes, None]:
+        # on_status 接收上游结果状态码（0 表示连接失败），供账号熔断使用
+        # on_text 接收每个文本片段，供回答缓存等收集完整内容
+        # coalesce 不为 None 时把高频的小片段合并成较少的 SSE 帧
+        # on_usage 在流结束（含中途失败）时接收 token 用量，供按账号统计
+        report = on_status or (lambda status_code: None)
+        if not token:
+            yield sse_utils.create_sse_data(UpstreamError("No available account token", 0).to_openai())
+            yield sse_utils.DONE_CHUNK
+            return
+
+        model = request_data.get("model", cls.DEFAULT_CHAT_MODEL)
+        include_usage = token_usage.include_usage(request_data)
+        encoder = sse_utils.ChunkEncoder(model, include_usage=include_usage)
+        # 输出 token 随每个片段增量累计，提示词 token 在结束时计算一次（历史消息的计数有缓存）
+        counter = token_usage.CompletionCounter()
+        texts = cls._iter_upstream_text(request_data, token, model, report)
+        if coalesce is not None:
+            texts = coalesce_text(texts, coalesce)
+        try:
+            async for text in texts:
+                counter.add(text)
+                if on_text is not None:
+                    on_text(text)
+                yield encoder.content(text)
+        except UpstreamError as e:
+            # 内容开始之后的失败同样以 OpenAI 格式的错误帧 + [DONE] 结束流，客户端不会停在半截
+            if on_usage is not None:
+                on_usage(token_usage.stream_usage(request_data.get("messages"), counter))
+            yield sse_utils.create_sse_data(e.to_openai())
+            yield sse_utils.DONE_CHUNK
+            return
+        finally:
+            # 客户端断开时生成器在 yield 处被关闭，这里同步关闭上游流而不是等待垃圾回收
+            await texts.aclose()
+
+        # End of stream
+        usage = token_usage.stream_usage(request_data.get("messages"), counter)
+        if on_usage is not None:
+            on_usage(usage)
+        yield encoder.finish("stop")
+        if include_usage:
+            yield encoder.usage(usage)
+        yield sse_utils.DONE_CHUNK
+
+    @classmethod
+    async def chat_completion(
+        cls,
+        request_data: Dict[str, Any],
+        token: str,
+        on_status: Optional[Callable[[int], None]] = None
+    ) -> Dict[str, Any]:
+        """非流式：一次读完上游 NDJSON，片段收集到列表后拼接；上游失败时抛出 UpstreamError"""
+        if not token:
+            raise UpstreamError("No available account token", 0)
+
+        report = on_status or (lambda status_code: None)
+        model = request_data.get("model", cls.DEFAULT_CHAT_MODEL)
+        fragments = [text async for text in cls._iter_upstream_text(request_data, token, model, report)]
+        content = "".join(fragments)
+        
+        return sse_utils.create_chat_completion_response(
+            sse_utils.new_request_id(), model, content,
+            usage=token_usage.usage_for(request_data.get("messages"), content)
+        )
+
+    @classmethod
+    async def generate_image(
+        cls,
+        request_data: Dict[str, Any],
+        token: str,
+        on_status: Optional[Callable[[int], None]] = None,
+        response_format: str = "b64_json",
+        cache_key: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """
+        response_format 为 "url" 时图片保存到 cache_dir/images，返回相对 URL；否则返回 b64_json。
+        cache_key 不为空时图片按该键保存到图片缓存。
+        """
+        report = on_status or (lambda status_code: None)
+        if not token:
+            raise ValueError("No available account token")
+
+        model = request_data.get("model", cls.DEFAULT_IMAGE_MODEL)
+        payload = {
+            "interface": "puter-image-generation",
+            "driver": "openai-image-generation",
+            "test_mode": False,
+            "method": "generate",
+            "args": {
+                "model": model,
+                "quality": request_data.get("quality", "high"),
+                "prompt": request_data.get("prompt")
+            },
+            "auth_token": token
+        }
+
+        client = UpstreamClientPool.get_client()
+        try:
+            async with client.stream("POST", cls.upstream_url(), json=payload, headers=cls._create_upstream_headers(), timeout=UpstreamClientPool.timeout(120.0)) as response:
+                report(response.status_code)
+                if response.status_code != 200:
+                    error_text = (await response.aread()).decode("utf-8", errors="replace")
+                    raise Exception(f"Upstream error: {response.status_code} - {error_text}")
+
+                # Puter returns raw binary image data：边读边写文件或边读边编码，不保留整张原图
+                content_type = response.headers.get("content-type")
+                if response_format == "url":
+                    name = await image_store.save_stream(response.aiter_bytes(), content_type, key=cache_key)
+                    item = {"url": f"{IMAGE_ROUTE}/{name}"}
+                elif cache_key:
+                    # 写入图片缓存的同时增量编码
+                    builder = Base64Builder()
+                    await image_store.save_stream(response.aiter_bytes(), content_type, key=cache_key, on_chunk=builder.feed)
+                    item = {"b64_json": builder.result()}
+                else:
+                    item = {"b64_json": await encode_stream(response.aiter_bytes())}
+        except httpx.HTTPError:
+            report(0)
+            raise
+
+        return {
+            "created": int(time.time()),
+            "data": [item]
+        }
+
+    @classmethod
+    def get_models(cls) -> Dict[str, Any]:
+        all_models = cls.CHAT_MODELS + cls.IMAGE_MODELS
+        return {
+            "object": "list",
+            "data": [
+                {
+                    "id": m,
+                    "object": "model",
+                    "created": int(time.time()),
+                    "owned_by": "puter-bridge"
+                } for m in all_models
+            ]
+        }
+
+metrics.register_models(PuterBridge.CHAT_MODELS)
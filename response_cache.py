@@ -0,0 +1,206 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, AsyncGenerator, Dict, Optional, Tuple
+
+from config import settings
+import sse_utils
+
+logger = logging.getLogger(__name__)
+
+# 参与缓存键计算的请求字段（消息和采样参数）
+KEY_FIELDS = (
+    "model", "messages", "temperature", "top_p", "max_tokens", "max_completion_tokens",
+    "stop", "seed", "presence_penalty", "frequency_penalty", "n",
+    "tools", "tool_choice", "response_format",
+)
+
+# 客户端通过该请求头控制缓存：force 强制缓存，bypass 跳过缓存
+CACHE_CONTROL_HEADER = "X-Cache-Control"
+CACHE_STATUS_HEADER = "X-Cache"
+
+
+def make_cache_key(request_data: Dict[str, Any], default_model: str) -> str:
+    canonical = {field: request_data.get(field) for field in KEY_FIELDS if request_data.get(field) is not None}
+    canonical.setdefault("model", default_model)
+    encoded = json.dumps(canonical, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+def is_deterministic(request_data: Dict[str, Any]) -> bool:
+    """temperature=0 且单个候选：相同请求应得到相同回答，可以复用或共享"""
+    if request_data.get("n") not in (None, 1):
+        return False
+    try:
+        return float(request_data.get("temperature")) == 0.0
+    except (TypeError, ValueError):
+        return False
+
+
+def is_cacheable(request_data: Dict[str, Any], cache_control: Optional[str] = None) -> bool:
+    """只缓存确定性请求，或客户端显式要求"""
+    if not settings.response_cache_enabled:
+        return False
+    control = (cache_control or "").strip().lower()
+    if control == "bypass":
+        return False
+    if control == "force":
+        return True
+    return is_deterministic(request_data)
+
+
+class ResponseCache:
+    """精确匹配的回答缓存：内存 LRU + 磁盘（大小上限、LRU 淘汰），两级都带 TTL"""
+
+    def __init__(self, directory: str):
+        self.directory = Path(directory)
+        self._memory: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        # 磁盘索引 key -> 文件大小，顺序即 LRU 顺序
+        self._disk_index: "OrderedDict[str, int]" = OrderedDict()
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+
+    def _path(self, key: str) -> Path:
+        return self.directory / key[:2] / f"{key}.json"
+
+    # ---- 内存层 ----
+
+    def _memory_get(self, key: str, now: float) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            item = self._memory.get(key)
+            if item is None:
+                return None
+            stored_at, entry = item
+            if now - stored_at > settings.response_cache_ttl:
+                del self._memory[key]
+                return None
+            self._memory.move_to_end(key)
+            return entry
+
+    def _memory_put(self, key: str, entry: Dict[str, Any], stored_at: float):
+        with self._lock:
+            self._memory[key] = (stored_at, entry)
+            self._memory.move_to_end(key)
+            while len(self._memory) > settings.response_cache_memory_entries:
+                self._memory.popitem(last=False)
+
+    # ---- 磁盘层（在线程池中执行）----
+
+    def load_index(self):
+        """启动时扫描缓存目录重建磁盘索引，按最后访问时间排序"""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        files = []
+        for path in self.directory.glob("*/*.json"):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            files.append((stat.st_mtime, path.stem, stat.st_size))
+        files.sort()
+        with self._lock:
+            self._disk_index = OrderedDict((key, size) for _, key, size in files)
+            self._disk_bytes = sum(size for _, _, size in files)
+        logger.info(f"回答缓存磁盘索引: {len(files)} 项, {self._disk_bytes} 字节")
+
+    def _disk_get(self, key: str, now: float) -> Optional[Tuple[float, Dict[str, Any]]]:
+        with self._lock:
+            if key not in self._disk_index:
+                return None
+        path = self._path(key)
+        try:
+            record = json.loads(path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            self._disk_forget(key)
+            return None
+        if now - record["stored_at"] > settings.response_cache_ttl:
+            self._disk_remove(key)
+            return None
+        try:
+            os.utime(path)  # 用 mtime 记录最近访问，重启后仍能按 LRU 淘汰
+        except OSError:
+            pass
+        with self._lock:
+            if key in self._disk_index:
+                self._disk_index.move_to_end(key)
+        return record["stored_at"], record["entry"]
+
+    def _disk_put(self, key: str, entry: Dict[str, Any], stored_at: float):
+        data = json.dumps({"stored_at": stored_at, "entry": entry}, ensure_ascii=False).encode("utf-8")
+        if len(data) > settings.response_cache_disk_max_bytes:
+            return
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(".tmp")
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, path)
+
+        evicted = []
+        with self._lock:
+            self._disk_bytes -= self._disk_index.pop(key, 0)
+            self._disk_index[key] = len(data)
+            self._disk_bytes += len(data)
+            while self._disk_bytes > settings.response_cache_disk_max_bytes and self._disk_index:
+                old_key, size = self._disk_index.popitem(last=False)
+                self._disk_bytes -= size
+                evicted.append(old_key)
+        for old_key in evicted:
+            self._path(old_key).unlink(missing_ok=True)
+
+    def _disk_forget(self, key: str):
+        with self._lock:
+            self._disk_bytes -= self._disk_index.pop(key, 0)
+
+    def _disk_remove(self, key: str):
+        self._disk_forget(key)
+        self._path(key).unlink(missing_ok=True)
+
+    # ---- 对外接口 ----
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        entry = self._memory_get(key, now)
+        if entry is not None:
+            return entry
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(None, self._disk_get, key, now)
+        if result is None:
+            return None
+        stored_at, entry = result
+        self._memory_put(key, entry, stored_at)
+        return entry
+
+    async def put(self, key: str, model: str, content: str):
+        entry = {"model": model, "content": content}
+        stored_at = time.time()
+        self._memory_put(key, entry, stored_at)
+        try:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self._disk_put, key, entry, stored_at)
+        except OSError as e:
+            logger.error(f"写入回答缓存失败: {e}")
+
+
+async def render_sse(entry: Dict[str, Any], usage: Optional[Dict[str, int]] = None) -> AsyncGenerator[bytes, None]:
+    """把缓存的回答按普通 SSE 流返回；usage 不为 None 时（stream_options.include_usage）在结束前附带用量分块"""
+    encoder = sse_utils.ChunkEncoder(entry["model"], include_usage=usage is not None)
+    yield encoder.content(entry["content"])
+    yield encoder.finish("stop")
+    if usage is not None:
+        yield encoder.usage(usage)
+    yield sse_utils.DONE_CHUNK
+
+
+def render_json(entry: Dict[str, Any], usage: Optional[Dict[str, int]] = None) -> Dict[str, Any]:
+    return sse_utils.create_chat_completion_response(
+        sse_utils.new_request_id(), entry["model"], entry["content"], usage=usage
+    )
+
+
+# 全局回答缓存实例
+response_cache = ResponseCache(os.path.join(settings.cache_dir, "responses"))
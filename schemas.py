@@ -117,4 +117,11 @@ class ImageGenerationRequest(BaseModel):
     height: Optional[int] = 512
     steps: Optional[int] = 30
     seed: Optional[int] = None
-    disable_safety_checker: bool = True
\ No newline at end of file
+    disable_safety_checker: bool = True
+    response_format: Optional[str] = "b64_json"  # "url" 时返回图片链接，"b64_json" 时内嵌 base64
+
+class BatchCreate(BaseModel):
+    input_file_id: str
+    endpoint: str = "/v1/chat/completions"
+    completion_window: str = "24h"
+    metadata: Optional[Dict[str, str]] = None
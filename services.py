@@ -2,27 +2,44 @@ import os
 import json
 import shutil
 import asyncio
+import time
+import uuid
+from datetime import datetime
 from pathlib import Path
-from sqlalchemy.orm import Session
+from sqlalchemy import func, select, update
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 import logging
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, List, Container
 
 from config import settings
-from models import Account, AppConfig, BrowserSession
+from models import Account, AppConfig, BrowserSession, StoredFile, Batch
+from database import AsyncSessionLocal
 from puter_bridge import PuterBridge
+from account_pool import account_pool, PooledAccount
+from shared_state import shared_state
+from admission import admission, AdmissionRejected, DEFAULT_LANE
+from circuit_breaker import STATE_BY_ACCOUNT_STATUS
+from stats_buffer import stats_buffer
+from config_cache import config_cache
+import metrics
+from image_store import image_store, make_image_key, IMAGE_ROUTE
 import schemas
-import random
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# 共享状态中账号列表与配置的版本名
+ACCOUNTS_VERSION = "accounts"
+CONFIG_VERSION = "config"
+
 # 账号服务
 class AccountService:
     @staticmethod
-    def create_account(db: Session, account_data: schemas.AccountCreate) -> Account:
+    async def create_account(db: AsyncSession, account_data: schemas.AccountCreate) -> Account:
         # 创建账号文件夹
-        account_dir_name = f"账号{db.query(Account).count() + 1:03d}"
+        account_count = (await db.execute(select(func.count(Account.id)))).scalar() or 0
+        account_dir_name = f"账号{account_count + 1:03d}"
         account_dir = Path(settings.accounts_dir) / account_dir_name
         account_dir.mkdir(parents=True, exist_ok=True)
         
@@ -44,85 +61,84 @@ class AccountService:
         
         try:
             db.add(account)
-            db.commit()
-            db.refresh(account)
+            await db.commit()
+            await db.refresh(account)
+            account_pool.upsert(account)
+            AccountService.notify_pool_changed()
             logger.info(f"账号创建成功: {account.name}")
             return account
         except IntegrityError:
-            db.rollback()
+            await db.rollback()
             raise ValueError(f"账号名称已存在: {account_data.name}")
     
     @staticmethod
-    def get_account(db: Session, account_id: int) -> Optional[Account]:
-        return db.query(Account).filter(Account.id == account_id).first()
+    async def get_account(db: AsyncSession, account_id: int) -> Optional[Account]:
+        return await db.get(Account, account_id)
     
     @staticmethod
-    def get_account_by_name(db: Session, name: str) -> Optional[Account]:
-        return db.query(Account).filter(Account.name == name).first()
+    async def get_account_by_name(db: AsyncSession, name: str) -> Optional[Account]:
+        result = await db.execute(select(Account).where(Account.name == name))
+        return result.scalars().first()
     
     @staticmethod
-    def list_accounts(db: Session, skip: int = 0, limit: int = 100) -> List[Account]:
-        return db.query(Account).offset(skip).limit(limit).all()
+    async def list_accounts(db: AsyncSession, skip: int = 0, limit: int = 100) -> List[Account]:
+        result = await db.execute(select(Account).offset(skip).limit(limit))
+        return result.scalars().all()
     
     @staticmethod
-    def update_account(db: Session, account_id: int, update_data: schemas.AccountUpdate) -> Optional[Account]:
-        account = AccountService.get_account(db, account_id)
+    async def update_account(db: AsyncSession, account_id: int, update_data: schemas.AccountUpdate) -> Optional[Account]:
+        account = await AccountService.get_account(db, account_id)
         if not account:
             return None
         
         for key, value in update_data.dict(exclude_unset=True).items():
             setattr(account, key, value)
         
-        db.commit()
-        db.refresh(account)
+        await db.commit()
+        await db.refresh(account)
+        account_pool.upsert(account)
+        AccountService.notify_pool_changed()
         return account
     
     @staticmethod
-    def delete_account(db: Session, account_id: int) -> bool:
-        account = AccountService.get_account(db, account_id)
+    async def delete_account(db: AsyncSession, account_id: int) -> bool:
+        account = await AccountService.get_account(db, account_id)
         if not account:
             return False
         
         # 删除本地文件夹
         if account.data_dir and Path(account.data_dir).exists():
-            shutil.rmtree(account.data_dir, ignore_errors=True)
+            await asyncio.get_running_loop().run_in_executor(
+                None, lambda: shutil.rmtree(account.data_dir, ignore_errors=True)
+            )
         
-        db.delete(account)
-        db.commit()
+        await db.delete(account)
+        await db.commit()
+        account_pool.remove(account_id)
+        AccountService.notify_pool_changed()
         return True
     
     @staticmethod
-    def update_account_stats(db: Session, account_id: int, success: bool = True):
-        account = AccountService.get_account(db, account_id)
-        if not account:
-            return
-        
-        account.total_calls += 1
-        if success:
-            account.success_calls += 1
-            account.last_success = __import__("datetime").datetime.now()
-        else:
-            account.failed_calls += 1
-            account.last_failure = __import__("datetime").datetime.now()
-        
-        db.commit()
+    def update_account_stats(account_id: int, success: bool = True):
+        # 只记录到内存，由 stats_buffer 定期批量写入数据库
+        stats_buffer.record(account_id, success)
 
     @staticmethod
-    def bind_account(db: Session, account_id: int, puter_user_data: Dict[str, Any]) -> Optional[Account]:
-        account = AccountService.get_account(db, account_id)
+    async def bind_account(db: AsyncSession, account_id: int, puter_user_data: Dict[str, Any]) -> Optional[Account]:
+        account = await AccountService.get_account(db, account_id)
         if not account:
             return None
             
         # 更新账号状态
         account.is_active = True
         account.status = "active"
-        account.last_success = __import__("datetime").datetime.now()
+        account.last_success = datetime.now()
         
-        # 更新认证数据
-        current_auth_data = account.auth_data or {}
+        # 更新认证数据（复制一份，JSON 列原地修改不会被识别为变更）
+        current_auth_data = dict(account.auth_data or {})
         current_auth_data.update({
             "puter_user": puter_user_data,
-            "bound_at": __import__("datetime").datetime.now().isoformat(),
+            "bound_at": datetime.now().isoformat(),
             "source": "puter.js_sdk"
         })
         account.auth_data = current_auth_data
@@ -134,36 +150,110 @@ class AccountService:
         if puter_user_data.get("token"):
              account.auth_token = puter_user_data.get("token")
 
-        db.commit()
-        db.refresh(account)
+        await db.commit()
+        await db.refresh(account)
+        account_pool.upsert(account)
+        AccountService.notify_pool_changed()
         return account
 
     @staticmethod
-    def get_next_token(db: Session) -> Optional[str]:
-        # 获取所有活跃且有Token的账号
-        accounts = db.query(Account).filter(
-            Account.status == "active",
-            Account.auth_token != None,
-            Account.auth_token != ""
-        ).all()
-        
-        if not accounts:
-            return None
-            
-        # 简单随机轮询
-        account = random.choice(accounts)
-        return account.auth_token
+    async def load_account_pool(db: AsyncSession):
+        result = await db.execute(select(Account))
+        account_pool.load(result.scalars().all())
+
+    @staticmethod
+    def notify_pool_changed():
+        # 多 worker 时通知其他 worker 重新同步账号池
+        if shared_state.active:
+            shared_state.bump(ACCOUNTS_VERSION)
+
+    @staticmethod
+    async def sync_account_pool(reaped: int = 0):
+        # 心跳时检查：其他 worker 增删改过账号则按数据库同步，保留本进程的在途数与熔断状态
+        if not shared_state.changed(ACCOUNTS_VERSION):
+            return
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(select(Account))
+            account_pool.sync(result.scalars().all())
+
+    @staticmethod
+    async def acquire_account(lane: str = DEFAULT_LANE) -> Optional[PooledAccount]:
+        # 经准入控制从内存账号池选出账号，达到并发上限时按优先级排队；请求结束后需调用 release_account
+        # 排队已满或等待超时抛出 AdmissionRejected
+        return await admission.acquire(lane)
+
+    @staticmethod
+    def try_acquire_account(exclude: Container[int] = (), held: bool = False) -> Optional[PooledAccount]:
+        # 不排队地再取一个账号（对冲、失败转移使用），没有空闲名额时返回 None；
+        # 失败转移先用 hold_slot 占住名额，held=True 时用该名额换账号
+        return admission.try_acquire(exclude, held)
+
+    @staticmethod
+    def hold_slot():
+        admission.hold()
+
+    @staticmethod
+    def unhold_slot():
+        admission.unhold()
+
+    @staticmethod
+    def release_account(account_id: int, status_code: Optional[int] = None):
+        # status_code 为上游结果，驱动账号熔断器和调用统计；None 表示未拿到上游结果
+        admission.release(account_id, status_code)
+        metrics.upstream_responses.inc(str(status_code) if status_code is not None else "none")
+        if status_code is not None:
+            AccountService.update_account_stats(account_id, success=status_code == 200)
+
+    @staticmethod
+    def account_to_dict(account: Account) -> Dict[str, Any]:
+        data = account.to_dict()
+        data["circuit"] = account_pool.circuit_state(account.id)
+        return data
+
+    @staticmethod
+    async def _write_account_status(account_id: int, status: str):
+        async with AsyncSessionLocal() as db:
+            try:
+                await db.execute(
+                    update(Account)
+                    .where(
+                        Account.id == account_id,
+                        Account.status.in_(list(STATE_BY_ACCOUNT_STATUS))
+                    )
+                    .values(status=status)
+                    .execution_options(synchronize_session=False)
+                )
+                await db.commit()
+            except Exception as e:
+                logger.error(f"写入账号熔断状态失败: {e}")
+
+    @staticmethod
+    def persist_account_status(account_id: int, status: str):
+        # 熔断状态变化写回 Account.status；只覆盖由熔断器管理的状态，不改动手动停用的账号
+        try:
+            asyncio.get_running_loop().create_task(AccountService._write_account_status(account_id, status))
+        except RuntimeError:
+            logger.warning(f"无事件循环，跳过写入账号熔断状态: {account_id} -> {status}")
+
+# 熔断状态变化时同步到数据库
+account_pool.add_listener(AccountService.persist_account_status)
+shared_state.add_tick_listener(AccountService.sync_account_pool)
 
 # 配置服务
 class ConfigService:
     @staticmethod
-    def get_config(db: Session, key: str) -> Optional[str]:
-        config = db.query(AppConfig).filter(AppConfig.key == key).first()
+    async def _get(db: AsyncSession, key: str) -> Optional[AppConfig]:
+        result = await db.execute(select(AppConfig).where(AppConfig.key == key))
+        return result.scalars().first()
+
+    @staticmethod
+    async def get_config(db: AsyncSession, key: str) -> Optional[str]:
+        config = await ConfigService._get(db, key)
         return config.value if config else None
     
     @staticmethod
-    def set_config(db: Session, key: str, value: str, value_type: str = "string", description: str = ""):
-        config = db.query(AppConfig).filter(AppConfig.key == key).first()
+    async def set_config(db: AsyncSession, key: str, value: str, value_type: str = "string", description: str = ""):
+        config = await ConfigService._get(db, key)
         if config:
             config.value = value
             config.value_type = value_type
@@ -171,22 +261,53 @@ class ConfigService:
         else:
             config = AppConfig(key=key, value=value, value_type=value_type, description=description)
             db.add(config)
-        db.commit()
+        await db.commit()
+        config_cache.put(key, value, value_type)
+        if shared_state.active:
+            shared_state.bump(CONFIG_VERSION)
         return config
     
     @staticmethod
-    def list_configs(db: Session) -> List[AppConfig]:
-        return db.query(AppConfig).all()
+    async def list_configs(db: AsyncSession) -> List[AppConfig]:
+        result = await db.execute(select(AppConfig))
+        return result.scalars().all()
     
     @staticmethod
-    def delete_config(db: Session, key: str) -> bool:
-        config = db.query(AppConfig).filter(AppConfig.key == key).first()
+    async def delete_config(db: AsyncSession, key: str) -> bool:
+        config = await ConfigService._get(db, key)
         if not config:
             return False
-        db.delete(config)
-        db.commit()
+        await db.delete(config)
+        await db.commit()
+        config_cache.invalidate(key)
+        if shared_state.active:
+            shared_state.bump(CONFIG_VERSION)
         return True
 
+    @staticmethod
+    async def load_config_cache(db: AsyncSession):
+        config_cache.load(await ConfigService.list_configs(db))
+
+    @staticmethod
+    async def sync_config_cache(reaped: int = 0):
+        # 心跳时检查：其他 worker 修改过配置（如 API Key）则重新加载
+        if not shared_state.changed(CONFIG_VERSION):
+            return
+        async with AsyncSessionLocal() as db:
+            await ConfigService.load_config_cache(db)
+
+    @staticmethod
+    def get_cached(key: str, default: Any = None) -> Any:
+        # 从进程内缓存读取已按 value_type 转换的配置值，不访问数据库
+        return config_cache.get(key, default)
+
+    @staticmethod
+    def get_cached_raw(key: str, default: Optional[str] = None) -> Optional[str]:
+        return config_cache.get_raw(key, default)
+
+# 其他 worker 修改配置后重新加载
+shared_state.add_tick_listener(ConfigService.sync_config_cache)
+
 # 浏览器自动化服务
 class BrowserService:
     @staticmethod
@@ -229,41 +350,191 @@ class BrowserService:
 # AI服务（集成Puter.js）
 class AIService:
     @staticmethod
-    async def generate_image(db: Session, prompt: str, model: str = "gpt-image-1", **kwargs):
-        token = AccountService.get_next_token(db)
-        if not token:
+    async def generate_image(db: AsyncSession, prompt: str, model: str = "gpt-image-1", **kwargs):
+        request_data = {
+            "prompt": prompt,
+            "model": model,
+            "quality": kwargs.get("quality", "high")
+        }
+        response_format = kwargs.get("response_format") or "b64_json"
+
+        # 相同生成参数的图片直接从图片缓存返回，不再调用上游
+        cache_key = None
+        if settings.image_cache_enabled:
+            cache_key = make_image_key(request_data, PuterBridge.DEFAULT_IMAGE_MODEL)
+            cached = await AIService._cached_image(cache_key, response_format)
+            if cached is not None:
+                return cached
+
+        try:
+            account = await AccountService.acquire_account()
+        except AdmissionRejected as e:
+            return {"error": e.to_openai()["error"]["message"]}
+        if not account:
              return {"error": "No active account found. Please connect a Puter account first."}
+        outcome = []
              
         try:
-             return await PuterBridge.generate_image({
-                 "prompt": prompt,
-                 "model": model, 
-                 "quality": kwargs.get("quality", "high")
-             }, token)
+             return await PuterBridge.generate_image(
+                 request_data,
+                 account.token,
+                 on_status=outcome.append,
+                 response_format=response_format,
+                 cache_key=cache_key
+             )
         except Exception as e:
              logger.error(f"Image generation failed: {e}")
              return {"error": str(e)}
+        finally:
+             AccountService.release_account(account.account_id, outcome[-1] if outcome else None)
+
+    @staticmethod
+    async def _cached_image(cache_key: str, response_format: str) -> Optional[Dict[str, Any]]:
+        name = image_store.lookup(cache_key)
+        if name is None:
+            return None
+        if response_format == "url":
+            item = {"url": f"{IMAGE_ROUTE}/{name}"}
+        else:
+            b64_json = await image_store.read_base64(name)
+            if b64_json is None:
+                return None
+            item = {"b64_json": b64_json}
+        return {"created": int(time.time()), "data": [item]}
     
     @staticmethod
-    async def chat(db: Session, message: str, model: str = "gpt-4o-mini", stream: bool = False):
+    async def chat(db: AsyncSession, message: str, model: str = "gpt-4o-mini", stream: bool = False):
         # 注意: 这里的chat方法主要用于简单的内部测试或非流式调用
         # 流式调用应该直接在API层处理
         
-        token = AccountService.get_next_token(db)
-        if not token:
+        try:
+            account = await AccountService.acquire_account()
+        except AdmissionRejected as e:
+            return {"error": e.to_openai()["error"]["message"]}
+        if not account:
              return {"error": "No active account found. Please connect a Puter account first."}
+        outcome = []
 
         try:
              return await PuterBridge.chat_completion({
                  "messages": [{"role": "user", "content": message}],
                  "model": model
-             }, token)
+             }, account.token, on_status=outcome.append)
         except Exception as e:
              logger.error(f"Chat completion failed: {e}")
              return {"error": str(e)}
+        finally:
+             AccountService.release_account(account.account_id, outcome[-1] if outcome else None)
+
+# 文件服务（/v1/files）
+class FileService:
+    @staticmethod
+    def files_dir() -> Path:
+        return Path(settings.data_dir) / "files"
+
+    @staticmethod
+    def new_id() -> str:
+        return f"file-{uuid.uuid4().hex[:24]}"
+
+    @staticmethod
+    async def create_from_upload(db: AsyncSession, upload, purpose: str) -> StoredFile:
+        # 分块复制上传内容，不在内存中保留整个文件
+        file_id = FileService.new_id()
+        path = FileService.files_dir() / f"{file_id}.jsonl"
+        loop = asyncio.get_running_loop()
+
+        def open_target():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            return open(path, "wb")
+
+        target = await loop.run_in_executor(None, open_target)
+        size = 0
+        try:
+            while chunk := await upload.read(1024 * 1024):
+                size += len(chunk)
+                await loop.run_in_executor(None, target.write, chunk)
+        except BaseException:
+            target.close()
+            path.unlink(missing_ok=True)
+            raise
+        await loop.run_in_executor(None, target.close)
+        return await FileService.register(db, file_id, upload.filename or path.name, purpose, path, size)
+
+    @staticmethod
+    async def register(db: AsyncSession, file_id: str, filename: str, purpose: str, path: Path, size: int) -> StoredFile:
+        stored = StoredFile(id=file_id, filename=filename, purpose=purpose, path=str(path), bytes=size)
+        db.add(stored)
+        await db.commit()
+        return stored
+
+    @staticmethod
+    async def get_file(db: AsyncSession, file_id: str) -> Optional[StoredFile]:
+        return await db.get(StoredFile, file_id)
+
+    @staticmethod
+    async def list_files(db: AsyncSession, purpose: Optional[str] = None) -> List[StoredFile]:
+        stmt = select(StoredFile).order_by(StoredFile.created_at.desc())
+        if purpose:
+            stmt = stmt.where(StoredFile.purpose == purpose)
+        result = await db.execute(stmt)
+        return result.scalars().all()
+
+    @staticmethod
+    async def delete_file(db: AsyncSession, file_id: str) -> bool:
+        stored = await db.get(StoredFile, file_id)
+        if not stored:
+            return False
+        Path(stored.path).unlink(missing_ok=True)
+        await db.delete(stored)
+        await db.commit()
+        return True
+
+# 批处理服务（/v1/batches）；执行由 batch_runner 负责
+class BatchService:
+    SUPPORTED_ENDPOINTS = ("/v1/chat/completions",)
+
+    @staticmethod
+    async def create_batch(db: AsyncSession, batch_data: schemas.BatchCreate) -> Batch:
+        if batch_data.endpoint not in BatchService.SUPPORTED_ENDPOINTS:
+            raise ValueError(f"不支持的 endpoint: {batch_data.endpoint}")
+        input_file = await db.get(StoredFile, batch_data.input_file_id)
+        if not input_file or not Path(input_file.path).is_file():
+            raise ValueError(f"输入文件不存在: {batch_data.input_file_id}")
+
+        batch = Batch(
+            id=f"batch_{uuid.uuid4().hex[:24]}",
+            endpoint=batch_data.endpoint,
+            input_file_id=batch_data.input_file_id,
+            completion_window=batch_data.completion_window,
+            batch_metadata=batch_data.metadata,
+            status="validating",
+        )
+        db.add(batch)
+        await db.commit()
+        return batch
+
+    @staticmethod
+    async def get_batch(db: AsyncSession, batch_id: str) -> Optional[Batch]:
+        return await db.get(Batch, batch_id)
+
+    @staticmethod
+    async def list_batches(db: AsyncSession, limit: int = 20) -> List[Batch]:
+        result = await db.execute(select(Batch).order_by(Batch.created_at.desc()).limit(limit))
+        return result.scalars().all()
+
+    @staticmethod
+    async def cancel_batch(db: AsyncSession, batch_id: str) -> Optional[Batch]:
+        batch = await db.get(Batch, batch_id)
+        if not batch:
+            return None
+        if batch.status in ("validating", "in_progress", "finalizing"):
+            batch.status = "cancelling"
+            batch.cancelling_at = int(time.time())
+            await db.commit()
+        return batch
 
 # 初始化默认配置
-def init_default_configs(db: Session):
+async def init_default_configs(db: AsyncSession):
     default_configs = [
         ("api_key", "1", "string", "API访问密钥"),
         ("host", settings.host, "string", "服务器主机"),
@@ -273,4 +544,4 @@ def init_default_configs(db: Session):
     ]
     
     for key, value, value_type, description in default_configs:
-        ConfigService.set_config(db, key, value, value_type, description)
\ No newline at end of file
+        await ConfigService.set_config(db, key, value, value_type, description)
\ No newline at end of file
@@ -0,0 +1,387 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional, Tuple
+
+from config import settings
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# 多 worker 部署时各进程共享的调度状态，保存在一个 WAL 模式的 SQLite 文件中：
+# - account_leases：每个 worker 在各账号上的在途请求数（写绝对值），选账号与在途上限按所有 worker 的合计计算；
+# - breakers：熔断 / 恢复的状态变化，其他 worker 在下次选账号时同步；
+# - workers：心跳与指标快照，心跳超时的 worker 连同它的在途数与认领一起清除；
+# - claims：只应由一个 worker 执行的任务（批处理）的归属；
+# - versions：账号列表等低频变化的版本号，变化后其他 worker 重新加载。
+# 单 worker 时不启用，所有状态只在进程内存中。
+#
+# 事件循环上不做可能等锁的 SQLite 操作：心跳、在途数与熔断的写回、认领与版本号都在专用线程中执行
+# （该线程独占一个连接，busy 超时为 db_busy_timeout_ms）；事件循环只持有另一个连接，用于选账号事务
+# （busy 超时为 shared_state_acquire_timeout_ms，超时即按本 worker 状态调度）和 WAL 下不会等锁的读取。
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS workers (
+    worker_id TEXT PRIMARY KEY, pid INTEGER, started REAL, heartbeat REAL, metrics TEXT
+);
+CREATE TABLE IF NOT EXISTS account_leases (
+    worker_id TEXT, account_id INTEGER, outstanding INTEGER, PRIMARY KEY (worker_id, account_id)
+);
+CREATE TABLE IF NOT EXISTS breakers (
+    account_id INTEGER PRIMARY KEY, seq INTEGER, worker_id TEXT, state TEXT, open_until REAL,
+    trips INTEGER, consecutive_failures INTEGER, last_status INTEGER
+);
+CREATE TABLE IF NOT EXISTS claims (key TEXT PRIMARY KEY, worker_id TEXT);
+CREATE TABLE IF NOT EXISTS versions (name TEXT PRIMARY KEY, value INTEGER);
+"""
+
+TickListener = Callable[[int], Awaitable[None]]
+
+# 选账号时拿不到写锁后，这段时间（秒）内的选账号直接按本 worker 状态调度，不再逐个等待 busy 超时
+BUSY_BACKOFF = 0.1
+
+
+class SharedView:
+    """一次选账号事务中读到的其他 worker 的状态"""
+
+    __slots__ = ("outstanding", "breakers")
+
+    def __init__(self, outstanding: Dict[int, int], breakers: List[Tuple[int, Dict[str, Any]]]):
+        self.outstanding = outstanding
+        self.breakers = breakers
+
+
+class SharedState:
+    def __init__(self, path: str):
+        self.path = path
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        # 专用线程的连接 / 事件循环的连接
+        self._conn: Optional[sqlite3.Connection] = None
+        self._loop_conn: Optional[sqlite3.Connection] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        # 本 worker 各账号的在途数与待写回的账号；选账号事务之外的变化由专用线程合并写回
+        self._leases: Dict[int, int] = {}
+        self._dirty_leases: set = set()
+        self._flush_scheduled = False
+        self._in_transaction = False
+        self._busy_until = 0.0
+        self._breaker_seq = 0
+        self._versions: Dict[str, int] = {}
+        self._tick_listeners: List[TickListener] = []
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def enabled(self) -> bool:
+        return settings.shared_state_enabled or settings.workers > 1
+
+    @property
+    def active(self) -> bool:
+        return self._loop_conn is not None
+
+    def add_tick_listener(self, listener: TickListener):
+        """每次心跳后调用 listener(reaped)，reaped 为本次清除的失联 worker 数"""
+        self._tick_listeners.append(listener)
+
+    # ---- 生命周期 ----
+
+    def _connect(self, timeout_ms: float) -> sqlite3.Connection:
+        # isolation_level=None：自动提交，需要时显式 BEGIN IMMEDIATE
+        return sqlite3.connect(self.path, timeout=timeout_ms / 1000, isolation_level=None, check_same_thread=False)
+
+    def open(self):
+        if not self.enabled or self._conn is not None:
+            return
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        conn = self._connect(settings.db_busy_timeout_ms)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(SCHEMA)
+        now = time.time()
+        conn.execute(
+            "INSERT OR REPLACE INTO workers (worker_id, pid, started, heartbeat, metrics) VALUES (?, ?, ?, ?, NULL)",
+            (self.worker_id, os.getpid(), now, now),
+        )
+        # 同名 worker（pid 复用）上次残留的状态
+        conn.execute("DELETE FROM account_leases WHERE worker_id = ?", (self.worker_id,))
+        conn.execute("DELETE FROM claims WHERE worker_id = ?", (self.worker_id,))
+        self._breaker_seq = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM breakers").fetchone()[0]
+        self._versions = dict(conn.execute("SELECT name, value FROM versions"))
+        self._conn = conn
+        self._loop_conn = self._connect(settings.shared_state_acquire_timeout_ms)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="shared-state")
+        logger.info(f"共享状态已启用: {self.path} (worker {self.worker_id})")
+
+    def start(self):
+        if self.active and self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._heartbeat_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if not self.active:
+            return
+        self._loop_conn.close()
+        self._loop_conn = None
+        executor, self._executor = self._executor, None
+        # 等待已排队的写回完成后再注销
+        await asyncio.get_running_loop().run_in_executor(executor, self._unregister)
+        executor.shutdown(wait=True)
+
+    def _unregister(self):
+        try:
+            for table in ("account_leases", "claims", "workers"):
+                self._conn.execute(f"DELETE FROM {table} WHERE worker_id = ?", (self.worker_id,))
+        except sqlite3.Error as e:
+            logger.warning(f"注销共享状态失败: {e}")
+        self._conn.close()
+        self._conn = None
+
+    async def _run(self, fn: Callable, *args) -> Any:
+        """在专用线程中执行 fn，等待结果"""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def _submit(self, fn: Callable, *args):
+        """在专用线程中执行 fn，不等待结果；停止后提交的写回直接丢弃"""
+        if self._executor is not None:
+            self._executor.submit(fn, *args)
+
+    async def _heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(settings.shared_state_heartbeat)
+            try:
+                # 指标快照在事件循环上取（指标只在这里更新），序列化与写入在专用线程
+                reaped = await self._run(self.heartbeat, metrics.registry.snapshot())
+            except sqlite3.Error as e:
+                logger.warning(f"共享状态心跳失败: {e}")
+                continue
+            for listener in self._tick_listeners:
+                try:
+                    await listener(reaped)
+                except Exception as e:
+                    logger.error(f"共享状态心跳回调失败: {e}", exc_info=True)
+
+    def heartbeat(self, snapshot: Dict[str, List]) -> int:
+        """（专用线程）更新心跳与指标快照，清除心跳超时的 worker；返回清除的 worker 数"""
+        encoded = json.dumps(snapshot, separators=(",", ":"))
+        now = time.time()
+        conn = self._conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # 被其他 worker 误判为失联而清除后重新登记；在途数在下次选账号 / 归还时按绝对值写回
+            conn.execute(
+                "INSERT INTO workers (worker_id, pid, started, heartbeat, metrics) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(worker_id) DO UPDATE SET heartbeat = excluded.heartbeat, metrics = excluded.metrics",
+                (self.worker_id, os.getpid(), now, now, encoded),
+            )
+            deadline = now - settings.shared_state_worker_timeout
+            reaped = [row[0] for row in conn.execute("SELECT worker_id FROM workers WHERE heartbeat < ?", (deadline,))]
+            for worker_id in reaped:
+                for table in ("account_leases", "claims", "workers"):
+                    conn.execute(f"DELETE FROM {table} WHERE worker_id = ?", (worker_id,))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        if reaped:
+            logger.warning(f"清除失联的 worker: {', '.join(reaped)}")
+        return len(reaped)
+
+    # ---- 账号调度 ----
+
+    @contextmanager
+    def acquire_transaction(self) -> Iterator[Optional[SharedView]]:
+        """
+        选账号的写事务（事件循环上）：BEGIN IMMEDIATE 让各 worker 的选择串行化，读到的在途数在提交前不会被其他 worker 改变。
+        写锁在 shared_state_acquire_timeout_ms 内拿不到（或共享文件不可用）时产出 None，调用方按本进程上次同步的状态继续调度。
+        """
+        conn = self._loop_conn
+        if time.monotonic() < self._busy_until:
+            yield None
+            return
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+        except sqlite3.Error as e:
+            logger.debug(f"共享状态繁忙，按本 worker 状态调度: {e}")
+            self._busy_until = time.monotonic() + BUSY_BACKOFF
+            yield None
+            return
+        self._in_transaction = True
+        try:
+            view = SharedView(
+                dict(conn.execute(
+                    "SELECT account_id, SUM(outstanding) FROM account_leases WHERE worker_id != ? GROUP BY account_id",
+                    (self.worker_id,),
+                )),
+                self._read_breakers(),
+            )
+            yield view
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            self._in_transaction = False
+        try:
+            conn.execute("COMMIT")
+        except sqlite3.Error as e:
+            logger.warning(f"提交共享状态失败: {e}")
+
+    def _read_breakers(self) -> List[Tuple[int, Dict[str, Any]]]:
+        rows = self._loop_conn.execute(
+            "SELECT seq, account_id, state, open_until, trips, consecutive_failures, last_status FROM breakers "
+            "WHERE seq > ? AND worker_id != ? ORDER BY seq",
+            (self._breaker_seq, self.worker_id),
+        ).fetchall()
+        if rows:
+            self._breaker_seq = rows[-1][0]
+        return [
+            (account_id, {
+                "state": state, "open_until": open_until, "trips": trips,
+                "consecutive_failures": failures, "last_status": last_status,
+            })
+            for _, account_id, state, open_until, trips, failures, last_status in rows
+        ]
+
+    def write_lease(self, account_id: int, outstanding: int):
+        """
+        写入本 worker 在该账号上的在途数（绝对值，丢失或被清除后下次写入即恢复）。
+        在选账号事务内直接写入；否则交给专用线程，线程在写事务中读取当时的最新值，不会用旧值覆盖新值。
+        """
+        self._leases[account_id] = outstanding
+        if self._in_transaction:
+            self._put_lease(self._loop_conn, account_id)
+            return
+        self._dirty_leases.add(account_id)
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            self._submit(self._flush_leases)
+
+    def _put_lease(self, conn: sqlite3.Connection, account_id: int):
+        conn.execute(
+            "INSERT INTO account_leases (worker_id, account_id, outstanding) VALUES (?, ?, ?) "
+            "ON CONFLICT(worker_id, account_id) DO UPDATE SET outstanding = excluded.outstanding",
+            (self.worker_id, account_id, self._leases[account_id]),
+        )
+
+    def _flush_leases(self):
+        # 专用线程：合并写回排队期间变化过的所有账号
+        self._flush_scheduled = False
+        dirty, self._dirty_leases = self._dirty_leases, set()
+        if not dirty:
+            return
+        conn = self._conn
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                for account_id in dirty:
+                    self._put_lease(conn, account_id)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        except sqlite3.Error as e:
+            logger.warning(f"写入账号在途数失败: {e}")
+
+    def publish_breaker(self, account_id: int, state: Dict[str, Any]):
+        """熔断 / 恢复时调用，由专用线程写入"""
+        self._submit(self._publish_breaker, account_id, state)
+
+    def _publish_breaker(self, account_id: int, state: Dict[str, Any]):
+        try:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO breakers "
+                "(account_id, seq, worker_id, state, open_until, trips, consecutive_failures, last_status) "
+                "VALUES (?, (SELECT COALESCE(MAX(seq), 0) + 1 FROM breakers), ?, ?, ?, ?, ?, ?)",
+                (
+                    account_id, self.worker_id, state["state"], state["open_until"], state["trips"],
+                    state["consecutive_failures"], state["last_status"],
+                ),
+            )
+        except sqlite3.Error as e:
+            logger.warning(f"同步熔断状态失败: {e}")
+
+    # ---- 认领与版本 ----
+
+    async def claim(self, key: str) -> bool:
+        """认领只应由一个 worker 执行的任务；已被存活的其他 worker 认领时返回 False"""
+        return await self._run(self._claim, key)
+
+    def _claim(self, key: str) -> bool:
+        try:
+            self._conn.execute("INSERT OR IGNORE INTO claims (key, worker_id) VALUES (?, ?)", (key, self.worker_id))
+            row = self._conn.execute("SELECT worker_id FROM claims WHERE key = ?", (key,)).fetchone()
+        except sqlite3.Error as e:
+            # 共享文件不可用时由本 worker 执行，宁可重复也不让任务停住
+            logger.warning(f"认领 {key} 失败: {e}")
+            return True
+        return row is not None and row[0] == self.worker_id
+
+    def release_claim(self, key: str):
+        self._submit(self._release_claim, key)
+
+    def _release_claim(self, key: str):
+        try:
+            self._conn.execute("DELETE FROM claims WHERE key = ? AND worker_id = ?", (key, self.worker_id))
+        except sqlite3.Error as e:
+            logger.warning(f"释放认领失败: {e}")
+
+    def bump(self, name: str):
+        """本 worker 修改了共享的数据（如账号列表），让其他 worker 重新加载"""
+        self._submit(self._bump, name)
+
+    def _bump(self, name: str):
+        try:
+            self._conn.execute(
+                "INSERT INTO versions (name, value) VALUES (?, 1) "
+                "ON CONFLICT(name) DO UPDATE SET value = value + 1",
+                (name,),
+            )
+            self._versions[name] = self._conn.execute(
+                "SELECT value FROM versions WHERE name = ?", (name,)
+            ).fetchone()[0]
+        except sqlite3.Error as e:
+            logger.warning(f"更新共享版本失败: {e}")
+
+    def changed(self, name: str) -> bool:
+        """自上次检查以来其他 worker 是否修改过 name（WAL 下读取不等待写锁）"""
+        row = self._loop_conn.execute("SELECT value FROM versions WHERE name = ?", (name,)).fetchone()
+        value = row[0] if row else 0
+        if value == self._versions.get(name, 0):
+            return False
+        self._versions[name] = value
+        return True
+
+    # ---- 指标 ----
+
+    def peer_metrics(self) -> List[Dict[str, List]]:
+        """其他存活 worker 最近一次心跳时的指标快照"""
+        if not self.active:
+            return []
+        deadline = time.time() - settings.shared_state_worker_timeout
+        rows = self._loop_conn.execute(
+            "SELECT metrics FROM workers WHERE worker_id != ? AND heartbeat >= ? AND metrics IS NOT NULL",
+            (self.worker_id, deadline),
+        ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def workers(self) -> List[Dict[str, Any]]:
+        if not self.active:
+            return []
+        rows = self._loop_conn.execute("SELECT worker_id, pid, started, heartbeat FROM workers ORDER BY started").fetchall()
+        now = time.time()
+        return [
+            {"worker_id": worker_id, "pid": pid, "uptime": round(now - started, 1), "heartbeat_age": round(now - heartbeat, 1)}
+            for worker_id, pid, started, heartbeat in rows
+        ]
+
+
+# 全局共享状态实例
+shared_state = SharedState(settings.shared_state_path)
@@ -0,0 +1,170 @@
+import asyncio
+import logging
+from typing import AsyncIterator, Dict, List, Optional
+
+from config import settings
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class _Flight:
+    """
+    一次进行中的上游请求：缓存已产生的分块，供所有订阅者（含后加入者）重放。
+    缓存超过 stream_buffer_max_bytes 时裁掉所有订阅者都已读过的分块（之后不再接受新的订阅者），
+    仍超过时暂停读取上游，直到最慢的订阅者跟上。
+    """
+
+    def __init__(self):
+        # chunks[0] 的序号为 base；base > 0 表示开头已裁掉
+        self.chunks: List = []
+        self.sizes: List[int] = []
+        self.base = 0
+        self.size = 0
+        self.done = False
+        self.subscribers = 0
+        # 订阅者 -> 下一个要读的分块序号
+        self.positions: Dict[object, int] = {}
+        self.task: Optional[asyncio.Task] = None
+        # 发起者 start 或 abandon 时置位
+        self.settled = asyncio.Event()
+        # 订阅者读取进度变化时置位，唤醒因缓存已满而暂停的上游
+        self.progress = asyncio.Event()
+        self._cond = asyncio.Condition()
+
+    @property
+    def end(self) -> int:
+        return self.base + len(self.chunks)
+
+    async def publish(self, chunk):
+        async with self._cond:
+            self.chunks.append(chunk)
+            size = len(chunk) if isinstance(chunk, bytes) else 0
+            self.sizes.append(size)
+            self.size += size
+            self._cond.notify_all()
+        while self.size > settings.stream_buffer_max_bytes and self._trim() > settings.stream_buffer_max_bytes:
+            self.progress.clear()
+            await self.progress.wait()
+
+    def _trim(self) -> int:
+        """丢弃所有订阅者都已读过的分块，返回剩余（最慢的订阅者未读）的字节数"""
+        slowest = min(self.positions.values(), default=self.base)
+        drop = slowest - self.base
+        if drop > 0:
+            self.size -= sum(self.sizes[:drop])
+            del self.chunks[:drop]
+            del self.sizes[:drop]
+            self.base = slowest
+        return self.size
+
+    def advance(self, subscriber: object, index: Optional[int]):
+        """更新订阅者的读取进度；index 为 None 表示订阅者已离开"""
+        if index is None:
+            self.positions.pop(subscriber, None)
+        else:
+            self.positions[subscriber] = index
+        self.progress.set()
+
+    async def finish(self):
+        async with self._cond:
+            self.done = True
+            self._cond.notify_all()
+
+    async def wait_beyond(self, index: int):
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.done or self.end > index)
+
+
+class SingleFlight:
+    """合并相同的并发请求：同一个 key 只开一个上游流，分块扇出给所有订阅者"""
+
+    def __init__(self):
+        self._flights: Dict[str, _Flight] = {}
+
+    def join(self, key: str) -> Optional[AsyncIterator]:
+        """
+        已有相同请求（含已登记、尚未发出的请求）时加入它；否则为调用方登记一个待发起的请求并返回 None。
+        返回 None 后调用方必须 start 或 abandon；登记与检查之间没有 await，同时到达的相同请求只有一个成为发起者。
+        """
+        flight = self._flights.get(key)
+        if flight is None or flight.done or flight.base > 0:
+            # 开头已被裁掉的请求无法完整重放，由调用方重新发起
+            self._flights[key] = _Flight()
+            return None
+        return self._subscribe(flight)
+
+    def pending(self, key: str) -> Optional[asyncio.Event]:
+        """相同请求已登记但还在等账号（准入排队）时返回它的 settled 事件，否则返回 None"""
+        flight = self._flights.get(key)
+        if flight is None or flight.task is not None or flight.done:
+            return None
+        return flight.settled
+
+    def start(self, key: str, source: AsyncIterator) -> AsyncIterator:
+        """以 source 作为上游开启已登记的请求；source 在后台任务中消费，不依赖首个客户端"""
+        flight = self._flights.get(key)
+        if flight is None or flight.task is not None or flight.done:
+            flight = _Flight()
+            self._flights[key] = flight
+        flight.task = asyncio.get_running_loop().create_task(self._produce(key, flight, source))
+        flight.settled.set()
+        return self._subscribe(flight)
+
+    def abandon(self, key: str):
+        """发起者在 start 之前失败（断开、被准入拒绝等）时撤销登记；等待中的相同请求重新 join，其中一个成为发起者"""
+        flight = self._flights.get(key)
+        if flight is None or flight.task is not None:
+            return
+        del self._flights[key]
+        flight.done = True
+        flight.settled.set()
+        asyncio.get_running_loop().create_task(flight.finish())
+
+    async def _produce(self, key: str, flight: _Flight, source: AsyncIterator):
+        try:
+            async for chunk in source:
+                await flight.publish(chunk)
+        except asyncio.CancelledError:
+            logger.info(f"合并请求已无订阅者，取消上游: {key[:12]}")
+        except Exception as e:
+            logger.error(f"合并请求上游出错: {e}")
+        finally:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            await source.aclose()
+            await flight.finish()
+
+    async def _subscribe(self, flight: _Flight):
+        flight.subscribers += 1
+        subscriber = object()
+        index = flight.base
+        flight.advance(subscriber, index)
+        try:
+            while True:
+                # 先重放已缓存的分块，再等待新分块
+                while index < flight.end:
+                    chunk = flight.chunks[index - flight.base]
+                    index += 1
+                    flight.advance(subscriber, index)
+                    yield chunk
+                if flight.done:
+                    return
+                await flight.wait_beyond(index)
+        finally:
+            flight.advance(subscriber, None)
+            flight.subscribers -= 1
+            if flight.subscribers == 0 and not flight.done and flight.task is not None:
+                flight.task.cancel()
+
+    def in_flight(self) -> int:
+        return len(self._flights)
+
+
+# 全局请求合并实例
+singleflight = SingleFlight()
+
+metrics.registry.register(metrics.CallbackMetric(
+    "puter_singleflight_inflight", "Coalesced upstream requests in flight", (),
+    lambda: {(): singleflight.in_flight()},
+))
@@ -1,11 +1,97 @@
 import json
 import time
+import uuid
+from json.encoder import encode_basestring
 from typing import Dict, Any, Optional
 
+# orjson 为可选依赖，安装后自动使用
+try:
+    import orjson
+except ImportError:  # pragma: no cover - 取决于运行环境
+    orjson = None
+
 DONE_CHUNK = b"data: [DONE]\n\n"
+# 上游失败时流中的 OpenAI 格式错误帧以此开头
+ERROR_FRAME_PREFIX = b'data: {"error"'
+
+# 上游文本可能含孤立的代理项（如被截断的 emoji），无法编码成 UTF-8；此时整体改用 \uXXXX 转义输出
+_dumps_ascii = json.JSONEncoder(separators=(",", ":")).encode
+
+if orjson is not None:
+    JSON_BACKEND = "orjson"
+
+    def dumps_bytes(data: Any) -> bytes:
+        try:
+            return orjson.dumps(data)
+        except orjson.JSONEncodeError:
+            return _dumps_ascii(data).encode("ascii")
+
+    def encode_json_string(text: str) -> bytes:
+        try:
+            return orjson.dumps(text)
+        except orjson.JSONEncodeError:
+            return json.dumps(text).encode("ascii")
+else:
+    JSON_BACKEND = "json"
+    _dumps = json.JSONEncoder(ensure_ascii=False, separators=(",", ":")).encode
+
+    def dumps_bytes(data: Any) -> bytes:
+        try:
+            return _dumps(data).encode("utf-8")
+        except UnicodeEncodeError:
+            return _dumps_ascii(data).encode("ascii")
+
+    def encode_json_string(text: str) -> bytes:
+        try:
+            return encode_basestring(text).encode("utf-8")
+        except UnicodeEncodeError:
+            return json.dumps(text).encode("ascii")
 
 def create_sse_data(data: Dict[str, Any]) -> bytes:
-    return f"data: {json.dumps(data)}\n\n".encode('utf-8')
+    return b"data: " + dumps_bytes(data) + b"\n\n"
+
+def new_request_id() -> str:
+    return f"chatcmpl-{uuid.uuid4().hex}"
+
+class ChunkEncoder:
+    """
+    单个请求的 chat.completion.chunk 编码器。
+    id / model / created 在构造时一次性编码成固定的字节前后缀，
+    每个分块只需转义增量文本并拼接字节。
+    include_usage 对应 stream_options.include_usage：每个分块带 "usage":null，结束前多一个只含 usage 的分块。
+    """
+
+    def __init__(
+        self,
+        model: str,
+        request_id: Optional[str] = None,
+        created: Optional[int] = None,
+        include_usage: bool = False
+    ):
+        self.model = model
+        self.request_id = request_id or new_request_id()
+        self.created = created if created is not None else int(time.time())
+        self.include_usage = include_usage
+        envelope = (
+            b'data: {"id":' + encode_json_string(self.request_id)
+            + b',"object":"chat.completion.chunk","created":' + str(self.created).encode("ascii")
+            + b',"model":' + encode_json_string(model)
+        )
+        head = envelope + b',"choices":[{"index":0,"delta":'
+        self._tail = (b',"usage":null' if include_usage else b'') + b'}\n\n'
+        self._content_prefix = head + b'{"content":'
+        self._content_suffix = b'},"finish_reason":null}]' + self._tail
+        self._envelope = envelope
+        self._head = head
+
+    def content(self, text: str) -> bytes:
+        return self._content_prefix + encode_json_string(text) + self._content_suffix
+
+    def finish(self, finish_reason: str = "stop") -> bytes:
+        return self._head + b'{},"finish_reason":' + encode_json_string(finish_reason) + b'}]' + self._tail
+
+    def usage(self, usage: Dict[str, int]) -> bytes:
+        return self._envelope + b',"choices":[],"usage":' + dumps_bytes(usage) + b'}\n\n'
 
 def create_chat_completion_chunk(
     request_id: str,
@@ -31,7 +117,8 @@ def create_chat_completion_response(
     request_id: str,
     model: str,
     content: str,
-    finish_reason: str = "stop"
+    finish_reason: str = "stop",
+    usage: Optional[Dict[str, int]] = None
 ) -> Dict[str, Any]:
     return {
         "id": request_id,
@@ -48,7 +135,7 @@ def create_chat_completion_response(
                 "finish_reason": finish_reason
             }
         ],
-        "usage": {
+        "usage": usage or {
             "prompt_tokens": 0,
             "completion_tokens": 0,
             "total_tokens": 0
@@ -0,0 +1,138 @@
+import asyncio
+import datetime
+import logging
+import threading
+from typing import Dict, Optional
+
+from sqlalchemy import bindparam, func, update
+
+from config import settings
+from database import AsyncSessionLocal
+from models import Account
+
+logger = logging.getLogger(__name__)
+
+
+class _PendingStats:
+    __slots__ = ("total", "success", "failed", "last_success", "last_failure")
+
+    def __init__(self):
+        self.total = 0
+        self.success = 0
+        self.failed = 0
+        self.last_success: Optional[datetime.datetime] = None
+        self.last_failure: Optional[datetime.datetime] = None
+
+
+class AccountStatsBuffer:
+    """账号调用统计的写回缓冲：热路径只改内存，后台定期批量写入 accounts 表"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending: Dict[int, _PendingStats] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def record(self, account_id: int, success: bool):
+        now = datetime.datetime.now()
+        with self._lock:
+            stats = self._pending.get(account_id)
+            if stats is None:
+                stats = self._pending[account_id] = _PendingStats()
+            stats.total += 1
+            if success:
+                stats.success += 1
+                stats.last_success = now
+            else:
+                stats.failed += 1
+                stats.last_failure = now
+
+    def _drain(self) -> Dict[int, _PendingStats]:
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        return pending
+
+    def _restore(self, pending: Dict[int, _PendingStats]):
+        # 写入失败时把增量合并回缓冲，下次重试
+        with self._lock:
+            for account_id, stats in pending.items():
+                current = self._pending.get(account_id)
+                if current is None:
+                    self._pending[account_id] = stats
+                    continue
+                current.total += stats.total
+                current.success += stats.success
+                current.failed += stats.failed
+                current.last_success = current.last_success or stats.last_success
+                current.last_failure = current.last_failure or stats.last_failure
+
+    async def flush(self, db) -> int:
+        """在一个事务内批量写入所有待写统计，返回写入的账号数"""
+        pending = self._drain()
+        if not pending:
+            return 0
+
+        table = Account.__table__
+        stmt = (
+            update(table)
+            .where(table.c.id == bindparam("b_id"))
+            .values(
+                total_calls=func.coalesce(table.c.total_calls, 0) + bindparam("b_total"),
+                success_calls=func.coalesce(table.c.success_calls, 0) + bindparam("b_success"),
+                failed_calls=func.coalesce(table.c.failed_calls, 0) + bindparam("b_failed"),
+                last_success=func.coalesce(bindparam("b_last_success"), table.c.last_success),
+                last_failure=func.coalesce(bindparam("b_last_failure"), table.c.last_failure),
+            )
+        )
+        params = [
+            {
+                "b_id": account_id,
+                "b_total": stats.total,
+                "b_success": stats.success,
+                "b_failed": stats.failed,
+                "b_last_success": stats.last_success,
+                "b_last_failure": stats.last_failure,
+            }
+            for account_id, stats in pending.items()
+        ]
+        try:
+            await db.execute(stmt, params)
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            self._restore(pending)
+            raise
+        return len(params)
+
+    # ---- 后台定时写入 ----
+
+    async def flush_async(self):
+        try:
+            async with AsyncSessionLocal() as db:
+                count = await self.flush(db)
+            if count:
+                logger.debug(f"已写入 {count} 个账号的调用统计")
+        except Exception as e:
+            logger.error(f"写入账号调用统计失败: {e}")
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(settings.stats_flush_interval)
+            await self.flush_async()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush_async()
+
+
+# 全局统计缓冲实例
+stats_buffer = AccountStatsBuffer()
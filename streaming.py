@@ -0,0 +1,86 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Dict
+
+from starlette.requests import ClientDisconnect, Request
+from starlette.responses import StreamingResponse
+from starlette.types import Receive, Scope, Send
+
+from config import settings
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# 客户端中途断开导致的取消次数，按检测方式分类
+cancellations: Dict[str, int] = {
+    "client_disconnect": 0,  # 收到 http.disconnect
+    "send_failed": 0,        # 向客户端写数据失败
+    "poll": 0,               # 非流式请求轮询 Request.is_disconnected() 发现断开
+}
+
+metrics.registry.register(metrics.CallbackMetric(
+    "puter_stream_cancellations_total",
+    "Requests cancelled because the client disconnected, by detection method",
+    ("reason",),
+    lambda: {(reason,): count for reason, count in cancellations.items()},
+    "counter",
+))
+
+
+def record_cancellation(reason: str, path: str = ""):
+    cancellations[reason] = cancellations.get(reason, 0) + 1
+    logger.info(f"客户端已断开，取消上游请求: {path} ({reason})")
+
+
+class CancellableStreamingResponse(StreamingResponse):
+    """
+    客户端断开时立即关闭 body 迭代器。
+    Starlette 只取消发送任务，停在 yield 处的生成器要等到被回收才会关闭，
+    期间上游流仍在读取；这里显式 aclose，让生成器的 finally 关闭上游连接并归还账号。
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        self.completed = False
+        self.disconnect_reason = "client_disconnect"
+
+    async def stream_response(self, send: Send) -> None:
+        try:
+            await super().stream_response(send)
+        except OSError:
+            self.disconnect_reason = "send_failed"
+            return
+        self.completed = True
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            if not self.completed:
+                record_cancellation(self.disconnect_reason, scope.get("path", ""))
+            aclose = getattr(self.body_iterator, "aclose", None)
+            if aclose is not None:
+                await aclose()
+
+
+async def until_disconnected(request: Request, awaitable: Awaitable) -> Any:
+    """
+    等待 awaitable 完成，期间按 settings.disconnect_poll_interval 轮询客户端是否断开。
+    断开时取消 awaitable 并抛出 ClientDisconnect。
+    """
+    task = asyncio.ensure_future(awaitable)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=settings.disconnect_poll_interval)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                record_cancellation("poll", request.url.path)
+                raise ClientDisconnect()
+    finally:
+        if not task.done():
+            task.cancel()
+            try:
+                await task
+            except (asyncio.CancelledError, Exception):
+                pass
@@ -0,0 +1,140 @@
+import functools
+import logging
+import math
+import re
+from typing import Any, Dict, List, Optional
+
+from config import settings
+
+# tiktoken 为可选依赖，安装且编码文件可用时使用，否则按字符类别估算
+try:
+    import tiktoken
+except ImportError:  # pragma: no cover - 取决于运行环境
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+# 与 OpenAI 的计算方式一致：每条消息的固定开销，以及回复开头的引导 token
+TOKENS_PER_MESSAGE = 3
+REPLY_PRIMING_TOKENS = 3
+
+# 增量计数时未结束的词最多暂存的字符数（没有空白的长文本如中文按此长度分段计数）
+MAX_CARRY = 64
+
+_encoding = None
+
+# 估算：英文单词约 5 个字母一个 token，数字 3 位一个，CJK 每字一个，其余符号约 2 个一个
+_PIECE_RE = re.compile(
+    r" ?[A-Za-z]+| ?\d+|[぀-ヿ㐀-鿿가-힯豈-﫿]| ?[^\sA-Za-z\d぀-ヿ㐀-鿿가-힯豈-﫿]+|\s+"
+)
+
+
+def load_tokenizer():
+    """启动时调用一次（可能需要读取或下载编码文件，不要放在请求路径上）"""
+    global _encoding
+    name = settings.usage_tokenizer
+    if not name or tiktoken is None:
+        logger.info("token 用量使用内置估算")
+        return
+    try:
+        _encoding = tiktoken.get_encoding(name)
+        count_text.cache_clear()
+        logger.info(f"token 用量使用 tiktoken 编码 {name}")
+    except Exception as e:
+        logger.warning(f"加载 tiktoken 编码 {name} 失败，使用内置估算: {e}")
+
+
+def _estimate(text: str) -> int:
+    tokens = 0
+    for match in _PIECE_RE.finditer(text):
+        piece = match.group()
+        last = piece[-1]
+        if last.isascii() and last.isalpha():
+            tokens += math.ceil(len(piece.lstrip()) / 5)
+        elif last.isdigit():
+            tokens += math.ceil(len(piece.lstrip()) / 3)
+        elif piece.isspace():
+            tokens += 1
+        elif len(piece) == 1 and not last.isascii():
+            tokens += 1
+        else:
+            tokens += math.ceil(len(piece.lstrip()) / 2)
+    return tokens
+
+
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    if _encoding is not None:
+        return len(_encoding.encode_ordinary(text))
+    return _estimate(text)
+
+
+@functools.lru_cache(maxsize=4096)
+def count_text(text: str) -> int:
+    """带缓存的计数：用于多轮对话中反复出现的历史消息"""
+    return count_tokens(text)
+
+
+def _content_text(content: Any) -> str:
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        # 多模态消息只统计文本部分
+        return "".join(part.get("text", "") for part in content if isinstance(part, dict) and part.get("type") == "text")
+    return "" if content is None else str(content)
+
+
+def prompt_tokens(messages: List[Dict[str, Any]]) -> int:
+    total = REPLY_PRIMING_TOKENS
+    for message in messages or []:
+        if not isinstance(message, dict):
+            continue
+        total += TOKENS_PER_MESSAGE + count_text(str(message.get("role", ""))) + count_text(_content_text(message.get("content")))
+        if message.get("name"):
+            total += 1 + count_text(str(message["name"]))
+    return total
+
+
+def make_usage(prompt: int, completion: int) -> Dict[str, int]:
+    return {"prompt_tokens": prompt, "completion_tokens": completion, "total_tokens": prompt + completion}
+
+
+def usage_for(messages: List[Dict[str, Any]], completion: str) -> Dict[str, int]:
+    return make_usage(prompt_tokens(messages), count_tokens(completion))
+
+
+def include_usage(request_data: Dict[str, Any]) -> bool:
+    options = request_data.get("stream_options")
+    return isinstance(options, dict) and bool(options.get("include_usage"))
+
+
+class CompletionCounter:
+    """
+    按增量累计输出 token 数。BPE 的预分词在空白前断开，所以每次只对新片段中最后一个空白之前的部分计数，
+    之后未结束的词留到下一个片段；每个片段的工作量与片段长度成正比。
+    """
+
+    __slots__ = ("tokens", "_carry")
+
+    def __init__(self):
+        self.tokens = 0
+        self._carry = ""
+
+    def add(self, text: str):
+        data = self._carry + text if self._carry else text
+        cut = max(data.rfind(" "), data.rfind("\n"))
+        if cut <= 0:
+            if len(data) <= MAX_CARRY:
+                self._carry = data
+                return
+            cut = len(data)
+        self.tokens += count_tokens(data[:cut])
+        self._carry = data[cut:]
+
+    def total(self) -> int:
+        return self.tokens + count_tokens(self._carry)
+
+
+def stream_usage(messages: List[Dict[str, Any]], counter: Optional[CompletionCounter]) -> Dict[str, int]:
+    return make_usage(prompt_tokens(messages), counter.total() if counter is not None else 0)
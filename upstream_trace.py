@@ -0,0 +1,303 @@
+import asyncio
+import base64
+import bisect
+import itertools
+import json
+import logging
+import os
+import time
+import uuid
+from collections import defaultdict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, AsyncIterator, Dict, List, Tuple
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# 上游流量录制与回放。
+# 录制：包装上游 httpx transport，记录每个响应的状态、首包延迟以及每个网络分块的到达时间和边界，
+# 写成 trace 文件（不含 auth_token 与消息内容，NDJSON 中的 text 默认替换为等长占位字符）。
+# 回放：ReplayTransport 按 trace 的时序返回同样的分块，PuterBridge 走完全相同的解析与编码路径。
+
+TRACE_VERSION = 1
+
+# 按 UTF-8 字节数选择占位字符，替换后每个字符的编码长度不变
+_FILLERS = {1: "x", 2: "é", 3: "中", 4: "😀"}
+
+
+def redact_text(text: str) -> str:
+    return "".join(ch if ch.isspace() else _FILLERS[len(ch.encode("utf-8"))] for ch in text)
+
+
+def redact_ndjson(body: bytes, sizes: List[int]) -> Tuple[bytes, List[int]]:
+    """
+    逐行替换 NDJSON 中 text 字段的内容，返回新的 body 和分块大小。
+    重新序列化可能让行长度略有变化，分块边界按其在所在行中的偏移映射到新内容。
+    """
+    old_starts: List[int] = []
+    new_starts: List[int] = []
+    new_lengths: List[int] = []
+    lines: List[bytes] = []
+    old_pos = new_pos = 0
+    for line in body.splitlines(keepends=True):
+        old_starts.append(old_pos)
+        new_starts.append(new_pos)
+        old_pos += len(line)
+        stripped = line.rstrip(b"\r\n")
+        try:
+            data = json.loads(stripped)
+        except ValueError:
+            data = None
+        if isinstance(data, dict) and isinstance(data.get("text"), str):
+            data["text"] = redact_text(data["text"])
+            line = json.dumps(data, ensure_ascii=False).encode("utf-8") + line[len(stripped):]
+        lines.append(line)
+        new_lengths.append(len(line))
+        new_pos += len(line)
+
+    new_sizes = []
+    previous = 0
+    offset = 0
+    for size in sizes:
+        offset += size
+        if offset >= len(body):
+            mapped = new_pos
+        else:
+            index = bisect.bisect_right(old_starts, offset) - 1
+            mapped = new_starts[index] + min(offset - old_starts[index], new_lengths[index])
+        new_sizes.append(mapped - previous)
+        previous = mapped
+    return b"".join(lines), new_sizes
+
+
+def request_meta(request: httpx.Request) -> Dict[str, Any]:
+    """从 drivers/call 请求体中提取回放匹配所需的字段；auth_token 与消息内容不会被记录"""
+    try:
+        payload = json.loads(request.content or b"{}")
+    except ValueError:
+        payload = {}
+    if not isinstance(payload, dict):
+        payload = {}
+    args = payload.get("args") if isinstance(payload.get("args"), dict) else {}
+    return {
+        "method": request.method,
+        "path": request.url.path,
+        "interface": payload.get("interface"),
+        "driver": payload.get("driver"),
+        "call": payload.get("method"),
+        "model": args.get("model"),
+        "stream": args.get("stream"),
+        "messages": len(args.get("messages") or []),
+    }
+
+
+@dataclass
+class Trace:
+    request: Dict[str, Any]
+    status: int
+    headers: Dict[str, str]
+    response_delay: float
+    # (相对请求开始的秒数, 分块内容)
+    chunks: List[Tuple[float, bytes]] = field(default_factory=list)
+    complete: bool = True
+
+    def to_dict(self, redact: bool = True) -> Dict[str, Any]:
+        body = b"".join(chunk for _, chunk in self.chunks)
+        sizes = [len(chunk) for _, chunk in self.chunks]
+        content_type = self.headers.get("content-type", "")
+        encoding = "utf-8"
+        if content_type.startswith("image/"):
+            # 图片只保留分块大小，回放时以零字节填充
+            stored = None
+            encoding = "omitted"
+        else:
+            if redact:
+                body, sizes = redact_ndjson(body, sizes)
+            try:
+                stored = body.decode("utf-8")
+            except UnicodeDecodeError:
+                stored = base64.b64encode(body).decode("ascii")
+                encoding = "base64"
+        return {
+            "version": TRACE_VERSION,
+            "request": self.request,
+            "status": self.status,
+            "headers": self.headers,
+            "response_delay": round(self.response_delay, 6),
+            "complete": self.complete,
+            "encoding": encoding,
+            "body": stored,
+            "chunks": [[round(t, 6), size] for (t, _), size in zip(self.chunks, sizes)],
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "Trace":
+        encoding = data.get("encoding", "utf-8")
+        sizes = [size for _, size in data["chunks"]]
+        if encoding == "omitted":
+            body = bytes(sum(sizes))
+        elif encoding == "base64":
+            body = base64.b64decode(data["body"])
+        else:
+            body = data["body"].encode("utf-8")
+        chunks = []
+        offset = 0
+        for t, size in data["chunks"]:
+            chunks.append((t, body[offset:offset + size]))
+            offset += size
+        return cls(
+            request=data.get("request") or {},
+            status=data["status"],
+            headers=data.get("headers") or {},
+            response_delay=data.get("response_delay", 0.0),
+            chunks=chunks,
+            complete=data.get("complete", True),
+        )
+
+
+def load_traces(directory: str) -> List[Trace]:
+    traces = []
+    for path in sorted(Path(directory).glob("*.json")):
+        try:
+            traces.append(Trace.from_dict(json.loads(path.read_text(encoding="utf-8"))))
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.warning(f"跳过无法读取的 trace 文件 {path}: {e}")
+    return traces
+
+
+class _RecordingStream(httpx.AsyncByteStream):
+    def __init__(self, inner: httpx.AsyncByteStream, trace: Trace, start: float, recorder: "RecordingTransport"):
+        self._inner = inner
+        self._trace = trace
+        self._start = start
+        self._recorder = recorder
+        self._saved = False
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        async for chunk in self._inner:
+            if chunk:
+                self._trace.chunks.append((time.monotonic() - self._start, chunk))
+            yield chunk
+        self._trace.complete = True
+
+    async def aclose(self) -> None:
+        try:
+            await self._inner.aclose()
+        finally:
+            if not self._saved:
+                self._saved = True
+                await self._recorder.save(self._trace)
+
+
+class RecordingTransport(httpx.AsyncBaseTransport):
+    """包装真实的上游 transport，把每个响应写成 directory 下的一个 trace 文件"""
+
+    def __init__(self, inner: httpx.AsyncBaseTransport, directory: str, redact: bool = True):
+        self._inner = inner
+        self.directory = Path(directory)
+        self.redact = redact
+        self.recorded = 0
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        # 要求不压缩，记录到的分块就是实际解析的字节
+        request.headers["accept-encoding"] = "identity"
+        start = time.monotonic()
+        response = await self._inner.handle_async_request(request)
+        trace = Trace(
+            request=request_meta(request),
+            status=response.status_code,
+            headers={"content-type": response.headers.get("content-type", "")},
+            response_delay=time.monotonic() - start,
+            complete=False,
+        )
+        return httpx.Response(
+            status_code=response.status_code,
+            headers=response.headers,
+            stream=_RecordingStream(response.stream, trace, start, self),
+            extensions=response.extensions,
+        )
+
+    async def save(self, trace: Trace):
+        # 客户端中途断开时保留已收到的部分，complete 为 False
+        model = str(trace.request.get("model") or "unknown").replace("/", "_")
+        path = self.directory / f"{int(time.time() * 1000)}-{model}-{uuid.uuid4().hex[:8]}.json"
+        data = json.dumps(trace.to_dict(self.redact), ensure_ascii=False)
+
+        def write():
+            self.directory.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_suffix(".tmp")
+            tmp_path.write_text(data, encoding="utf-8")
+            os.replace(tmp_path, path)
+
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, write)
+            self.recorded += 1
+        except OSError as e:
+            logger.warning(f"写入上游 trace 失败: {e}")
+
+    async def aclose(self) -> None:
+        await self._inner.aclose()
+
+
+class _ReplayStream(httpx.AsyncByteStream):
+    def __init__(self, trace: Trace, speed: float, start: float):
+        self._trace = trace
+        self._speed = speed
+        self._start = start
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        for t, chunk in self._trace.chunks:
+            if self._speed > 0:
+                # 按相对请求开始的时刻等待，处理耗时不会累积成漂移
+                delay = self._start + t / self._speed - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            yield chunk
+
+
+class ReplayTransport(httpx.AsyncBaseTransport):
+    """
+    按录制的 trace 返回上游响应，不访问网络。
+    请求按 (interface, model) 匹配 trace，没有同模型的 trace 时退回同接口的任意 trace，依次轮换；
+    speed 为回放倍速，0 表示不等待、尽快输出。
+    """
+
+    def __init__(self, traces: List[Trace], speed: float = 1.0):
+        if not traces:
+            raise ValueError("没有可回放的 trace")
+        self.speed = speed
+        self._by_model: Dict[Tuple[Any, Any], List[Trace]] = defaultdict(list)
+        self._by_interface: Dict[Any, List[Trace]] = defaultdict(list)
+        for trace in traces:
+            self._by_model[(trace.request.get("interface"), trace.request.get("model"))].append(trace)
+            self._by_interface[trace.request.get("interface")].append(trace)
+        self._all = traces
+        self._cursors: Dict[int, Any] = {}
+        self.replayed = 0
+
+    def _pick(self, request: httpx.Request) -> Trace:
+        meta = request_meta(request)
+        candidates = (
+            self._by_model.get((meta["interface"], meta["model"]))
+            or self._by_interface.get(meta["interface"])
+            or self._all
+        )
+        cursor = self._cursors.get(id(candidates))
+        if cursor is None:
+            cursor = self._cursors[id(candidates)] = itertools.cycle(candidates)
+        return next(cursor)
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        trace = self._pick(request)
+        start = time.monotonic()
+        if self.speed > 0 and trace.response_delay > 0:
+            await asyncio.sleep(trace.response_delay / self.speed)
+        self.replayed += 1
+        return httpx.Response(
+            status_code=trace.status,
+            headers=trace.headers,
+            stream=_ReplayStream(trace, self.speed, start),
+        )
+